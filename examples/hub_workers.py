@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+More worker processes listening on the same port. Every received message is
+answered to the peer "xconnector" regardless of the worker it is connected to.
+Peers connect to port 4000 without SSL.
+"""
+
+import sys
+sys.path.insert(0, "../")
+
+import multiprocessing
+import logging
+
+import snakemq
+import snakemq.link
+import snakemq.packeter
+import snakemq.messaging
+import snakemq.message
+import snakemq.hub
+
+WORKERS = 4
+MESH_ADDRESSES = ["unix:/tmp/snakemq_hub_%i" % i for i in range(WORKERS)]
+
+def worker(index):
+    def on_recv(conn, ident, message):
+        print("worker %i received from" % index, conn, ident, message)
+        # the reply is forwarded if the peer is connected to another worker
+        m.send_message("xconnector",
+                      snakemq.message.Message(b"reply", ttl=60))
+
+    s = snakemq.link.Link()
+    s.add_listener(("", 4000), reuse_port=True)
+    pktr = snakemq.packeter.Packeter(s)
+    m = snakemq.messaging.Messaging("xlistener", "", pktr)
+    m.on_message_recv.add(on_recv)
+
+    hub = snakemq.hub.HubForwarder(m, index, MESH_ADDRESSES)
+    hub.start()
+    try:
+        s.loop()
+    finally:
+        hub.cleanup()
+        s.cleanup()
+
+snakemq.init_logging()
+logger = logging.getLogger("snakemq")
+logger.setLevel(logging.INFO)
+
+processes = [multiprocessing.Process(target=worker, args=[i])
+              for i in range(WORKERS)]
+for process in processes:
+    process.start()
+for process in processes:
+    process.join()
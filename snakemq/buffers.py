@@ -33,7 +33,30 @@ class BufferTooLarge(BufferException):
 ############################################################################
 ############################################################################
 
+def fragments_head(fragments, size):
+    """
+    :param fragments: list of bytes-like objects
+    :return: list of fragments holding max N-bytes from the beginning of
+             ``fragments``, nothing is copied
+    """
+    head = []
+    for fragment in fragments:
+        if not size:
+            break
+        if len(fragment) > size:
+            fragment = memoryview(fragment)[:size]
+        head.append(fragment)
+        size -= len(fragment)
+    return head
+
+############################################################################
+############################################################################
+
 class StreamBuffer(object):
+    """
+    Thread-safe buffer with an optional maximal size. See
+    :class:`LocklessStreamBuffer` for buffers used only by a single thread.
+    """
     def __init__(self):
         self.size = 0  #: current size of the buffer
         self.max_size = None
@@ -49,8 +72,7 @@ class StreamBuffer(object):
 
     def clear(self):
         with self.not_full_cond:
-            self.queue.clear()
-            self.size = 0
+            self._clear()
             self.not_full_cond.notify()
 
     ############################################################
@@ -89,14 +111,7 @@ class StreamBuffer(object):
                 if self.size + data_len > self.max_size:
                     raise BufferTimeout
 
-            self.size += data_len
-            for i in range(len(data) // MAX_BUF_CHUNK_SIZE + 1):
-                chunk = data[i * MAX_BUF_CHUNK_SIZE:(i + 1) * MAX_BUF_CHUNK_SIZE]
-                if not chunk:
-                    break
-                self.queue.append(chunk)
-                del chunk
-            del data
+            self._put(data)
 
     ############################################################
 
@@ -107,45 +122,24 @@ class StreamBuffer(object):
         :param cut: True = remove returned data from buffer
         :return: max N-bytes from the buffer.
         """
-        assert (((self.size > 0) and (len(self.queue) > 0))
-             or ((self.size == 0) and (len(self.queue) == 0)))
-
-        retbuf = []
-        i = 0
         with self.not_full_cond:
             orig_size = self.size
-            while size and self.queue:
-                if cut:
-                    fragment = self.queue.popleft()
-                else:
-                    fragment = self.queue[i]
-
-                if len(fragment) > size:
-                    if cut:
-                        # paste back the rest
-                        self.queue.appendleft(fragment[size:])
-                    # get only needed
-                    fragment = fragment[:size]
-                    frag_len = size
-                else:
-                    frag_len = len(fragment)
-
-                retbuf.append(fragment)
-                del fragment
-
-                size -= frag_len
-                if cut:
-                    self.size -= frag_len
-                else:
-                    i += 1
-                    if i == len(self.queue):
-                        break
+            data = self._get(size, cut)
+            self._notify_not_full(orig_size)
+        return data
 
-            if (self.max_size and (orig_size >= self.max_size) and
-                                  (self.size < self.max_size)):
-                self.not_full_cond.notify()
+    ############################################################
 
-        return b"".join(retbuf)
+    def get_fragments(self, size):
+        """
+        Same as ``get(size, cut=False)`` but the data are not joined into a
+        single string.
+
+        :return: list of bytes-like objects holding max N-bytes from the
+                 buffer
+        """
+        with self.not_full_cond:
+            return fragments_head(self.queue, size)
 
     ############################################################
 
@@ -153,31 +147,139 @@ class StreamBuffer(object):
         """
         More efficient version of get(cut=True) and no data will be returned.
         """
+        with self.not_full_cond:
+            orig_size = self.size
+            self._cut(size)
+            self._notify_not_full(orig_size)
+
+    ############################################################
+
+    def __len__(self):
+        return self.size
+
+    ############################################################
+    # unsynchronized implementation
+    ############################################################
+
+    def _notify_not_full(self, orig_size):
+        if (self.max_size and (orig_size >= self.max_size) and
+                              (self.size < self.max_size)):
+            self.not_full_cond.notify()
+
+    ############################################################
+
+    def _clear(self):
+        self.queue.clear()
+        self.size = 0
+
+    ############################################################
+
+    def _put(self, data):
+        data_len = len(data)
+        self.size += data_len
+        if data_len > MAX_BUF_CHUNK_SIZE:
+            # chunks are just views, the data is not copied
+            view = memoryview(data)
+            for i in range(0, data_len, MAX_BUF_CHUNK_SIZE):
+                self.queue.append(view[i:i + MAX_BUF_CHUNK_SIZE])
+            del view
+        else:
+            self.queue.append(data)
+
+    ############################################################
+
+    def _get(self, size, cut):
         assert (((self.size > 0) and (len(self.queue) > 0))
              or ((self.size == 0) and (len(self.queue) == 0)))
 
-        with self.not_full_cond:
-            orig_size = self.size
-            while size and self.queue:
+        retbuf = []
+        i = 0
+        while size and self.queue:
+            if cut:
                 fragment = self.queue.popleft()
+            else:
+                fragment = self.queue[i]
 
-                if len(fragment) > size:
+            if len(fragment) > size:
+                if cut:
                     # paste back the rest
-                    self.queue.appendleft(fragment[size:])
-                    frag_len = size
-                else:
-                    frag_len = len(fragment)
-
-                del fragment
-                size -= frag_len
+                    self.queue.appendleft(memoryview(fragment)[size:])
+                # get only needed
+                fragment = fragment[:size]
+                frag_len = size
+            else:
+                frag_len = len(fragment)
+
+            retbuf.append(fragment)
+            del fragment
+
+            size -= frag_len
+            if cut:
                 self.size -= frag_len
+            else:
+                i += 1
+                if i == len(self.queue):
+                    break
 
-            if (self.max_size and (orig_size >= self.max_size) and
-                                  (self.size < self.max_size)):
-                self.not_full_cond.notify()
+        return b"".join(retbuf)
 
     ############################################################
 
-    def __len__(self):
-        assert sum([len(item) for item in self.queue]) == self.size
-        return self.size
+    def _cut(self, size):
+        assert (((self.size > 0) and (len(self.queue) > 0))
+             or ((self.size == 0) and (len(self.queue) == 0)))
+
+        while size and self.queue:
+            fragment = self.queue.popleft()
+
+            if len(fragment) > size:
+                # paste back the rest
+                self.queue.appendleft(memoryview(fragment)[size:])
+                frag_len = size
+            else:
+                frag_len = len(fragment)
+
+            del fragment
+            size -= frag_len
+            self.size -= frag_len
+
+############################################################################
+############################################################################
+
+class LocklessStreamBuffer(StreamBuffer):
+    """
+    **Not thread-safe** variant of :class:`StreamBuffer` without the maximal
+    size. Intended for buffers owned by the link loop.
+    """
+
+    def clear(self):
+        self._clear()
+
+    ############################################################
+
+    def set_max_size(self, max_size):
+        if max_size is not None:
+            raise BufferException("lockless buffer can't have a max size")
+
+    ############################################################
+
+    def put(self, data, timeout=None):
+        assert type(data) == bytes
+        if data:
+            # do not insert an empty string
+            self._put(data)
+
+    ############################################################
+
+    def get(self, size, cut=True):
+        return self._get(size, cut)
+
+    ############################################################
+
+    def get_fragments(self, size):
+        return fragments_head(self.queue, size)
+
+    ############################################################
+
+    def cut(self, size):
+        self._cut(size)
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Hub of worker processes sharing one public address (see
+``Link.add_listener(..., reuse_port=True)``). Every worker runs its own
+Link/Packeter/Messaging stack and a peer is connected to just one of them.
+Workers are interconnected by a mesh of hub links. They announce which
+idents they own and messages queued for an ident owned by another worker are
+forwarded to it.
+
+Hub message data format: ``[1B kind|1B ident length|ident|data]``.
+
+The worker which forwarded a message is told when the owner has sent (or
+dropped) it, so ``on_message_sent`` and ``on_message_drop`` of the origin
+messaging are called as well (``conn_id`` of such ``on_message_sent`` is
+None). A message lost along with a crashed worker is not reported.
+
+:author: David Siroky (siroky@dasir.cz)
+:license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import struct
+import threading
+import logging
+from collections import deque
+
+from snakemq.link import Link
+from snakemq.packeter import Packeter
+from snakemq.messaging import Messaging, ENCODING
+from snakemq.message import Message
+
+###########################################################################
+###########################################################################
+
+#: mesh idents, not allowed for peers of the workers
+HUB_IDENT_PREFIX = "\x00hub:"
+HUB_IDENT = HUB_IDENT_PREFIX + "%i"
+
+HUB_OWN = 1
+HUB_DISOWN = 2
+HUB_FORWARD = 3
+HUB_SENT = 4  #: data is the UUID of the forwarded message
+HUB_DROPPED = 5  #: data is the UUID of the forwarded message
+
+#: TTL of delivery reports, the origin might be reconnecting to the mesh
+HUB_REPORT_TTL = 60
+
+HUB_HEADER = struct.Struct("!BB")
+
+###########################################################################
+###########################################################################
+
+class HubForwarder(object):
+    """
+    Attach a worker's messaging to the hub mesh. The mesh link runs in its
+    own thread, see :meth:`start`.
+    """
+
+    def __init__(self, messaging, worker, mesh_addresses, queues_storage=None):
+        """
+        :param messaging: :class:`~snakemq.messaging.Messaging` of the worker
+        :param worker: index of this worker in ``mesh_addresses``
+        :param mesh_addresses: hub listening addresses of all workers
+        :param queues_storage: storage for messages being forwarded
+        """
+        self.log = logging.getLogger("snakemq.hub")
+        self.messaging = messaging
+        self.worker = worker
+        self.workers = len(mesh_addresses)
+        self.lock = threading.Lock()
+        self.owners = {}  #: ident:worker index, idents of other workers
+        self.local = set()  #: idents connected to this worker
+        #: message uuid:ident, messages forwarded by this worker
+        self.outgoing = {}
+        #: message uuid:origin worker index, messages forwarded to this worker
+        self.incoming = {}
+        #: (kind, ident, message uuid) reports for the worker's messaging
+        self.reports = deque()
+        self.thread = None
+
+        self.link = Link()
+        self.link.add_listener(mesh_addresses[worker])
+        # every pair of workers is connected just once
+        for address in mesh_addresses[:worker]:
+            self.link.add_connector(address)
+        self.packeter = Packeter(self.link)
+        self.mesh = Messaging(HUB_IDENT % worker, "", self.packeter,
+                              queues_storage)
+        self.worker_by_ident = dict((HUB_IDENT % i, i)
+                                    for i in range(self.workers))
+
+        self.mesh.on_connect.add(self._on_mesh_connect)
+        self.mesh.on_disconnect.add(self._on_mesh_disconnect)
+        self.mesh.on_message_recv.add(self._on_mesh_message)
+        self.mesh.on_message_drop.add(self._on_mesh_message_drop)
+        messaging.on_connect.add(self._on_connect)
+        messaging.on_disconnect.add(self._on_disconnect)
+        messaging.on_message_sent.add(self._on_message_sent)
+        messaging.on_message_drop.add(self._on_message_drop)
+        messaging.packeter.link.on_loop_pass.add(self._on_loop_pass)
+
+    ############################################################
+
+    def start(self):
+        """
+        Run the mesh link loop in a thread.
+        """
+        self.thread = threading.Thread(target=self.link.loop,
+                                        name="snakemq_hub_%i" % self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    ############################################################
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.link.stop()
+        self.link.wakeup_poll()
+        self.thread.join()
+        self.thread = None
+
+    ############################################################
+
+    def cleanup(self):
+        """
+        Detach from the worker's messaging and close the mesh.
+        """
+        self.stop()
+        self.messaging.on_connect.remove(self._on_connect)
+        self.messaging.on_disconnect.remove(self._on_disconnect)
+        self.messaging.on_message_sent.remove(self._on_message_sent)
+        self.messaging.on_message_drop.remove(self._on_message_drop)
+        self.messaging.packeter.link.on_loop_pass.remove(self._on_loop_pass)
+        self.link.cleanup()
+
+    ############################################################
+
+    def get_owner(self, ident):
+        """
+        :return: index of the worker owning the ident or None if unknown
+        """
+        with self.lock:
+            if ident in self.local:
+                return self.worker
+            return self.owners.get(ident)
+
+    ############################################################
+
+    @staticmethod
+    def frame(kind, ident, data=b""):
+        ident = ident.encode(ENCODING)
+        return HUB_HEADER.pack(kind, len(ident)) + ident + data
+
+    ############################################################
+
+    def send_to_worker(self, worker, kind, ident):
+        # ttl=0 - the peer gets complete information on (re)connection
+        self.mesh.send_message(HUB_IDENT % worker,
+                              Message(self.frame(kind, ident), ttl=0))
+
+    ############################################################
+
+    def report(self, kind, ident, message_uuid):
+        """
+        Pass the delivery report of a forwarded message towards its origin.
+        """
+        with self.lock:
+            self.outgoing.pop(message_uuid, None)
+            origin = self.incoming.pop(message_uuid, None)
+        if origin is not None:
+            self.mesh.send_message(HUB_IDENT % origin,
+                          Message(self.frame(kind, ident, message_uuid),
+                                  ttl=HUB_REPORT_TTL))
+        else:
+            # callbacks are called in the worker's link thread
+            self.reports.append((kind, ident, message_uuid))
+            self.messaging.packeter.link.wakeup_poll()
+
+    ############################################################
+
+    def broadcast(self, kind, ident):
+        for worker in range(self.workers):
+            if worker != self.worker:
+                self.send_to_worker(worker, kind, ident)
+
+    ############################################################
+
+    def _on_connect(self, conn_id, ident):
+        if ident.startswith(HUB_IDENT_PREFIX):
+            self.log.error("reserved peer ident %r" % ident)
+            self.messaging.packeter.link.close(conn_id)
+            return
+        with self.lock:
+            self.local.add(ident)
+            self.owners.pop(ident, None)
+        self.broadcast(HUB_OWN, ident)
+
+    ############################################################
+
+    def _on_disconnect(self, conn_id, ident):
+        if ident.startswith(HUB_IDENT_PREFIX):
+            return
+        with self.lock:
+            self.local.discard(ident)
+        self.broadcast(HUB_DISOWN, ident)
+
+    ############################################################
+
+    def _on_mesh_connect(self, conn_id, hub_ident):
+        worker = self.worker_by_ident.get(hub_ident)
+        if worker is None:
+            self.log.error("unknown hub peer %r" % hub_ident)
+            self.link.close(conn_id)
+            return
+        with self.lock:
+            local = list(self.local)
+        for ident in local:
+            self.send_to_worker(worker, HUB_OWN, ident)
+
+    ############################################################
+
+    def _on_mesh_disconnect(self, conn_id, hub_ident):
+        worker = self.worker_by_ident.get(hub_ident)
+        with self.lock:
+            for ident, owner in list(self.owners.items()):
+                if owner == worker:
+                    del self.owners[ident]
+
+    ############################################################
+
+    def _on_mesh_message(self, conn_id, hub_ident, message):
+        worker = self.worker_by_ident[hub_ident]
+        data = message.data
+        kind, ident_len = HUB_HEADER.unpack_from(data)
+        start = HUB_HEADER.size
+        ident = data[start:start + ident_len].decode(ENCODING)
+
+        if kind == HUB_FORWARD:
+            # if the ident has moved meanwhile then the next loop pass
+            # forwards it again
+            with self.lock:
+                self.incoming[message.uuid] = worker
+            self.messaging.send_message(ident,
+                  Message(data[start + ident_len:], ttl=message.ttl,
+                          flags=message.flags, uuid=message.uuid))
+        elif kind in (HUB_SENT, HUB_DROPPED):
+            self.report(kind, ident, data[start + ident_len:])
+        elif kind == HUB_OWN:
+            with self.lock:
+                self.owners[ident] = worker
+            # messages queued meanwhile are forwarded in the next pass
+            self.messaging.packeter.link.wakeup_poll()
+        elif kind == HUB_DISOWN:
+            with self.lock:
+                if self.owners.get(ident) == worker:
+                    del self.owners[ident]
+        else:
+            self.log.error("unknown hub message kind %i from %s" %
+                            (kind, hub_ident))
+
+    ############################################################
+
+    def _on_loop_pass(self):
+        """
+        Pass delivery reports to the worker's messaging and move messages
+        queued for idents of other workers to the mesh.
+        """
+        while self.reports:
+            kind, ident, message_uuid = self.reports.popleft()
+            if kind == HUB_SENT:
+                self.messaging.on_message_sent(None, ident, message_uuid)
+            else:
+                self.messaging.on_message_drop(ident, message_uuid)
+
+        with self.lock:
+            if not self.owners:
+                return
+            owners = list(self.owners.items())
+        queues = self.messaging.queues_manager.queues
+        for ident, worker in owners:
+            queue = queues.get(ident)
+            if (queue is not None) and len(queue):
+                self.forward_queued(ident, worker)
+
+    ############################################################
+
+    def _on_message_sent(self, conn_id, ident, message_uuid):
+        if message_uuid in self.incoming:
+            self.report(HUB_SENT, ident, message_uuid)
+
+    ############################################################
+
+    def _on_message_drop(self, ident, message_uuid):
+        if message_uuid in self.incoming:
+            self.report(HUB_DROPPED, ident, message_uuid)
+
+    ############################################################
+
+    def _on_mesh_message_drop(self, hub_ident, message_uuid):
+        # forwarded message expired before it reached the owner
+        with self.lock:
+            ident = self.outgoing.get(message_uuid)
+        if ident is not None:
+            self.report(HUB_DROPPED, ident, message_uuid)
+
+    ############################################################
+
+    def forward_queued(self, ident, worker):
+        hub_ident = HUB_IDENT % worker
+        messages = self.messaging.pop_queued(ident)
+        with self.lock:
+            for message in messages:
+                self.outgoing[message.uuid] = ident
+        for message in messages:
+            self.mesh.send_message(hub_ident,
+                  Message(self.frame(HUB_FORWARD, ident, message.data),
+                          ttl=message.ttl, flags=message.flags,
+                          uuid=message.uuid))
+        self.log.debug("forwarded %r to %s" % (ident, hub_ident))
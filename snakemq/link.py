@@ -5,16 +5,20 @@
           U{http://www.opensource.org/licenses/mit-license.php})
 """
 
+import os
+import stat
 import select
 import socket
 import errno
 import time
 import bisect
 import logging
+import threading
 
 try:
     import ssl
-    HAS_SSL = True
+    # non-blocking handshakes and encryption use memory BIOs
+    HAS_SSL = hasattr(ssl, "MemoryBIO")
 except ImportError:
     import dummyssl as ssl
     HAS_SSL = False
@@ -24,14 +28,33 @@ from snakemq.exceptions import SendNotFinished
 from snakemq.poll import poll
 from snakemq.pollbell import Bell
 from snakemq.callbacks import Callback
+from snakemq.workers import WorkersPool
 
 ############################################################################
 ############################################################################
 
 RECONNECT_INTERVAL = 3.0
 RECV_BLOCK_SIZE = 256 * 1024
+#: max. bytes read from a single socket in one poll round
+RECV_BUDGET = 1024 * 1024
 POLL_TIMEOUT = 0.2
+#: seconds to wait for the peer's close of a closed SSL connection
+SSL_LINGER = 2.0
 BELL_READ = 1024
+#: more fragments are joined and sent by a regular send()
+SENDMSG_MAX_FRAGMENTS = 256
+
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+HAS_REUSEPORT = hasattr(socket, "SO_REUSEPORT")
+HAS_EPOLLET = hasattr(select, "EPOLLET")
+HAS_UNIX = hasattr(socket, "AF_UNIX")
+
+#: prefix of Unix domain socket addresses, ``"unix:/path"`` or
+#: ``"unix:@name"`` for the Linux abstract namespace
+UNIX_PREFIX = "unix:"
+
+#: threads of :meth:`Link.offload_ssl`
+SSL_WORKERS = 4
 
 SSL_HANDSHAKE_IN_PROGRESS = 0
 SSL_HANDSHAKE_DONE = 1
@@ -40,32 +63,198 @@ SSL_HANDSHAKE_FAILED = 2
 ############################################################################
 ############################################################################
 
+def is_unix_address(address):
+    return isinstance(address, str) and address.startswith(UNIX_PREFIX)
+
+############################################################################
+
+def resolve_address(address):
+    """
+    :param address: ``(host, port)`` or ``"unix:..."``
+    :return: address usable as a dictionary key
+    """
+    if is_unix_address(address):
+        if not HAS_UNIX:
+            raise RuntimeError("Unix domain sockets are not available")
+        return address
+    return socket.gethostbyname(address[0]), address[1]
+
+############################################################################
+
+def to_sockaddr(address):
+    """
+    :return: address for ``socket.bind()``/``socket.connect()``
+    """
+    if is_unix_address(address):
+        path = address[len(UNIX_PREFIX):]
+        if path.startswith("@"):
+            return "\0" + path[1:]  # abstract namespace
+        return path
+    return address
+
+############################################################################
+
+def address_family(address):
+    if is_unix_address(address):
+        return socket.AF_UNIX
+    return socket.AF_INET
+
+############################################################################
+
+def remove_stale_unix_socket(path):
+    """
+    Remove socket file left by a dead listener. A live one is kept and the
+    following bind fails.
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except OSError:
+        return  # does not exist
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as exc:
+        if exc.args[0] == errno.ECONNREFUSED:
+            os.unlink(path)
+    finally:
+        probe.close()
+
+############################################################################
+############################################################################
+
+# SSL tasks executed by worker threads, see Link.offload_ssl()
+
+def ssl_handshake_task(ssl_obj, incoming, outgoing, data):
+    """
+    :return: (done, data to send, received data pending, info), info is
+             ``(cipher, resumed, (peer certificate, binary certificate))``
+             of a finished handshake
+    """
+    if data:
+        incoming.write(data)
+    try:
+        ssl_obj.do_handshake()
+    except ssl.SSLWantReadError:
+        return False, outgoing.read(), False, None
+    info = (ssl_obj.cipher(), ssl_obj.session_reused,
+            (ssl_obj.getpeercert(), ssl_obj.getpeercert(True)))
+    pending = bool(incoming.pending or ssl_obj.pending())
+    return True, outgoing.read(), pending, info
+
+############################################################################
+
+def ssl_encrypt_task(ssl_obj, incoming, outgoing, data):
+    """
+    :return: encrypted data
+    """
+    ssl_obj.write(data)
+    return outgoing.read()
+
+############################################################################
+
+def ssl_decrypt_task(ssl_obj, incoming, outgoing, data):
+    """
+    :return: (decrypted data, data to send, closed by the peer)
+    """
+    if data:
+        incoming.write(data)
+    chunks = []
+    closed = False
+    while True:
+        try:
+            chunk = ssl_obj.read(RECV_BLOCK_SIZE)
+        except ssl.SSLWantReadError:
+            break
+        except ssl.SSLZeroReturnError:
+            closed = True
+            break
+        if not chunk:
+            closed = True
+            break
+        chunks.append(chunk)
+    return b"".join(chunks), outgoing.read(), closed
+
+############################################################################
+
+def ssl_eof_task(ssl_obj, incoming, outgoing, data):
+    """
+    Marks the end of the stream after all preceding tasks.
+    """
+    return None
+
+############################################################################
+############################################################################
+
 class SSLConfig(object):
     """
-    Container for SSL configuration.
+    Container for SSL configuration. One ``ssl.SSLContext`` per side is
+    created on the first use and shared by all connections of the listeners
+    and connectors using this configuration.
     """
     def __init__(self, keyfile=None, certfile=None, cert_reqs=ssl.CERT_NONE,
-                  ssl_version=ssl.PROTOCOL_SSLv23, ca_certs=None):
+                  ssl_version=ssl.PROTOCOL_SSLv23, ca_certs=None,
+                  context=None):
         """
-        :see: ssl.wrap_socket
+        :see: ssl.SSLContext
+        :param context: ``ssl.SSLContext`` used for both sides instead of
+                        the one created from the other parameters
         """
         self.keyfile = keyfile
         self.certfile = certfile
         self.cert_reqs = cert_reqs
         self.ssl_version = ssl_version
         self.ca_certs = ca_certs
+        self._contexts = {}  #: server_side:SSLContext
+        if context is not None:
+            self._contexts[True] = self._contexts[False] = context
+
+    ##########################################################
+
+    def get_context(self, server_side):
+        context = self._contexts.get(server_side)
+        if context is None:
+            context = self.create_context(server_side)
+            self._contexts[server_side] = context
+        return context
+
+    ##########################################################
+
+    def create_context(self, server_side):
+        protocol = self.ssl_version
+        if protocol == ssl.PROTOCOL_SSLv23:
+            # the same negotiation without the deprecated generic protocol
+            protocol = (ssl.PROTOCOL_TLS_SERVER if server_side
+                        else ssl.PROTOCOL_TLS_CLIENT)
+        context = ssl.SSLContext(protocol)
+        # peers are identified by certificates, not by host names
+        context.check_hostname = False
+        context.verify_mode = self.cert_reqs
+        if self.certfile is not None:
+            context.load_cert_chain(self.certfile, self.keyfile)
+        if self.ca_certs is not None:
+            context.load_verify_locations(self.ca_certs)
+        return context
 
 ############################################################################
 ############################################################################
 
 class LinkSocket(object):
-    def __init__(self, sock=None, ssl_config=None, remote_peer=None):
+    def __init__(self, sock=None, ssl_config=None, remote_peer=None,
+                  family=socket.AF_INET):
+        """
+        :param family: family of the created socket if ``sock`` is None
+        """
         if (ssl_config is not None) and not HAS_SSL:
-            raise RuntimeError("ssl module is not available")
+            raise RuntimeError("ssl module with memory BIO is not available")
         assert (sock is None) or isinstance(sock, socket.socket)
-        self.sock = sock or self.create_socket()
+        self.sock = sock or self.create_socket(family)
+        self.family = self.sock.family
         self.ssl_config = ssl_config
         self.remote_peer = remote_peer
+        self.unix_path = None  #: socket file of a listener
+        #: TLS session of the last connection, resumed by the reconnect
+        self.ssl_session = None
 
         self.is_connector = False  #: connector or listener
         self.conn_id = None
@@ -74,23 +263,43 @@ class LinkSocket(object):
     #########################################################
 
     def reset(self):
-        self.write_buf = None  #: for SSL
+        self.write_buf = None  #: encrypted data not sent yet
+        self.ssl_obj = None  #: ssl.SSLObject
+        self.ssl_incoming = None  #: ssl.MemoryBIO
+        self.ssl_outgoing = None  #: ssl.MemoryBIO
+        self.ssl_tasks = 0  #: tasks submitted to the SSL workers
+        self.ssl_encrypting = False  #: last send is in the SSL workers
+        self.ssl_eof = False  #: EOF waits for the SSL workers
+        #: (cipher, resumed, (cert, binary cert)) of a handshake done by
+        #: the workers
+        self.ssl_info = None
         self.last_send_size = 0
         self.send_finished = True
+        self.poll_mask = None  #: registered in the poller
+        self.edge_triggered = False
 
     #########################################################
 
     @staticmethod
-    def create_socket():
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def create_socket(family=socket.AF_INET):
+        sock = socket.socket(family, socket.SOCK_STREAM)
         sock.setblocking(False)
         return sock
 
     #########################################################
 
-    def listen(self, address):
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind(address)
+    def listen(self, address, reuse_port=False):
+        sockaddr = to_sockaddr(address)
+        if self.family == socket.AF_INET:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        elif not sockaddr.startswith("\0"):
+            remove_stale_unix_socket(sockaddr)
+            self.unix_path = sockaddr
+        if reuse_port:
+            if not HAS_REUSEPORT:
+                raise RuntimeError("SO_REUSEPORT is not available")
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(sockaddr)
         self.sock.listen(10)
 
     #########################################################
@@ -98,55 +307,87 @@ class LinkSocket(object):
     def accept(self):
         newsock, addr = self.sock.accept()
         newsock.setblocking(False)
-        if self.ssl_config is not None:
-            newsock = ssl.wrap_socket(newsock, server_side=True,
-                                      do_handshake_on_connect=False,
-                                      ssl_version=self.ssl_config.ssl_version,
-                                      keyfile=self.ssl_config.keyfile,
-                                      certfile=self.ssl_config.certfile,
-                                      cert_reqs=self.ssl_config.cert_reqs,
-                                      ca_certs=self.ssl_config.ca_certs)
         newsock = LinkSocket(newsock, self.ssl_config)
         newsock.remote_peer = addr
+        if self.ssl_config is not None:
+            newsock.start_ssl(server_side=True)
         return newsock, addr
 
     #########################################################
 
     def connect(self):
         self.is_connector = True
-        if self.ssl_config is not None:
-            self.sock = ssl.wrap_socket(self.sock, server_side=False,
-                                      do_handshake_on_connect=False,
-                                      ssl_version=self.ssl_config.ssl_version,
-                                      keyfile=self.ssl_config.keyfile,
-                                      certfile=self.ssl_config.certfile,
-                                      cert_reqs=self.ssl_config.cert_reqs,
-                                      ca_certs=self.ssl_config.ca_certs)
-        return self.sock.connect_ex(self.remote_peer)
+        return self.sock.connect_ex(to_sockaddr(self.remote_peer))
 
     #########################################################
 
     def send(self, data):
         """
-        If data is ``None`` then ``self.write_buf`` is used.
+        If data is ``None`` then only the rest of ``self.write_buf`` is sent.
+
+        :param data: bytes or list of bytes-like fragments, fragments are
+                     sent by a single ``sendmsg()`` call if possible
         """
         if (data is not None) and not self.send_finished:
             raise SendNotFinished(("previous send on %r is not finished, " +
                               "wait for on_ready_to_send") % self)
 
-        data = data or self.write_buf
+        if self.ssl_obj is not None:
+            self.send_ssl(data)
+            return
+
+        # nothing is sent if the socket raises EWOULDBLOCK
+        self.last_send_size = 0
+        if isinstance(data, list):
+            if HAS_SENDMSG and (len(data) <= SENDMSG_MAX_FRAGMENTS):
+                self.send_finished = False
+                self.last_send_size = self.sock.sendmsg(data)
+                return
+            data = b"".join(data)
 
         self.send_finished = False
-        if self.ssl_config is None:
-            self.last_send_size = self.sock.send(data)
-        else:
-            try:
-                self.last_send_size = self.sock.write(data)
-                self.write_buf = None
-            except ssl.SSLError as exc:
-                if exc.args[0] != ssl.SSL_ERROR_WANT_WRITE:
-                    raise
-                self.write_buf = data
+        self.last_send_size = self.sock.send(data)
+
+    #########################################################
+
+    def send_ssl(self, data):
+        if data is None:
+            self.flush_write_buf()
+            return
+        if isinstance(data, list):
+            data = b"".join(data)
+        # the memory BIO takes all the data, the socket gets what it can
+        self.last_send_size = self.ssl_obj.write(data)
+        self.send_finished = False
+        self.flush_ssl()
+
+    #########################################################
+
+    def flush_ssl(self):
+        """
+        Send the encrypted data, the rest is kept in ``self.write_buf``.
+        """
+        self.queue_encrypted(self.ssl_outgoing.read())
+        self.flush_write_buf()
+
+    #########################################################
+
+    def queue_encrypted(self, data):
+        if data:
+            self.write_buf = (self.write_buf + data) if self.write_buf else data
+
+    #########################################################
+
+    def flush_write_buf(self):
+        if not self.write_buf:
+            return
+        try:
+            sent = self.sock.send(self.write_buf)
+        except socket.error as exc:
+            if exc.args[0] != errno.EWOULDBLOCK:
+                raise
+            return
+        self.write_buf = self.write_buf[sent:] or None
 
     #########################################################
 
@@ -155,42 +396,149 @@ class LinkSocket(object):
 
     #########################################################
 
+    def recv_into(self, buf):
+        """
+        :return: size of the received (decrypted) data, 0 on EOF
+        """
+        if self.ssl_obj is None:
+            return self.sock.recv_into(buf)
+
+        buf = memoryview(buf)
+        try:
+            size = self.read_ssl(buf)
+            if not size:
+                data = self.sock.recv(len(buf))
+                if not data:
+                    return 0
+                self.ssl_incoming.write(data)
+                size = self.read_ssl(buf)
+        except ssl.SSLZeroReturnError:
+            return 0  # closed by the peer's close_notify
+        if self.ssl_outgoing.pending:
+            # post-handshake messages, the rest goes with the next send
+            self.flush_ssl()
+        if not size:
+            raise ssl.SSLWantReadError(ssl.SSL_ERROR_WANT_READ,
+                                        "incomplete record")
+        return size
+
+    #########################################################
+
+    def read_ssl(self, buf):
+        """
+        Decrypt as many records as fit into the buffer.
+        """
+        size = 0
+        while size < len(buf):
+            try:
+                read = self.ssl_obj.read(len(buf) - size, buf[size:])
+            except ssl.SSLWantReadError:
+                break
+            except ssl.SSLZeroReturnError:
+                if size:
+                    break
+                raise
+            if not read:
+                break
+            size += read
+        return size
+
+    #########################################################
+
+    def has_ssl_pending(self):
+        """
+        :return: True if there is received data not decrypted/read yet (no
+                 poll event would announce it)
+        """
+        return ((self.ssl_obj is not None) and
+                bool(self.ssl_incoming.pending or self.ssl_obj.pending()))
+
+    #########################################################
+
+    def start_ssl(self, server_side):
+        context = self.ssl_config.get_context(server_side)
+        self.ssl_incoming = ssl.MemoryBIO()
+        self.ssl_outgoing = ssl.MemoryBIO()
+        self.ssl_obj = context.wrap_bio(self.ssl_incoming, self.ssl_outgoing,
+                          server_side=server_side,
+                          session=None if server_side else self.ssl_session)
+
+    #########################################################
+
+    def recv_handshake(self):
+        """
+        :return: received data or None if there is nothing to read
+        """
+        try:
+            data = self.sock.recv(RECV_BLOCK_SIZE)
+        except socket.error as exc:
+            if exc.args[0] != errno.EWOULDBLOCK:
+                raise
+            return None
+        if not data:
+            raise socket.error(errno.ECONNRESET,
+                                "connection closed during handshake")
+        return data
+
+    #########################################################
+
+    def do_handshake(self):
+        """
+        Non-blocking step of the SSL handshake.
+
+        :return: True if the handshake is done
+        """
+        data = self.recv_handshake()
+        if data is not None:
+            self.ssl_incoming.write(data)
+        try:
+            self.ssl_obj.do_handshake()
+        except ssl.SSLWantReadError:
+            self.flush_ssl()
+            return False
+        self.flush_ssl()
+        return True
+
+    #########################################################
+
     def fileno(self):
         return self.sock.fileno()
 
     #########################################################
 
-    def close(self):
+    def close(self, linger=False):
+        """
+        :param linger: shut down just the sending and return the raw socket
+                       instead of closing it
+        """
+        # the SSL object must not be touched while the workers use it
+        if ((self.ssl_obj is not None) and self.is_connector and
+            (self.ssl_tasks == 0)):
+            try:
+                session = self.ssl_obj.session
+            except ValueError:
+                session = None  # handshake has not been finished
+            if session is not None:
+                self.ssl_session = session
+        raw_sock = self.sock
         try:
-            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.shutdown(socket.SHUT_WR if linger else socket.SHUT_RDWR)
         except socket.error as exc:
             if exc.errno not in (errno.ENOTCONN, errno.ECONNRESET):
                 raise
-        self.sock.close()
+        if not linger:
+            self.sock.close()
+        if self.unix_path is not None:
+            try:
+                os.unlink(self.unix_path)
+            except OSError:
+                pass
+            self.unix_path = None
         if self.is_connector:
             self.reset()
             # closed socket cannot be reconnected so a new one must be created
-            self.sock = self.create_socket()
-
-    #########################################################
-
-    def create_ssl_context(self):
-        assert isinstance(self.sock, ssl.SSLSocket)
-
-        if hasattr(self.sock, "_sock"):
-            raw_sock = self.sock._sock  # py2
-        else:
-            raw_sock = self.sock  # py3
-
-        # this is always called from handle_connect so server_side=False
-        if hasattr(self.sock, "context"):
-            self.sock._sslobj = self.sock.context._wrap_socket(raw_sock,
-                                                  False, None)
-        else:
-            self.sock._sslobj = ssl._ssl.sslwrap(raw_sock, False,
-                                        self.sock.keyfile, self.sock.certfile,
-                                        self.sock.cert_reqs, self.sock.ssl_version,
-                                        self.sock.ca_certs)
+            self.sock = self.create_socket(self.family)
+        return raw_sock if linger else None
 
     #########################################################
 
@@ -202,13 +550,14 @@ class LinkSocket(object):
 
     def getpeercert(self, binary_form=False):
         """
-        :see: python documentation - ssl.SSLSocket.getpeercert()
+        :see: python documentation - ssl.SSLObject.getpeercert()
         :return: peer's SSL certificate if available or None
         """
-        if self.ssl_config is None:
+        if self.ssl_obj is None:
             return None
-        else:
-            return self.sock._sslobj.peer_certificate(binary_form)
+        if self.ssl_info is not None:
+            return self.ssl_info[2][bool(binary_form)]
+        return self.ssl_obj.getpeercert(binary_form)
 
 ############################################################################
 ############################################################################
@@ -225,6 +574,26 @@ class Link(object):
 
         self.reconnect_interval = RECONNECT_INTERVAL  #: in seconds
         self.recv_block_size = RECV_BLOCK_SIZE
+        #: a socket is read repeatedly while it fills the whole block, up to
+        #: this count of bytes per poll round
+        self.recv_budget = RECV_BUDGET
+        #: ``on_recv`` gets a memoryview of the receive buffer instead of
+        #: bytes, it is valid only during the call (set by
+        #: :class:`~snakemq.packeter.Packeter` which copies it)
+        self.recv_memoryview = False
+        self._recv_buf = None  #: shared by all sockets
+        self._recv_view = None
+        #: edge-triggered poll (``EPOLLET``) for connections without SSL,
+        #: sockets are written until ``EWOULDBLOCK`` and read until drained,
+        #: set it before any connection is made (ignored without epoll)
+        self.edge_triggered = False
+        self._socks_to_recv = set()  #: edge-triggered, not drained
+        self._socks_ready_to_send = []  #: edge-triggered, last send passed
+        #: :class:`~snakemq.workers.WorkersPool`, see :meth:`offload_ssl`
+        self.ssl_pool = None
+        self.ssl_offload_records = False
+        self._ssl_results = []  #: finished tasks of the SSL workers
+        self._ssl_results_lock = threading.Lock()
 
         #{ callbacks
         self.on_connect = Callback()  #: ``func(conn_id)``
@@ -258,6 +627,7 @@ class Link(object):
         self._reconnect_intervals = {}  #: address:interval
 
         self._in_ssl_handshake = set()  #: set of LinkSocket
+        self._lingering = {}  #: fd:(raw socket, deadline)
 
     ##########################################################
 
@@ -265,6 +635,10 @@ class Link(object):
         """
         Close all sockets and remove all connectors and listeners.
         """
+        if self.ssl_pool is not None:
+            self.ssl_pool.shutdown()
+            self.ssl_pool = None
+            self._ssl_results = []
         self._poll_bell.close()
 
         for address in list(self._connectors.keys()):
@@ -274,7 +648,10 @@ class Link(object):
             self.del_listener(address)
 
         for sock in list(self._sock_by_fd.values()):
-            self.handle_close(sock)
+            self.close_ssl_sock(sock)
+
+        for fd in list(self._lingering.keys()):
+            self.close_lingering(fd)
 
         assert not self._do_loop
 
@@ -288,6 +665,7 @@ class Link(object):
         assert len(self._plannned_connections) == 0
         assert len(self._reconnect_intervals) == 0
         assert len(self._in_ssl_handshake) == 0
+        assert len(self._lingering) == 0
 
     ##########################################################
 
@@ -296,14 +674,16 @@ class Link(object):
         This will not create an immediate connection. It just adds a connector
         to the pool.
 
-        :param address: remote address
+        :param address: remote address ``(host, port)`` or a Unix domain
+                        socket ``"unix:/path"``
         :param reconnect_interval: reconnect interval in seconds
         :return: connector address (use it for deletion)
         """
-        address = socket.gethostbyname(address[0]), address[1]
+        address = resolve_address(address)
         if address in self._connectors:
             raise ValueError("connector '%r' already set", address)
-        sock = LinkSocket(remote_peer=address, ssl_config=ssl_config)
+        sock = LinkSocket(remote_peer=address, ssl_config=ssl_config,
+                          family=address_family(address))
         self._connectors[address] = sock
         self._reconnect_intervals[address] = \
                 reconnect_interval or self.reconnect_interval
@@ -326,29 +706,35 @@ class Link(object):
                   for (when, _address) in self._plannned_connections
                   if _address != address]
 
-        self.handle_close(sock)
+        self.close_ssl_sock(sock)
 
     ##########################################################
 
-    def add_listener(self, address, ssl_config=None):
+    def add_listener(self, address, ssl_config=None, reuse_port=False):
         """
         Adds listener to the pool. This method is not blocking. Run only once.
 
+        :param address: ``(host, port)`` or a Unix domain socket
+                        ``"unix:/path"``, a stale socket file is replaced
+        :param reuse_port: set ``SO_REUSEPORT``, more processes can listen
+                           on the same address and the kernel spreads
+                           incoming connections between them
         :return: listener address (use it for deletion)
         """
-        address = socket.gethostbyname(address[0]), address[1]
+        address = resolve_address(address)
         if address in self._listen_socks:
-            raise ValueError("listener '%r' already set" % address)
-        listen_sock = LinkSocket(ssl_config=ssl_config)
-        listen_sock.listen(address)
-        if address[1] == 0:
+            raise ValueError("listener '%r' already set" % (address,))
+        listen_sock = LinkSocket(ssl_config=ssl_config,
+                                family=address_family(address))
+        listen_sock.listen(address, reuse_port)
+        if (listen_sock.family == socket.AF_INET) and (address[1] == 0):
             address = listen_sock.sock.getsockname()
 
         fileno = listen_sock.fileno()
         self._sock_by_fd[fileno] = listen_sock
         self._listen_socks[address] = listen_sock
         self._listen_socks_filenos.add(fileno)
-        self.poller.register(listen_sock, select.EPOLLIN)
+        self.register_sock(listen_sock, select.EPOLLIN)
 
         self.log.debug("add_listener fd=%i %r" % (fileno, address))
         return address
@@ -367,6 +753,21 @@ class Link(object):
 
     ##########################################################
 
+    def offload_ssl(self, workers=SSL_WORKERS, records=False):
+        """
+        Execute SSL handshakes in a pool of threads so a burst of new
+        connections does not stall the established ones. Call it before
+        any connection is made.
+
+        :param workers: count of threads
+        :param records: encrypt and decrypt the data in the threads too,
+                        the loop just sends and receives the encrypted data
+        """
+        self.ssl_pool = WorkersPool(workers, name="snakemq_ssl")
+        self.ssl_offload_records = records
+
+    ##########################################################
+
     def wakeup_poll(self):
         """
         Thread-safe.
@@ -389,11 +790,23 @@ class Link(object):
         sometimes blocks for a little time even in non-blocking mode.
 
         Optimal data size is 16k-64k.
+
+        :param data: bytes or list of bytes-like fragments (scatter/gather
+                     send, the fragments are not joined if the platform
+                     supports ``sendmsg()``)
         """
         try:
             sock = self._sock_by_conn[conn_id]
+            if self.ssl_offload_records and (sock.ssl_obj is not None):
+                self.send_ssl_offloaded(sock, data)
+                return
             sock.send(data)
-            self.poller.modify(sock, select.EPOLLIN | select.EPOLLOUT)
+            if sock.edge_triggered:
+                # there might be no edge if the socket is still writable,
+                # try to send more until EWOULDBLOCK
+                self._socks_ready_to_send.append(sock)
+            else:
+                self.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
         except socket.error as exc:
             err = exc.args[0]
             if err == errno.EWOULDBLOCK:
@@ -411,6 +824,20 @@ class Link(object):
 
     ##########################################################
 
+    def adopt_socket(self, sock, remote_peer=None):
+        """
+        Take over an already connected socket, e.g. one end of
+        ``socket.socketpair()``. :attr:`on_connect` is called as for an
+        accepted connection. The connection is not reconnected.
+
+        :param sock: socket.socket
+        """
+        sock.setblocking(False)
+        self.add_accepted(LinkSocket(sock, remote_peer=remote_peer),
+                          remote_peer)
+
+    ##########################################################
+
     def loop(self, poll_timeout=POLL_TIMEOUT, count=None, runtime=None):
         """
         Start the communication loop.
@@ -436,6 +863,8 @@ class Link(object):
             if is_event and (count is not None):
                 count -= 1
             self.deal_connects()
+            if self._lingering:
+                self.deal_lingering()
 
         self._do_loop = False
 
@@ -458,6 +887,39 @@ class Link(object):
     ##########################################################
     ##########################################################
 
+    def register_sock(self, sock, mask):
+        if sock.edge_triggered:
+            mask = select.EPOLLIN | select.EPOLLOUT | select.EPOLLET
+        self.poller.register(sock, mask)
+        sock.poll_mask = mask
+
+    ##########################################################
+
+    def set_poll_mask(self, sock, mask):
+        """
+        Modify the poller registration only if the mask differs.
+        """
+        if sock.edge_triggered:
+            mask = select.EPOLLIN | select.EPOLLOUT | select.EPOLLET
+        if mask != sock.poll_mask:
+            self.poller.modify(sock, mask)
+            sock.poll_mask = mask
+
+    ##########################################################
+
+    def unregister_sock(self, sock):
+        self.poller.unregister(sock)
+        sock.poll_mask = None
+        self._socks_to_recv.discard(sock)
+
+    ##########################################################
+
+    def use_edge_trigger(self, sock):
+        sock.edge_triggered = (self.edge_triggered and HAS_EPOLLET and
+                                (sock.ssl_config is None))
+
+    ##########################################################
+
     def new_connection_id(self, sock):
         """
         Create a virtual connection ID. This ID will be passed to ``on_*``
@@ -498,14 +960,17 @@ class Link(object):
         sock = self._connectors[address]
         err = sock.connect()
 
-        self.poller.register(sock)
+        self.register_sock(sock, select.EPOLLIN | select.EPOLLOUT)
         self._sock_by_fd[sock.fileno()] = sock
         self._socks_waiting_to_connect.add(sock)
 
         if err in (0, errno.EISCONN):
             self.handle_connect(sock)
             return True
-        elif err in (errno.ECONNREFUSED, errno.ENETUNREACH):
+        elif ((err in (errno.ECONNREFUSED, errno.ENETUNREACH)) or
+              ((sock.family != socket.AF_INET) and
+                (err in (errno.ENOENT, errno.EAGAIN)))):
+            # Unix socket - no listener yet or full backlog
             self.handle_conn_refused(sock)
         elif err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
             raise socket.error(err, errno.errorcode[err])
@@ -515,46 +980,279 @@ class Link(object):
     ##########################################################
 
     def ssl_handshake(self, sock):
-        failed = False
-        err = None
-
-        if sock.sock._sslobj is None:
+        if self.ssl_pool is not None:
+            return self.ssl_handshake_offloaded(sock)
+        try:
+            done = sock.do_handshake()
+        except (ssl.SSLError, socket.error) as exc:
+            self.log.error("SSL handshake %s: %r" % (sock.conn_id, exc))
+            self.handle_close(sock)
             self._in_ssl_handshake.remove(sock)
             return SSL_HANDSHAKE_FAILED
 
+        if sock.write_buf is None:
+            self.set_poll_mask(sock, select.EPOLLIN)
+        else:
+            self.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
+        if not done:
+            return SSL_HANDSHAKE_IN_PROGRESS
+
+        self._in_ssl_handshake.remove(sock)
+        self.log.debug("SSL handshake done %s, cipher=%r, resumed=%r" %
+                        (sock.conn_id, sock.ssl_obj.cipher(),
+                          sock.ssl_obj.session_reused))
+        if sock.has_ssl_pending():
+            # data which came with the end of the handshake
+            self._socks_to_recv.add(sock)
+        return SSL_HANDSHAKE_DONE
+
+    ##########################################################
+
+    def ssl_handshake_offloaded(self, sock):
+        """
+        The loop just moves the data, the result comes from the workers.
+        """
+        # a task with no data starts the handshake
+        start = (sock.ssl_tasks == 0) and (sock.write_buf is None)
+        try:
+            data = sock.recv_handshake()
+            sock.flush_write_buf()
+        except socket.error as exc:
+            if sock.ssl_tasks:
+                # the handshake might be done already, wait for the workers
+                self.submit_ssl_eof(sock)
+                return SSL_HANDSHAKE_IN_PROGRESS
+            self.log.error("SSL handshake %s: %r" % (sock.conn_id, exc))
+            self.close_ssl_sock(sock)
+            return SSL_HANDSHAKE_FAILED
+
+        if sock.write_buf is None:
+            self.set_poll_mask(sock, select.EPOLLIN)
+        else:
+            self.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
+        if (data is not None) or start:
+            self.submit_ssl(sock, ssl_handshake_task, data,
+                            self.handle_ssl_handshake_result)
+        return SSL_HANDSHAKE_IN_PROGRESS
+
+    ##########################################################
+
+    def submit_ssl(self, sock, func, data, handler):
+        """
+        Tasks of a socket are executed one by one, ``handler(sock, result)``
+        is called by the loop.
+        """
+        sock.ssl_tasks += 1
+        self.ssl_pool.submit(self.run_ssl_task,
+                              (sock, sock.ssl_obj, sock.ssl_incoming,
+                                sock.ssl_outgoing, func, data, handler),
+                              key=sock)
+
+    ##########################################################
+
+    def run_ssl_task(self, sock, ssl_obj, incoming, outgoing, func, data,
+                      handler):
+        """
+        Executed by a worker thread.
+        """
         try:
-            if sock.sock._sslobj is None:
-                # this might be caused by SSL-wrapping a socket with not
-                # fully created connection (like if you nmap a port)
-                failed = True
-                err = "no _sslobj"
-            else:
-                sock.sock.do_handshake()
-        except ssl.SSLError as exc:
-            err = exc
-            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
-                self.poller.modify(sock, select.EPOLLIN)
-            elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
-                self.poller.modify(sock, select.EPOLLOUT)
+            result = func(ssl_obj, incoming, outgoing, data)
+            error = None
+        except (ssl.SSLError, ValueError) as exc:
+            result = None
+            error = exc
+        with self._ssl_results_lock:
+            self._ssl_results.append((sock, ssl_obj, handler, result, error))
+        self.wakeup_poll()
+
+    ##########################################################
+
+    def handle_ssl_results(self):
+        with self._ssl_results_lock:
+            results = self._ssl_results
+            self._ssl_results = []
+        for sock, ssl_obj, handler, result, error in results:
+            if (sock.ssl_obj is not ssl_obj) or (sock.conn_id is None):
+                continue  # closed (or even reconnected) meanwhile
+            sock.ssl_tasks -= 1
+            if error is None:
+                handler(sock, result)
             else:
-                failed = True
+                self.log.error("SSL %s: %r" % (sock.conn_id, error))
+                self.close_ssl_sock(sock)
+
+    ##########################################################
+
+    def close_ssl_sock(self, sock):
+        """
+        Close a socket which might be in the SSL handshake.
+        """
+        self.handle_close(sock)
+        # no disconnect event during the handshake, see handle_close()
+        self._in_ssl_handshake.discard(sock)
+
+    ##########################################################
+
+    def send_encrypted(self, sock, data):
+        """
+        :return: False if the connection has been closed
+        """
+        sock.queue_encrypted(data)
+        try:
+            sock.flush_write_buf()
         except socket.error as exc:
-            err = exc
-            failed = True
+            self.log.error("send %s error %r" % (sock.conn_id, exc))
+            self.close_ssl_sock(sock)
+            return False
+        return True
+
+    ##########################################################
+
+    def handle_ssl_handshake_result(self, sock, result):
+        done, data, pending, info = result
+        if not self.send_encrypted(sock, data):
+            return
+        if sock not in self._in_ssl_handshake:
+            # data which came with the end of the handshake
+            if pending:
+                self.recv_ssl_pending(sock)
+            return
+
+        if sock.write_buf is None:
+            self.set_poll_mask(sock, select.EPOLLIN)
         else:
-            self._in_ssl_handshake.remove(sock)
-            self.poller.modify(sock, select.EPOLLIN)
-            self.log.debug("SSL handshake done %s, cipher=%r" %
-                            (sock.conn_id, sock.sock.cipher()))
-            return SSL_HANDSHAKE_DONE
+            self.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
+        if not done:
+            return
+        sock.ssl_info = info
+        # without offloaded records the loop takes over the SSL object,
+        # no task may use it
+        if sock.ssl_tasks and not self.ssl_offload_records:
+            return
+        self.finish_ssl_handshake(sock)
+        if pending and (sock.conn_id is not None):
+            self.recv_ssl_pending(sock)
+
+    ##########################################################
+
+    def finish_ssl_handshake(self, sock):
+        self._in_ssl_handshake.remove(sock)
+        self.log.debug("SSL handshake done %s, cipher=%r, resumed=%r" %
+                        ((sock.conn_id,) + sock.ssl_info[:2]))
+        self.on_connect(sock.conn_id)
+
+    ##########################################################
+
+    def recv_ssl_pending(self, sock):
+        if self.ssl_offload_records:
+            self.submit_ssl(sock, ssl_decrypt_task, None,
+                            self.handle_ssl_decrypted)
+        else:
+            self._socks_to_recv.add(sock)
+
+    ##########################################################
+
+    def send_ssl_offloaded(self, sock, data):
+        if not sock.send_finished:
+            raise SendNotFinished(("previous send on %r is not finished, " +
+                              "wait for on_ready_to_send") % sock)
+        # the caller's buffer might change before the worker gets to it
+        data = b"".join(data) if isinstance(data, list) else bytes(data)
+        sock.send_finished = False
+        sock.last_send_size = len(data)
+        sock.ssl_encrypting = True
+        self.submit_ssl(sock, ssl_encrypt_task, data,
+                        self.handle_ssl_encrypted)
+
+    ##########################################################
 
-        if failed:
-            self.log.error("SSL handshake %s: %r" % (sock.conn_id, err))
+    def handle_ssl_encrypted(self, sock, data):
+        sock.ssl_encrypting = False
+        if self.send_encrypted(sock, data):
+            self.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
+
+    ##########################################################
+
+    def handle_recv_ssl_offloaded(self, sock):
+        received = 0
+        while received < self.recv_budget:
+            try:
+                data = sock.recv(self.recv_block_size)
+            except socket.error as exc:
+                err = exc.args[0]
+                if err in (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+                            errno.ECONNABORTED, errno.EPIPE, errno.EBADF):
+                    self.log.error("recv %s error %s" %
+                                      (sock.conn_id, errno.errorcode[err]))
+                    self.handle_close(sock)
+                elif err != errno.EWOULDBLOCK:
+                    raise
+                return
+            if not data:
+                self.submit_ssl_eof(sock)
+                return
+            self.submit_ssl(sock, ssl_decrypt_task, data,
+                            self.handle_ssl_decrypted)
+            if len(data) < self.recv_block_size:
+                return  # drained
+            received += len(data)
+
+    ##########################################################
+
+    def handle_ssl_decrypted(self, sock, result):
+        data, encrypted, closed = result
+        if not self.send_encrypted(sock, encrypted):
+            return
+        if data:
+            self.log.debug("recv %s len=%i" % (sock.conn_id, len(data)))
+            if self.recv_memoryview:
+                self.on_recv(sock.conn_id, memoryview(data))
+            else:
+                self.on_recv(sock.conn_id, data)
+            if sock.conn_id is None:  # closed by on_recv
+                return
+        if closed:
             self.handle_close(sock)
-            self._in_ssl_handshake.remove(sock)
-            return SSL_HANDSHAKE_FAILED
+        elif (sock.write_buf is not None) and not sock.ssl_encrypting:
+            self.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
 
-        return SSL_HANDSHAKE_IN_PROGRESS
+    ##########################################################
+
+    def submit_ssl_eof(self, sock):
+        """
+        Close the connection after the data in the workers is delivered.
+        """
+        self.set_poll_mask(sock, 0)
+        if not sock.ssl_eof:
+            sock.ssl_eof = True
+            self.submit_ssl(sock, ssl_eof_task, None, self.handle_ssl_eof)
+
+    ##########################################################
+
+    def handle_ssl_eof(self, sock, result):
+        if sock.ssl_tasks:
+            # tasks submitted meanwhile go first
+            self.submit_ssl(sock, ssl_eof_task, None, self.handle_ssl_eof)
+            return
+        if sock in self._in_ssl_handshake:
+            if sock.ssl_info is None:
+                self.log.error("SSL handshake %s: connection closed" %
+                                sock.conn_id)
+                self.close_ssl_sock(sock)
+                return
+            self.finish_ssl_handshake(sock)
+            if sock.conn_id is None:  # closed by on_connect
+                return
+        if self.ssl_offload_records:
+            self.handle_close(sock)
+        else:
+            # the loop reads the rest and the EOF, the poll reports the EOF
+            # again if the rest does not fit into a single recv
+            if sock.write_buf is None:
+                self.set_poll_mask(sock, select.EPOLLIN)
+            else:
+                self.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
+            self.handle_recv(sock)
 
     ##########################################################
 
@@ -565,13 +1263,14 @@ class Link(object):
 
         handshake_res = SSL_HANDSHAKE_IN_PROGRESS
         if sock.ssl_config:
-            sock.create_ssl_context()
+            sock.start_ssl(server_side=False)
             self._in_ssl_handshake.add(sock)
             handshake_res = self.ssl_handshake(sock)
             if handshake_res == SSL_HANDSHAKE_FAILED:
                 return
 
-        self.poller.modify(sock, select.EPOLLIN)
+        self.use_edge_trigger(sock)
+        self.set_poll_mask(sock, select.EPOLLIN)
 
         if (sock.ssl_config is None) or (handshake_res == SSL_HANDSHAKE_DONE):
             self.on_connect(conn_id)
@@ -584,12 +1283,22 @@ class Link(object):
         except socket.error as exc:
             self.log.error("accept %r: %r" % (sock, exc))
             return
+        self.add_accepted(newsock, address)
+
+    ##########################################################
 
+    def add_accepted(self, newsock, address):
+        """
+        Take over an already accepted connection.
+
+        :param newsock: LinkSocket
+        """
         conn_id = self.new_connection_id(newsock)
         self.log.info("accept %s %r" % (conn_id, address))
 
         self._sock_by_fd[newsock.fileno()] = newsock
-        self.poller.register(newsock, select.EPOLLIN)
+        self.use_edge_trigger(newsock)
+        self.register_sock(newsock, select.EPOLLIN)
 
         handshake_res = SSL_HANDSHAKE_IN_PROGRESS
         if newsock.ssl_config:
@@ -603,41 +1312,77 @@ class Link(object):
 
     ##########################################################
 
+    def get_recv_view(self):
+        if ((self._recv_buf is None) or
+            (len(self._recv_buf) != self.recv_block_size)):
+            self._recv_buf = bytearray(self.recv_block_size)
+            self._recv_view = memoryview(self._recv_buf)
+        return self._recv_view
+
+    ##########################################################
+
     def handle_recv(self, sock):
         conn_id = sock.conn_id
         if conn_id is None:
             # socket could be closed in one poll round before recv
             return
+        if self.ssl_offload_records and (sock.ssl_obj is not None):
+            self.handle_recv_ssl_offloaded(sock)
+            return
 
-        # do not put it in a draining cycle to avoid other links starvation
-        try:
-            fragment = sock.recv(self.recv_block_size)
-        except ssl.SSLError as exc:
-            if exc.args[0] != ssl.SSL_ERROR_WANT_READ:
-                raise
-            # wait for next round, SSL context has not enough data do decrypt
-        except socket.error as exc:
-            # TODO catch SSL exceptions
-            err = exc.args[0]
-            if err in (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
-                        errno.ECONNABORTED, errno.EPIPE, errno.EBADF):
-                self.log.error("recv %s error %s" %
-                                  (conn_id, errno.errorcode[err]))
+        view = self.get_recv_view()
+        received = 0
+        # drain the socket while it is full of data but not more than the
+        # budget to avoid other links starvation
+        while True:
+            try:
+                size = sock.recv_into(view)
+            except ssl.SSLError as exc:
+                if exc.args[0] != ssl.SSL_ERROR_WANT_READ:
+                    self.log.error("recv %s SSL error %r" % (conn_id, exc))
+                    self.handle_close(sock)
+                # else wait for next round, SSL context has not enough data
+                # to decrypt
+                return
+            except socket.error as exc:
+                err = exc.args[0]
+                if err in (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+                            errno.ECONNABORTED, errno.EPIPE, errno.EBADF):
+                    self.log.error("recv %s error %s" %
+                                      (conn_id, errno.errorcode[err]))
+                    self.handle_close(sock)
+                elif err != errno.EWOULDBLOCK:
+                    raise
+                return
+
+            if not size:
                 self.handle_close(sock)
-            elif err != errno.EWOULDBLOCK:
-                raise
-        else:
-            if fragment:
-                self.log.debug("recv %s len=%i" % (conn_id, len(fragment)))
-                self.on_recv(conn_id, fragment)
+                return
+            self.log.debug("recv %s len=%i" % (conn_id, size))
+            if self.recv_memoryview:
+                self.on_recv(conn_id, view[:size])
             else:
-                self.handle_close(sock)
+                self.on_recv(conn_id, view[:size].tobytes())
+
+            if sock.conn_id is None:  # closed by on_recv
+                return
+            # edge-triggered socket is read until EWOULDBLOCK, the edge of
+            # an EOF following the data would be lost
+            if (size < len(view)) and not sock.edge_triggered:
+                return  # drained
+            received += size
+            if received >= self.recv_budget:
+                if sock.edge_triggered or sock.has_ssl_pending():
+                    # there will be no new edge (or no poll event for data
+                    # already read by SSL) for the remaining data
+                    self._socks_to_recv.add(sock)
+                return
 
     ##########################################################
 
     def handle_conn_refused(self, sock):
         self._socks_waiting_to_connect.remove(sock)
-        self.poller.unregister(sock)
+        self.unregister_sock(sock)
         del self._sock_by_fd[sock.fileno()]
         sock.close()
 
@@ -650,9 +1395,14 @@ class Link(object):
     def handle_close(self, sock):
         fileno = sock.fileno()
         if fileno in self._sock_by_fd:
-            self.poller.unregister(sock)
+            self.unregister_sock(sock)
             del self._sock_by_fd[fileno]
-        sock.close()
+        # data (e.g. TLS 1.3 session tickets) coming to a closed socket
+        # would reset the connection and the peer would lose the data it
+        # has not read yet
+        raw_sock = sock.close(linger=(sock.ssl_obj is not None))
+        if raw_sock is not None:
+            self.linger(raw_sock)
 
         if sock.conn_id is not None:
             self.log.info("disconnect %s " % sock.conn_id)
@@ -668,13 +1418,67 @@ class Link(object):
 
     ##########################################################
 
+    def linger(self, raw_sock):
+        """
+        Keep a socket shut down for sending until the peer closes it too.
+        """
+        self._lingering[raw_sock.fileno()] = \
+                (raw_sock, time.time() + SSL_LINGER)
+        self.poller.register(raw_sock, select.EPOLLIN)
+
+    ##########################################################
+
+    def handle_lingering(self, fd):
+        raw_sock = self._lingering[fd][0]
+        received = 0
+        try:
+            while received < self.recv_budget:
+                data = raw_sock.recv(self.recv_block_size)
+                if not data:
+                    break
+                received += len(data)  # discarded
+            else:
+                return
+        except socket.error as exc:
+            if exc.args[0] == errno.EWOULDBLOCK:
+                return
+        self.close_lingering(fd)
+
+    ##########################################################
+
+    def close_lingering(self, fd):
+        raw_sock = self._lingering.pop(fd)[0]
+        self.poller.unregister(raw_sock)
+        raw_sock.close()
+
+    ##########################################################
+
+    def deal_lingering(self):
+        now = time.time()
+        for fd, (raw_sock, deadline) in list(self._lingering.items()):
+            if deadline <= now:
+                self.close_lingering(fd)
+
+    ##########################################################
+
     def handle_ready_to_send(self, sock):
+        if sock.ssl_encrypting:
+            # wait for the workers
+            self.set_poll_mask(sock, select.EPOLLIN)
+            return
         if sock.write_buf is None:
+            if sock.send_finished:
+                # just the rest of the SSL handshake has been sent
+                if sock.poll_mask is not None:
+                    self.set_poll_mask(sock, select.EPOLLIN)
+                return
             sock.send_finished = True
-            self.poller.modify(sock, select.EPOLLIN)
             self.log.debug("ready to send %s (last send len=%i)" %
                             (sock.conn_id, sock.last_send_size))
             self.on_ready_to_send(sock.conn_id, sock.last_send_size)
+            # the callback usually sends more data, keep EPOLLOUT then
+            if sock.send_finished and (sock.poll_mask is not None):
+                self.set_poll_mask(sock, select.EPOLLIN)
         else:
             self.log.debug("ready to send %s, repeat" % sock.conn_id)
             sock.send(None)  # repeat last buffer
@@ -693,7 +1497,7 @@ class Link(object):
         if mask & select.EPOLLOUT:
             if sock in self._socks_waiting_to_connect:
                 self.handle_connect(sock)
-            else:
+            elif not (sock.edge_triggered and sock.send_finished):
                 self.handle_ready_to_send(sock)
         if mask & select.EPOLLIN:
             if fd in self._listen_socks_filenos:
@@ -707,6 +1511,8 @@ class Link(object):
         if fd == self._poll_bell.r:
             assert mask & select.EPOLLIN
             self._poll_bell.read(BELL_READ)  # flush the pipe
+        elif fd in self._lingering:
+            self.handle_lingering(fd)
         else:
             # socket might have been already discarded by the Link
             # so this pass might be skipped
@@ -714,7 +1520,11 @@ class Link(object):
                 return
             sock = self._sock_by_fd[fd]
 
-            if mask & (select.EPOLLERR | select.EPOLLHUP):
+            # closed Unix socket reports EPOLLHUP together with EPOLLIN,
+            # the rest of the data must be read first (until recv() returns
+            # nothing)
+            if ((mask & select.EPOLLERR) or
+                ((mask & select.EPOLLHUP) and not (mask & select.EPOLLIN))):
                 self.handle_sock_err(sock)
             else:
                 if sock in self._in_ssl_handshake:
@@ -731,6 +1541,8 @@ class Link(object):
         :return: values returned by poll
         """
         fds = []
+        if self._socks_ready_to_send or self._socks_to_recv:
+            poll_timeout = 0  # do not wait, there is a work to do
         try:
             fds[:] = self.poller.poll(poll_timeout)
         except IOError as exc:
@@ -739,10 +1551,32 @@ class Link(object):
 
         for fd, mask in fds:
             self.handle_fd_mask(fd, mask)
+        if self._ssl_results:
+            self.handle_ssl_results()
+        self.handle_edge_triggered()
         return fds
 
     ##########################################################
 
+    def handle_edge_triggered(self):
+        """
+        Continue with edge-triggered sockets which have not reached
+        ``EWOULDBLOCK``. A single round to keep the fairness.
+        """
+        if self._socks_ready_to_send:
+            socks = self._socks_ready_to_send
+            self._socks_ready_to_send = []
+            for sock in socks:
+                if (sock.conn_id is not None) and not sock.send_finished:
+                    self.handle_ready_to_send(sock)
+        if self._socks_to_recv:
+            socks = self._socks_to_recv
+            self._socks_to_recv = set()
+            for sock in socks:
+                self.handle_recv(sock)
+
+    ##########################################################
+
     def deal_connects(self):
         now = time.time()
         to_remove = 0
@@ -7,32 +7,81 @@ Message container.
           U{http://www.opensource.org/licenses/mit-license.php})
 """
 
-import uuid as uuid_module
+import os
+import struct
+import itertools
 
 ###########################################################################
 ###########################################################################
 
 FLAG_PERSISTENT = 0x1  #: store to a persistent storage
+#: used by the messaging layer (0x40000000 zlib and 0x80000000 LZMA
+#: compressed frame), not allowed in messages
+FLAGS_RESERVED = 0xC0000000
 
 MAX_UUID_LENGTH = 16
 
+UUID_PREFIX_LENGTH = 8
+UUID_COUNTER_FORMAT = struct.Struct("!Q")
+
+###########################################################################
+###########################################################################
+
+def _reset_uuid_generator():
+    global _uuid_prefix, _uuid_counter
+    _uuid_prefix = os.urandom(UUID_PREFIX_LENGTH)
+    _uuid_counter = itertools.count()
+
+_reset_uuid_generator()
+if hasattr(os, "register_at_fork"):
+    # a forked process must not generate the same identifiers
+    os.register_at_fork(after_in_child=_reset_uuid_generator)
+
+def generate_uuid():
+    """
+    Thread safe.
+
+    :return: (bytes) unique message identifier, random prefix of the process
+             and a counter
+    """
+    return _uuid_prefix + UUID_COUNTER_FORMAT.pack(next(_uuid_counter))
+
 ###########################################################################
 ###########################################################################
 
 class Message(object):
+    __slots__ = ("data", "ttl", "flags", "_uuid")
+
     def __init__(self, data, ttl=0, flags=0, uuid=None):
         """
         :param data: (bytes) payload
         :param ttl: messaging TTL in seconds (integer or float), None is infinity
-        :param flags: combination of FLAG_*
-        :param uuid: (bytes) unique message identifier (implicitly generated)
+        :param flags: combination of FLAG_*, :data:`FLAGS_RESERVED` bits
+                      raise ValueError
+        :param uuid: (bytes) unique message identifier (implicitly generated
+                     on the first use, usually when the message is queued)
         """
         assert type(data) == bytes
         assert uuid is None or (type(uuid) == bytes), uuid
+        if flags & FLAGS_RESERVED:
+            raise ValueError("reserved message flags %X" %
+                             (flags & FLAGS_RESERVED))
         self.data = data
         self.ttl = None if ttl is None else float(ttl)
         self.flags = flags
-        self.uuid = (uuid or bytes(uuid_module.uuid4().bytes))[:MAX_UUID_LENGTH]
+        self._uuid = (uuid or None) and uuid[:MAX_UUID_LENGTH]
+
+    ############################################################
+
+    @property
+    def uuid(self):
+        if self._uuid is None:
+            self._uuid = generate_uuid()
+        return self._uuid
+
+    @uuid.setter
+    def uuid(self, value):
+        self._uuid = value[:MAX_UUID_LENGTH]
 
     ############################################################
 
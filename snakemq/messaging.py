@@ -10,6 +10,26 @@ Payload
 - incompatible protocol: ``[]``
 - identification: ``[ident]``
 - message: ``[16B UUID|4B TTL|4B flags|message]``
+- capabilities: ``[4B capability flags]``
+- message batch: ``[message entries]``, each entry is
+  ``[1B presence|UUID|(4B TTL)|(4B flags)|varint length|message]``
+
+  - UUID is 16 bytes or just the last 8 bytes if the presence has
+    ``BATCH_ENTRY_UUID_SUFFIX`` (the rest is taken from the previous entry)
+  - TTL and flags are present only if the presence has ``BATCH_ENTRY_TTL``
+    or ``BATCH_ENTRY_FLAGS``, otherwise they are the same as in the previous
+    entry (0 for the first entry)
+  - varint is an unsigned LEB128 (7 bits per byte, low bits first)
+
+Compression
+-----------
+Each peer sends its capabilities right after the protocol version. A message
+is compressed only if the receiving peer announced the codec. The codec is
+marked by a flag in the message frame (the reserved bits
+:data:`snakemq.message.FLAGS_RESERVED`). Zlib messages of a connection are
+parts of a single stream (each is sync-flushed), LZMA messages are
+compressed one by one. A message which decompresses to more than
+``decompress_limit`` bytes breaks the connection.
 
 :author: David Siroky (siroky@dasir.cz)
 :license: MIT License (see LICENSE.txt or
@@ -21,12 +41,21 @@ import logging
 import threading
 import re
 import time
+import itertools
+import zlib
+
+try:
+    import lzma
+    DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError)
+except ImportError:
+    lzma = None
+    DECOMPRESS_ERRORS = (zlib.error,)
 
 from snakemq.exceptions import (SnakeMQBrokenMessage, SnakeMQException,
                                 SnakeMQIncompatibleProtocol, SnakeMQNoIdent,
                                 NoConnection)
 from snakemq.queues import QueuesManager
-from snakemq.message import Message
+from snakemq.message import Message, FLAGS_RESERVED
 from snakemq.callbacks import Callback
 import snakemq.version
 
@@ -58,6 +87,8 @@ FRAME_TYPE_IDENTIFICATION = 2
 FRAME_TYPE_MESSAGE = 3
 FRAME_TYPE_PING = 4
 FRAME_TYPE_P0NG = 5
+FRAME_TYPE_CAPABILITIES = 6
+FRAME_TYPE_MESSAGE_BATCH = 7
 
 FRAME_TYPE_TYPE = "B"
 FRAME_TYPE_SIZE = 1  # 1 byte
@@ -66,13 +97,95 @@ FRAME_FORMAT_PROTOCOL_VERSION = "!I"
 FRAME_FORMAT_PROTOCOL_VERSION_SIZE = struct.calcsize(FRAME_FORMAT_PROTOCOL_VERSION)
 FRAME_FORMAT_MESSAGE = "!16sII"
 FRAME_FORMAT_MESSAGE_SIZE = struct.calcsize(FRAME_FORMAT_MESSAGE)
+FRAME_FORMAT_CAPABILITIES = "!I"
+FRAME_FORMAT_CAPABILITIES_SIZE = struct.calcsize(FRAME_FORMAT_CAPABILITIES)
+FRAME_FORMAT_BATCH_PRESENCE = struct.Struct("!B")
+FRAME_FORMAT_BATCH_FIELD = struct.Struct("!I")  # TTL or flags
+
+#: batch entry presence flags
+BATCH_ENTRY_TTL = 0x1
+BATCH_ENTRY_FLAGS = 0x2
+BATCH_ENTRY_UUID_SUFFIX = 0x4
+BATCH_UUID_SIZE = 16
+BATCH_UUID_PREFIX_SIZE = 8
+MAX_VARINT_SIZE = 5  # 32 bits
 
 MIN_FRAME_SIZE = 1  # just the type field
 
 INFINITE_TTL = 0xffffffff
 
+#: message frame flags of compressed payloads (never passed to the
+#: application), also used as capabilities
+FRAME_FLAG_ZLIB = 0x40000000
+FRAME_FLAG_LZMA = 0x80000000
+FRAME_FLAGS_COMPRESSION = FRAME_FLAG_ZLIB | FRAME_FLAG_LZMA
+assert FRAME_FLAGS_COMPRESSION == FLAGS_RESERVED
+
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_LZMA = "lzma"
+COMPRESSION_FLAGS = {COMPRESSION_ZLIB: FRAME_FLAG_ZLIB,
+                     COMPRESSION_LZMA: FRAME_FLAG_LZMA}
+#: peer understands message batch frames
+CAPABILITY_BATCH = 0x1
+
+#: batching and codecs this peer can decompress
+if lzma is None:
+    CAPABILITIES = CAPABILITY_BATCH | FRAME_FLAG_ZLIB
+else:
+    CAPABILITIES = CAPABILITY_BATCH | FRAME_FLAG_ZLIB | FRAME_FLAG_LZMA
+
+#: default min. size of message data to compress (bytes)
+COMPRESSION_THRESHOLD = 512
+#: default max. size of decompressed message data (bytes)
+DECOMPRESS_LIMIT = 64 * 1024 * 1024
+
+#: default max. count of messages passed to the packeter and not yet sent
+SEND_WINDOW_MESSAGES = 64
+#: default max. size (bytes) of frames passed to the packeter and not yet sent
+SEND_WINDOW_SIZE = 512 * 1024
+#: default max. count of messages packed into a single batch frame
+BATCH_MAX_MESSAGES = 256
+#: default max. size (bytes) of message data packed into a single batch frame
+BATCH_MAX_SIZE = 16 * 1024
+
 ENCODING = "utf-8"
 
+############################################################################
+############################################################################
+
+def pack_varint(value):
+    """
+    :return: bytes, unsigned LEB128
+    """
+    parts = bytearray()
+    while value >= 0x80:
+        parts.append((value & 0x7f) | 0x80)
+        value >>= 7
+    parts.append(value)
+    return bytes(parts)
+
+def unpack_varint(buf, offset):
+    """
+    :return: (value, offset after the varint)
+    """
+    value = 0
+    shift = 0
+    for i in range(MAX_VARINT_SIZE):
+        if offset >= len(buf):
+            break
+        byte = FRAME_FORMAT_BATCH_PRESENCE.unpack_from(buf, offset)[0]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+    raise SnakeMQBrokenMessage("varint")
+
+#: ReceiveHook regexps without these characters are literal prefixes
+REGEXP_SPECIAL_CHARS = frozenset(".^$*+?{}[]\\|()")
+MAX_ROUTES_CACHE = 1024
+REGEXP_TYPE = type(re.compile(""))
+
 #############################################################################
 #############################################################################
 
@@ -94,6 +207,30 @@ class Messaging(object):
         self.keepalive_interval = None
         self.keepalive_wait = 0.5  #: wait for pong, in seconds
 
+        #: max. count of message frames handed to the packeter but not yet
+        #: sent (per peer), a batch frame counts as one
+        self.send_window_messages = SEND_WINDOW_MESSAGES
+        #: max. size of message frames handed to the packeter but not yet sent
+        #: (per peer, in bytes), a single message is always passed regardless
+        #: of its size
+        self.send_window_size = SEND_WINDOW_SIZE
+
+        #: compression of outgoing messages, ``COMPRESSION_ZLIB``,
+        #: ``COMPRESSION_LZMA`` or None, used only if the peer supports it
+        self.compression = None
+        #: messages with smaller data are not compressed (bytes)
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.compression_level = 6  #: zlib level or lzma preset
+        #: larger decompressed messages are rejected (bytes)
+        self.decompress_limit = DECOMPRESS_LIMIT
+
+        #: max. count of queued messages packed into a single frame if the
+        #: peer supports it (1 = no batching)
+        self.batch_max_messages = BATCH_MAX_MESSAGES
+        #: max. size of message data in a single batch frame (bytes), larger
+        #: messages are sent alone
+        self.batch_max_size = BATCH_MAX_SIZE
+
         #{ callbacks
         self.on_error = Callback()  #: ``func(conn_id, exception)``
         self.on_message_recv = Callback()  #: ``func(conn_id, ident, message)``
@@ -109,7 +246,12 @@ class Messaging(object):
         self._ident_by_conn = {}
         self._conn_by_ident = {}
         self._keepalive = {}  #: conn_id:[last_recv, last_ping]
-        self._message_by_packet = {}  #: packet id: message uuid
+        #: packet id:(message uuids, frame size)
+        self._message_by_packet = {}
+        self._in_flight = {}  #: conn_id:[frames count, frames size]
+        self._capabilities = {}  #: conn_id:compression flags of the peer
+        self._compressors = {}  #: conn_id:zlib compress object
+        self._decompressors = {}  #: conn_id:zlib decompress object
 
         packeter.link.on_loop_pass.add(self._on_link_loop_pass)
         packeter.on_connect.add(self._on_connect)
@@ -131,6 +273,7 @@ class Messaging(object):
         self._touch_keepalive(conn_id)
         try:
             self.send_protocol_version(conn_id)
+            self.send_capabilities(conn_id)
             self.send_identification(conn_id)
         except NoConnection:
             # just leave it
@@ -140,10 +283,14 @@ class Messaging(object):
 
     def _on_disconnect(self, conn_id):
         del self._keepalive[conn_id]
+        self._capabilities.pop(conn_id, None)
+        self._compressors.pop(conn_id, None)
+        self._decompressors.pop(conn_id, None)
         if conn_id not in self._ident_by_conn:
             return
 
         ident = self._ident_by_conn.pop(conn_id)
+        del self._in_flight[conn_id]
         with self._lock:
             self.queues_manager.get_queue(ident).disconnect()
         del self._conn_by_ident[ident]
@@ -171,6 +318,19 @@ class Messaging(object):
 
     ###########################################################
 
+    def parse_capabilities(self, payload, conn_id):
+        if len(payload) < FRAME_FORMAT_CAPABILITIES_SIZE:
+            raise SnakeMQBrokenMessage("capabilities")
+
+        # longer payload is reserved for future capabilities
+        capabilities = struct.unpack(FRAME_FORMAT_CAPABILITIES,
+                          memstr(payload[:FRAME_FORMAT_CAPABILITIES_SIZE]))[0]
+        self.log.debug("conn=%s remote capabilities %X" %
+                        (conn_id, capabilities))
+        self._capabilities[conn_id] = capabilities
+
+    ###########################################################
+
     def parse_identification(self, payload, conn_id):
         remote_ident = memstr(payload).decode(ENCODING, "replace")
         self.log.debug("conn=%s remote ident '%s'" % (conn_id, remote_ident))
@@ -189,6 +349,7 @@ class Messaging(object):
             self.queues_manager.get_queue(remote_ident).connect()
         self._ident_by_conn[conn_id] = remote_ident
         self._conn_by_ident[remote_ident] = conn_id
+        self._in_flight[conn_id] = [0, 0]
         self.on_connect(conn_id, remote_ident)
 
     ###########################################################
@@ -206,12 +367,72 @@ class Messaging(object):
                                         memstr(payload[:FRAME_FORMAT_MESSAGE_SIZE]))
         if ttl == INFINITE_TTL:
             ttl = None
-        message = Message(data=memstr(payload[FRAME_FORMAT_MESSAGE_SIZE:]),
-                          uuid=muuid, ttl=ttl, flags=flags)
+        data = payload[FRAME_FORMAT_MESSAGE_SIZE:]
+        if flags & FRAME_FLAGS_COMPRESSION:
+            data = self.decompress(conn_id, flags, data)
+            flags &= ~FRAME_FLAGS_COMPRESSION
+        message = Message(data=memstr(data), uuid=muuid, ttl=ttl, flags=flags)
         self.on_message_recv(conn_id, ident, message)
 
     ###########################################################
 
+    def parse_message_batch(self, payload, conn_id):
+        try:
+            ident = self._ident_by_conn[conn_id]
+        except KeyError:
+            raise SnakeMQNoIdent(conn_id)
+
+        # unpack everything first, a broken batch is dropped as a whole
+        messages = []
+        offset = 0
+        size = len(payload)
+        muuid = None
+        ttl = 0
+        flags = 0
+        try:
+            while offset < size:
+                presence = FRAME_FORMAT_BATCH_PRESENCE.unpack_from(payload,
+                                                                   offset)[0]
+                offset += 1
+                if presence & BATCH_ENTRY_UUID_SUFFIX:
+                    if muuid is None:
+                        raise SnakeMQBrokenMessage("message batch")
+                    end = offset + BATCH_UUID_SIZE - BATCH_UUID_PREFIX_SIZE
+                    muuid = muuid[:BATCH_UUID_PREFIX_SIZE] + \
+                                                  memstr(payload[offset:end])
+                else:
+                    end = offset + BATCH_UUID_SIZE
+                    muuid = memstr(payload[offset:end])
+                offset = end
+                if presence & BATCH_ENTRY_TTL:
+                    ttl = FRAME_FORMAT_BATCH_FIELD.unpack_from(payload,
+                                                               offset)[0]
+                    offset += FRAME_FORMAT_BATCH_FIELD.size
+                if presence & BATCH_ENTRY_FLAGS:
+                    flags = FRAME_FORMAT_BATCH_FIELD.unpack_from(payload,
+                                                                 offset)[0]
+                    offset += FRAME_FORMAT_BATCH_FIELD.size
+                length, offset = unpack_varint(payload, offset)
+                end = offset + length
+                if end > size:
+                    raise SnakeMQBrokenMessage("message batch")
+                data = payload[offset:end]
+                offset = end
+                entry_flags = flags
+                if entry_flags & FRAME_FLAGS_COMPRESSION:
+                    data = self.decompress(conn_id, entry_flags, data)
+                    entry_flags &= ~FRAME_FLAGS_COMPRESSION
+                messages.append(Message(data=memstr(data), uuid=muuid,
+                                        ttl=None if ttl == INFINITE_TTL else ttl,
+                                        flags=entry_flags))
+        except struct.error:
+            raise SnakeMQBrokenMessage("message batch")
+
+        for message in messages:
+            self.on_message_recv(conn_id, ident, message)
+
+    ###########################################################
+
     def _on_packet_recv(self, conn_id, packet):
         self._touch_keepalive(conn_id)
         try:
@@ -230,8 +451,12 @@ class Messaging(object):
                 self.parse_identification(payload, conn_id)
             elif frame_type == FRAME_TYPE_MESSAGE:
                 self.parse_message(payload, conn_id)
+            elif frame_type == FRAME_TYPE_MESSAGE_BATCH:
+                self.parse_message_batch(payload, conn_id)
             elif frame_type == FRAME_TYPE_PING:
                 self.send_pong(conn_id)
+            elif frame_type == FRAME_TYPE_CAPABILITIES:
+                self.parse_capabilities(payload, conn_id)
         except SnakeMQException as exc:
             self.log.error("conn=%s ident=%s %r" %
                   (conn_id, self._ident_by_conn.get(conn_id), exc))
@@ -242,12 +467,18 @@ class Messaging(object):
 
     def _on_packet_sent(self, conn_id, packet_id):
         try:
-            msg_uuid = self._message_by_packet[packet_id]
-            del self._message_by_packet[packet_id]
+            msg_uuids, frame_size = self._message_by_packet.pop(packet_id)
         except KeyError:
             return
+        in_flight = self._in_flight[conn_id]
+        in_flight[0] -= 1
+        in_flight[1] -= frame_size
         ident = self._ident_by_conn[conn_id]
-        self.on_message_sent(conn_id, ident, msg_uuid)
+        for msg_uuid in msg_uuids:
+            self.on_message_sent(conn_id, ident, msg_uuid)
+        # refill the window, the callbacks might have closed the connection
+        if conn_id in self._in_flight:
+            self._send_queued(ident, conn_id)
 
     ###########################################################
 
@@ -277,6 +508,16 @@ class Messaging(object):
 
     ###########################################################
 
+    def frame_capabilities(self):
+        return (struct.pack(FRAME_TYPE_TYPE, FRAME_TYPE_CAPABILITIES) +
+                struct.pack(FRAME_FORMAT_CAPABILITIES, CAPABILITIES))
+
+    def send_capabilities(self, conn_id):
+        self.log.debug("conn=%s sending capabilities" % conn_id)
+        self.packeter.send_packet(conn_id, self.frame_capabilities())
+
+    ###########################################################
+
     def frame_identification(self):
         return (struct.pack(FRAME_TYPE_TYPE, FRAME_TYPE_IDENTIFICATION) +
                 self.identifier.encode(ENCODING))
@@ -287,19 +528,138 @@ class Messaging(object):
 
     ###########################################################
 
-    def frame_message(self, message):
+    def compress(self, conn_id, data):
+        """
+        :return: (compression flag, data), flag is 0 if the data is left as
+                 it is
+        """
+        if ((self.compression is None) or
+              (len(data) < self.compression_threshold)):
+            return 0, data
+        flag = COMPRESSION_FLAGS[self.compression]
+        if not (self._capabilities.get(conn_id, 0) & flag):
+            return 0, data
+        if flag == FRAME_FLAG_ZLIB:
+            compressor = self._compressors.get(conn_id)
+            if compressor is None:
+                compressor = zlib.compressobj(self.compression_level)
+                self._compressors[conn_id] = compressor
+            # the peer must be able to decompress the message right away
+            return flag, (compressor.compress(data) +
+                          compressor.flush(zlib.Z_SYNC_FLUSH))
+        else:
+            # lzma can't flush in the middle of a stream
+            return flag, lzma.compress(data, format=lzma.FORMAT_ALONE,
+                                        preset=self.compression_level)
+
+    def decompress(self, conn_id, flags, data):
+        """
+        :return: data, at most ``decompress_limit`` bytes
+        """
+        limit = self.decompress_limit
+        try:
+            if flags & FRAME_FLAGS_COMPRESSION == FRAME_FLAG_ZLIB:
+                decompressor = self._decompressors.get(conn_id)
+                if decompressor is None:
+                    decompressor = zlib.decompressobj()
+                    self._decompressors[conn_id] = decompressor
+                data = decompressor.decompress(memstr(data), limit)
+                if decompressor.unconsumed_tail:
+                    raise SnakeMQBrokenMessage("decompress limit")
+                return data
+            elif (flags & FRAME_FLAGS_COMPRESSION == FRAME_FLAG_LZMA and
+                    lzma is not None):
+                decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+                data = decompressor.decompress(memstr(data), limit)
+                if not decompressor.eof:
+                    # too large or truncated
+                    raise SnakeMQBrokenMessage("decompress limit")
+                return data
+        except DECOMPRESS_ERRORS:
+            raise SnakeMQBrokenMessage("compressed message")
+        raise SnakeMQBrokenMessage("unsupported compression")
+
+    ###########################################################
+
+    def frame_message(self, message, conn_id=None):
+        """
+        :param conn_id: the message data are compressed for this connection
+                        (if negotiated)
+        """
         if message.ttl is None:
             ttl = INFINITE_TTL
         else:
             ttl = int(message.ttl)
+        flag, data = self.compress(conn_id, message.data)
         return (struct.pack(FRAME_TYPE_TYPE, FRAME_TYPE_MESSAGE) +
                 struct.pack(FRAME_FORMAT_MESSAGE,
-                            message.uuid, ttl, message.flags) +
-                message.data)
+                            message.uuid, ttl, message.flags | flag) +
+                data)
 
     def send_message_frame(self, conn_id, message):
-        pid = self.packeter.send_packet(conn_id, self.frame_message(message))
-        self._message_by_packet[pid] = message.uuid
+        frame = self.frame_message(message, conn_id)
+        self._send_frame(conn_id, frame, [message.uuid])
+
+    ###########################################################
+
+    def frame_message_batch(self, messages, conn_id=None):
+        """
+        :param conn_id: the message data are compressed for this connection
+                        (if negotiated)
+        """
+        parts = [struct.pack(FRAME_TYPE_TYPE, FRAME_TYPE_MESSAGE_BATCH)]
+        prefix = None
+        prev_ttl = 0
+        prev_flags = 0
+        for message in messages:
+            if message.ttl is None:
+                ttl = INFINITE_TTL
+            else:
+                ttl = int(message.ttl)
+            flag, data = self.compress(conn_id, message.data)
+            flags = message.flags | flag
+            muuid = message.uuid
+            if len(muuid) != BATCH_UUID_SIZE:
+                muuid = muuid.ljust(BATCH_UUID_SIZE, b"\0")
+            header = bytearray(1)
+            if muuid[:BATCH_UUID_PREFIX_SIZE] == prefix:
+                # generated UUIDs share the prefix
+                header[0] = BATCH_ENTRY_UUID_SUFFIX
+                header += muuid[BATCH_UUID_PREFIX_SIZE:]
+            else:
+                prefix = muuid[:BATCH_UUID_PREFIX_SIZE]
+                header += muuid
+            if ttl != prev_ttl:
+                header[0] |= BATCH_ENTRY_TTL
+                header += FRAME_FORMAT_BATCH_FIELD.pack(ttl)
+                prev_ttl = ttl
+            if flags != prev_flags:
+                header[0] |= BATCH_ENTRY_FLAGS
+                header += FRAME_FORMAT_BATCH_FIELD.pack(flags)
+                prev_flags = flags
+            length = len(data)
+            if length < 0x80:
+                header.append(length)
+            else:
+                header += pack_varint(length)
+            parts.append(bytes(header))
+            parts.append(data)
+        return b"".join(parts)
+
+    def send_message_batch_frame(self, conn_id, messages):
+        frame = self.frame_message_batch(messages, conn_id)
+        self._send_frame(conn_id, frame,
+                         [message.uuid for message in messages])
+
+    ###########################################################
+
+    def _send_frame(self, conn_id, frame, msg_uuids):
+        pid = self.packeter.send_packet(conn_id, frame)
+        self._message_by_packet[pid] = (msg_uuids, len(frame))
+        in_flight = self._in_flight.get(conn_id)
+        if in_flight is not None:
+            in_flight[0] += 1
+            in_flight[1] += len(frame)
 
     ###########################################################
 
@@ -332,16 +692,55 @@ class Messaging(object):
 
     ###########################################################
 
-    def _on_link_loop_pass(self):
-        self._manage_pings()
-        for ident, conn_id in self._conn_by_ident.items():
-            with self._lock:
-                queue = self.queues_manager.get_queue(ident)
-                if len(queue) == 0:
-                    continue
+    def _send_queued(self, ident, conn_id):
+        """
+        Pass queued messages to the packeter until the send window of the
+        connection is full. The window is refilled as soon as messages are
+        sent so the throughput does not depend on the loop pass rate.
+        Small messages are packed into batch frames if the peer supports it.
+        """
+        in_flight = self._in_flight[conn_id]
+        batching = ((self.batch_max_messages > 1) and
+                    (self._capabilities.get(conn_id, 0) & CAPABILITY_BATCH))
+        with self._lock:
+            queue = self.queues_manager.get_queue(ident)
+            while len(queue) and ((in_flight[0] == 0) or
+                      ((in_flight[0] < self.send_window_messages) and
+                      (in_flight[1] < self.send_window_size))):
                 item = queue.get()
+                if item is None:
+                    # the rest of the queue has expired while loading
+                    break
                 queue.pop()
-                self.send_message_frame(conn_id, item)
+                if not batching:
+                    self.send_message_frame(conn_id, item)
+                    continue
+                batch = [item]
+                size = len(item.data)
+                while len(queue) and (len(batch) < self.batch_max_messages):
+                    item = queue.get()
+                    if (item is None) or (size + len(item.data) >
+                                          self.batch_max_size):
+                        break
+                    queue.pop()
+                    batch.append(item)
+                    size += len(item.data)
+                if len(batch) == 1:
+                    self.send_message_frame(conn_id, batch[0])
+                else:
+                    self.send_message_batch_frame(conn_id, batch)
+
+    ###########################################################
+
+    def _on_link_loop_pass(self):
+        self._manage_pings()
+        with self._lock:
+            self.queues_manager.collect_garbage()
+        for ident, conn_id in list(self._conn_by_ident.items()):
+            self._send_queued(ident, conn_id)
+        with self._lock:
+            # group storage changes made in this pass
+            self.queues_manager.flush()
 
     ###########################################################
 
@@ -353,23 +752,58 @@ class Messaging(object):
         :param message: :class:`~snakemq.message.Message`
         """
         assert isinstance(message, Message)
+        if message.flags & FLAGS_RESERVED:
+            raise ValueError("reserved message flags %X" %
+                             (message.flags & FLAGS_RESERVED))
         with self._lock:
             self.queues_manager.get_queue(ident).push(message)
         self.packeter.link.wakeup_poll()
 
+    ###########################################################
+
+    def pop_queued(self, ident):
+        """
+        Remove all messages waiting in the queue of the ident. Thread safe.
+
+        :return: list of :class:`~snakemq.message.Message`
+        """
+        messages = []
+        with self._lock:
+            queue = self.queues_manager.queues.get(ident)
+            while (queue is not None) and len(queue):
+                message = queue.get()
+                if message is None:
+                    break
+                queue.pop()
+                messages.append(message)
+        return messages
+
 #############################################################################
 #############################################################################
 
 class ReceiveHook(object):
     """
     Received messages are classified by regexp. Appropriate callbacks are
-    called.
+    called in the order of registration.
+
+    Regexps without special characters are treated as literal prefixes and
+    looked up in a table by the message head. Only true patterns are
+    matched one by one.
     """
 
     def __init__(self, messaging):
         self.messaging = messaging
-        #: regexp:(compiled_regexp, callback)
+        #: regexp:(order, callback, compiled_regexp or None for literals)
         self._hooks = {}
+        self._order = itertools.count()
+        #: literal prefix:(order, callback)
+        self._literals = {}
+        self._literal_lengths = []
+        #: [(order, compiled_regexp, callback)]
+        self._patterns = []
+        #: message head:callbacks of literal prefixes
+        self._routes = {}
+        self._route_head_length = 0
 
         messaging.on_message_recv = self._on_message_receive
 
@@ -380,17 +814,55 @@ class ReceiveHook(object):
         :param regexp:
         :param callback: L{Messaging.on_message_recv}
         """
-        self._hooks[regexp] = (re.compile(regexp), callback)
+        # invalid regexp must not leave the hook registered
+        compiled = None if is_literal(regexp) else re.compile(regexp)
+        self._hooks.pop(regexp, None)
+        self._hooks[regexp] = (next(self._order), callback, compiled)
+        self._rebuild()
 
     ###########################################################
 
     def unregister(self, regexp):
         del self._hooks[regexp]
+        self._rebuild()
 
     ###########################################################
 
     def clear(self):
         self._hooks.clear()
+        self._rebuild()
+
+    ###########################################################
+
+    def _rebuild(self):
+        self._literals.clear()
+        del self._patterns[:]
+        for regexp, (order, callback, compiled) in self._hooks.items():
+            if compiled is None:
+                self._literals[regexp] = (order, callback)
+            else:
+                self._patterns.append((order, compiled, callback))
+        self._patterns.sort(key=lambda pattern: pattern[0])
+        self._literal_lengths = sorted(set(len(literal)
+                                          for literal in self._literals))
+        self._route_head_length = max(self._literal_lengths or [0])
+        self._routes.clear()
+
+    ###########################################################
+
+    def _route_literals(self, head):
+        """
+        :return: list of (order, callback) of literal prefixes of the head
+        """
+        routes = []
+        for length in self._literal_lengths:
+            if length > len(head):
+                break
+            hook = self._literals.get(head[:length])
+            if hook is not None:
+                routes.append(hook)
+        routes.sort(key=lambda hook: hook[0])
+        return routes
 
     ###########################################################
 
@@ -398,11 +870,37 @@ class ReceiveHook(object):
         """
         :return: all callbacks that matches
         """
-        return [callback for regexp, callback in self._hooks.values()
-                                            if regexp.match(txt)]
+        # literal matches depend only on the head
+        head = txt[:self._route_head_length]
+        routes = self._routes.get(head)
+        if routes is None:
+            routes = self._route_literals(head)
+            if len(self._routes) >= MAX_ROUTES_CACHE:
+                self._routes.clear()
+            self._routes[head] = routes
+        if not self._patterns:
+            return [callback for _, callback in routes]
+        matches = routes + [(order, callback)
+                            for (order, regexp, callback) in self._patterns
+                            if regexp.match(txt)]
+        matches.sort(key=lambda hook: hook[0])
+        return [callback for _, callback in matches]
 
     ###########################################################
 
     def _on_message_receive(self, conn_id, ident, message):
         for callback in self._get_callbacks(message.data):
             callback(conn_id, ident, message)
+
+#############################################################################
+#############################################################################
+
+def is_literal(regexp):
+    """
+    :return: True if the regexp contains no special characters
+    """
+    if isinstance(regexp, REGEXP_TYPE):
+        return False
+    if isinstance(regexp, bytes):
+        regexp = regexp.decode("latin-1")
+    return not any((char in REGEXP_SPECIAL_CHARS) for char in regexp)
@@ -13,7 +13,7 @@ import struct
 from collections import deque
 
 from snakemq.exceptions import NoConnection
-from snakemq.buffers import StreamBuffer
+from snakemq.buffers import LocklessStreamBuffer
 from snakemq.exceptions import SnakeMQBrokenPacket
 from snakemq.callbacks import Callback
 
@@ -21,6 +21,9 @@ from snakemq.callbacks import Callback
 ############################################################################
 
 SEND_BLOCK_SIZE = 64 * 1024
+#: smaller payloads are joined with the packet header, larger are queued
+#: separately and sent without copying
+SEND_JOIN_LIMIT = 1024
 
 BIN_SIZE_FORMAT = "!I"  # network order 32-bit unsigned integer
 SIZEOF_BIN_SIZE = struct.calcsize(BIN_SIZE_FORMAT)
@@ -41,36 +44,76 @@ def bin_to_size(buf):
 ############################################################################
 ############################################################################
 
-class ReceiveBuffer(StreamBuffer):
+class ReceiveBuffer(object):
+    """
+    Contiguous buffer of received data. Packets are parsed in place and
+    the consumed part of the buffer is discarded lazily.
+    """
     def __init__(self):
-        StreamBuffer.__init__(self)
+        self.buf = bytearray()
+        self.offset = 0  #: start of the unprocessed data
         self.packet_size = None  # cache for packet size by its header
 
     ############################################################
 
+    def put(self, data):
+        """
+        :param data: bytes-like object, it is copied
+        """
+        if self.offset:
+            if self.offset == len(self.buf):
+                del self.buf[:]
+                self.offset = 0
+            elif self.offset >= len(self.buf) // 2:
+                # compact only if it moves less data then it frees
+                del self.buf[:self.offset]
+                self.offset = 0
+        self.buf += data
+
+    ############################################################
+
     def get_packets(self):
         """
         :return: list of fully received packets
         """
         packets = []
-        while self.size:
-            if self.packet_size is None:
-                if self.size < SIZEOF_BIN_SIZE:
-                    # wait for more data
-                    break
-                header = self.get(SIZEOF_BIN_SIZE, True)
-                self.packet_size = bin_to_size(header)
-                if self.packet_size < 0:
-                    raise SnakeMQBrokenPacket("wrong packet header")
-            else:
-                if self.size < self.packet_size:
-                    # wait for more data
-                    break
-                packets.append(self.get(self.packet_size, True))
-                self.packet_size = None
+        offset = self.offset
+        end = len(self.buf)
+        packet_size = self.packet_size
+        # the view must be released before the buffer is resized, no
+        # context manager in py2
+        view = memoryview(self.buf)
+        try:
+            while True:
+                if packet_size is None:
+                    if end - offset < SIZEOF_BIN_SIZE:
+                        # wait for more data
+                        break
+                    packet_size = struct.unpack_from(BIN_SIZE_FORMAT,
+                                                      self.buf, offset)[0]
+                    offset += SIZEOF_BIN_SIZE
+                    if packet_size < 0:
+                        raise SnakeMQBrokenPacket("wrong packet header")
+                else:
+                    if end - offset < packet_size:
+                        # wait for more data
+                        break
+                    packets.append(view[offset:offset + packet_size].tobytes())
+                    offset += packet_size
+                    packet_size = None
+        finally:
+            if hasattr(view, "release"):
+                view.release()
+        self.offset = offset
+        self.packet_size = packet_size
 
         return packets
 
+    ############################################################
+
+    def __len__(self):
+        return len(self.buf) - self.offset
+
 ############################################################################
 ############################################################################
 
@@ -79,7 +122,7 @@ class ConnectionInfo(object):
     Connection information and receive buffer handler.
     """
     def __init__(self):
-        self.send_buffer = StreamBuffer()
+        self.send_buffer = LocklessStreamBuffer()
         self.recv_buffer = ReceiveBuffer()
         self.send_in_progress = False
         self.queued_packet_ids = deque()  # pairs of (packet_length, packet_id)
@@ -107,6 +150,8 @@ class Packeter(object):
         self._connections = {}  # conn_id:ConnectionInfo
         self._last_packet_id = 0
 
+        # the receive buffer copies the received data
+        self.link.recv_memoryview = True
         self.link.on_connect.add(self._on_connect)
         self.link.on_disconnect.add(self._on_disconnect)
         self.link.on_recv.add(self._on_recv)
@@ -130,9 +175,13 @@ class Packeter(object):
         self._last_packet_id += 1
         packet_id = self._last_packet_id
 
-        buf = size_to_bin(len(buf)) + buf
-        conn.send_buffer.put(buf)
-        conn.queued_packet_ids.append((len(buf), packet_id))
+        header = size_to_bin(len(buf))
+        if len(buf) < SEND_JOIN_LIMIT:
+            conn.send_buffer.put(header + buf)
+        else:
+            conn.send_buffer.put(header)
+            conn.send_buffer.put(buf)
+        conn.queued_packet_ids.append((SIZEOF_BIN_SIZE + len(buf), packet_id))
         self._send_to_link(conn_id, conn)
 
         return packet_id
@@ -191,7 +240,7 @@ class Packeter(object):
     def _send_to_link(self, conn_id, conn):
         if conn.send_in_progress:
             return
-        buf = conn.send_buffer.get(SEND_BLOCK_SIZE, False)
-        if buf:
-            self.link.send(conn_id, buf)
+        fragments = conn.send_buffer.get_fragments(SEND_BLOCK_SIZE)
+        if fragments:
+            self.link.send(conn_id, fragments)
             conn.send_in_progress = True
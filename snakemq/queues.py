@@ -3,17 +3,33 @@
 Queues, manager. TTL is decreased only by the disconnected time. Queue manager
 "downtime" is not included.
 
+Each queue has its own TTL clock which runs only while the queue is
+disconnected. Items expire when the clock passes their deadline. Deadlines
+are kept in a heap so only expired items are visited.
+
+Persistent items are loaded from the storage lazily in pages as the queue is
+drained. Items which are not loaded yet are not visited by the expiration,
+their stored TTLs are decreased by the disconnected time on every connect.
+
 :author: David Siroky (siroky@dasir.cz)
 :license: MIT License (see LICENSE.txt)
 """
 
 import time
 import logging
+import heapq
+import itertools
+from collections import deque
 
 from snakemq.storage import QueuesStorageBase
 from snakemq.message import FLAG_PERSISTENT
 from snakemq.callbacks import Callback
 
+###########################################################################
+###########################################################################
+
+LOAD_PAGE_SIZE = 1000  #: count of items loaded from the storage at once
+
 ###########################################################################
 ###########################################################################
 # queue
@@ -23,9 +39,25 @@ class Queue(object):
     def __init__(self, name, manager):
         self.name = name
         self.manager = manager
-        self.queue = []
+        self.queue = deque()
+        self.index = {}  #: uuid:item, all items in the queue
+        #: id() of items removed from the middle of the queue, they are
+        #: discarded when they reach the queue head
+        self.removed = set()
+        #: TTL clock - total disconnected time until the last disconnect
+        self.ttl_clock = 0.0
+        self.deadlines = {}  #: uuid:deadline (TTL clock) of items with TTL
+        #: heap of (deadline, seq, item), might contain stale entries
+        self.deadlines_heap = []
+        self.deadlines_seq = itertools.count()
         self.last_disconnect_absolute = None
         self.connected = False
+        self.unloaded = 0  #: count of items remaining in the storage
+        self.unloaded_iter = None
+        #: TTL clock the stored TTLs of unloaded items are relative to
+        self.unloaded_clock = 0.0
+        #: items pushed while some stored items are not loaded yet
+        self.tail = deque()
 
         if manager.storage:
             self.load_persistent_data()
@@ -34,48 +66,259 @@ class Queue(object):
     ####################################################
 
     def load_persistent_data(self):
-        self.queue[:] = self.manager.storage.get_items(self.name)
+        storage = self.manager.storage
+        self.unloaded = storage.get_items_count(self.name)
+        if self.unloaded:
+            self.unloaded_iter = storage.iter_items(self.name)
+
+    ####################################################
+
+    def load_more(self, count=LOAD_PAGE_SIZE):
+        """
+        Load next page of items from the storage.
+        """
+        items = list(itertools.islice(self.unloaded_iter, count))
+        exhausted = len(items) < count
+        # an item pushed during the loading might be returned by the storage
+        # too (e.g. SQLite reuses rowids of deleted rows), it is already in
+        # the tail
+        items = [item for item in items if item.uuid not in self.index]
+        self.unloaded -= len(items)
+        if exhausted:
+            self.unloaded = 0
+        for item in items:
+            self.queue.append(item)
+            self.index[item.uuid] = item
+            self.set_deadline(item, self.unloaded_clock)
+        if self.unloaded <= 0:
+            self.finish_loading()
+        self.expire(self.get_ttl_clock())
+        if not self.connected:
+            self.manager.plan_expiration(self)
+
+    ####################################################
+
+    def finish_loading(self):
+        self.unloaded = 0
+        self.unloaded_iter = None
+        self.queue.extend(self.tail)
+        self.tail.clear()
+
+    ####################################################
+
+    def fill_head(self):
+        """
+        Discard removed items from the head and load more items if the
+        loaded part is drained.
+        """
+        self.discard_removed_head()
+        while (not self.queue) and self.unloaded:
+            self.load_more()
+            self.discard_removed_head()
+
+    ####################################################
+
+    def find(self, item_uuid):
+        """
+        :return: item with the given UUID (loads it if necessary) or None
+        """
+        item = self.index.get(item_uuid)
+        while (item is None) and self.unloaded:
+            self.load_more()
+            item = self.index.get(item_uuid)
+        return item
+
+    ####################################################
+
+    def set_items(self, items):
+        """
+        Replace content of the queue.
+        """
+        self.queue = deque(items)
+        self.index = dict((item.uuid, item) for item in self.queue)
+        self.unloaded = 0
+        self.unloaded_iter = None
+        self.tail.clear()
+        self.removed.clear()
+        self.deadlines.clear()
+        del self.deadlines_heap[:]
+        for item in self.queue:
+            self.set_deadline(item, self.ttl_clock)
+
+    ####################################################
+
+    def set_deadline(self, item, clock):
+        if item.ttl is None:
+            self.deadlines.pop(item.uuid, None)
+            return
+        deadline = clock + item.ttl
+        self.deadlines[item.uuid] = deadline
+        heapq.heappush(self.deadlines_heap,
+                      (deadline, next(self.deadlines_seq), item))
+
+    ####################################################
+
+    def get_ttl_clock(self):
+        if self.connected:
+            return self.ttl_clock
+        else:
+            return self.ttl_clock + time.time() - self.last_disconnect_absolute
 
     ####################################################
 
     def connect(self):
+        self.ttl_clock += time.time() - self.last_disconnect_absolute
         self.connected = True
-        self.collect_garbage()
+        self.fill_head()
+        self.expire(self.ttl_clock)
+        self.store_ttls()
 
     ####################################################
 
     def collect_garbage(self):
-        """ remove outdated items and update TTLs """
-        diff = time.time() - self.last_disconnect_absolute
-        fresh_queue = []
-        deleted_items = []
-        storage_update_ttls = []
-        storage_to_delete = []
-        for item in self.queue:
-            if item.ttl is None:
-                fresh_queue.append(item)
-                continue
-            item.ttl -= diff
-            if item.ttl >= 0:  # must include 0
-                fresh_queue.append(item)
-                if item.flags & FLAG_PERSISTENT:
-                    storage_update_ttls.append(item)
-            else:
-                deleted_items.append(item)
-                if item.flags & FLAG_PERSISTENT:
-                    storage_to_delete.append(item)
-        if self.manager.storage:
-            self.manager.storage.update_items_ttl(storage_update_ttls)
-            self.manager.storage.delete_items(storage_to_delete)
-        self.queue[:] = fresh_queue
-        for item in deleted_items:
+        """ remove outdated items """
+        self.expire(self.get_ttl_clock())
+
+    ####################################################
+
+    def is_deadline_valid(self, deadline, item):
+        return ((self.index.get(item.uuid) is item) and
+                (self.deadlines.get(item.uuid) == deadline))
+
+    ####################################################
+
+    def expire(self, clock):
+        """
+        Remove items with deadline before the given TTL clock. Only expired
+        items are visited.
+        """
+        heap = self.deadlines_heap
+        dropped = []
+        while heap and (heap[0][0] < clock):  # TTL 0 is still valid
+            deadline, _, item = heapq.heappop(heap)
+            if self.is_deadline_valid(deadline, item):
+                del self.index[item.uuid]
+                del self.deadlines[item.uuid]
+                self.removed.add(id(item))
+                dropped.append(item)
+        self.discard_removed_head()
+
+        if dropped and self.manager.storage:
+            self.manager.storage.delete_items([item for item in dropped
+                                          if item.flags & FLAG_PERSISTENT])
+        for item in dropped:
+            self.manager.on_item_drop(self.name, item.uuid)
+
+    ####################################################
+
+    def store_ttls(self):
+        """
+        Update TTLs of persistent items in the storage.
+        """
+        if not self.manager.storage:
+            return
+        if self.unloaded:
+            self.shift_unloaded_ttls()
+        to_update = []
+        for item_uuid, deadline in self.deadlines.items():
+            item = self.index[item_uuid]
+            if item.flags & FLAG_PERSISTENT:
+                item.ttl = deadline - self.ttl_clock
+                to_update.append(item)
+        self.manager.storage.update_items_ttl(to_update)
+
+    ####################################################
+
+    def shift_unloaded_ttls(self):
+        """
+        Apply the disconnected time to TTLs of items which are not loaded yet
+        and drop the expired ones.
+        """
+        elapsed = self.ttl_clock - self.unloaded_clock
+        if elapsed <= 0:
+            return
+        storage = self.manager.storage
+        # loaded items are updated separately
+        dropped = [item for item in storage.shift_items_ttl(self.name, elapsed)
+                   if item.uuid not in self.index]
+        self.unloaded_clock = self.ttl_clock
+        storage.delete_items(dropped)
+        self.unloaded -= len(dropped)
+        # the stored TTLs have changed, read the storage again
+        close = getattr(self.unloaded_iter, "close", None)
+        if close is not None:
+            close()
+        if self.unloaded > 0:
+            self.unloaded_iter = self.resume_loading(
+                                              storage.iter_items(self.name))
+        else:
+            self.finish_loading()
+        for item in dropped:
             self.manager.on_item_drop(self.name, item.uuid)
 
     ####################################################
 
+    def resume_loading(self, items):
+        """
+        Skip already loaded items of a new storage iterator. Items loaded
+        now might be deleted before the iterator gets to them so they are
+        skipped right away.
+
+        :return: iterator of the remaining unloaded items
+        """
+        items = iter(items)
+        for item in items:
+            if item.uuid not in self.index:
+                return self.iter_unloaded(item, items, self.unloaded)
+        return iter(())
+
+    def iter_unloaded(self, first, items, count):
+        # items pushed after the iterator creation follow the unloaded ones
+        try:
+            for item in itertools.chain([first], items):
+                if count <= 0:
+                    break
+                if item.uuid not in self.index:
+                    count -= 1
+                    yield item
+        finally:
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+
+    ####################################################
+
+    def compact_deadlines(self):
+        """
+        Drop stale entries (of delivered or removed items) from the heap.
+        """
+        if len(self.deadlines_heap) > 2 * len(self.deadlines) + 64:
+            self.deadlines_heap[:] = [(deadline, seq, item)
+                          for (deadline, seq, item) in self.deadlines_heap
+                          if self.is_deadline_valid(deadline, item)]
+            heapq.heapify(self.deadlines_heap)
+
+    ####################################################
+
+    def next_expiration(self):
+        """
+        :return: absolute time of the nearest item expiration or None if
+                 there is nothing to expire (connected queues never expire
+                 items)
+        """
+        heap = self.deadlines_heap
+        while heap and not self.is_deadline_valid(heap[0][0], heap[0][2]):
+            heapq.heappop(heap)
+        if self.connected or not heap:
+            return None
+        return self.last_disconnect_absolute + heap[0][0] - self.ttl_clock
+
+    ####################################################
+
     def disconnect(self):
         self.connected = False
         self.last_disconnect_absolute = time.time()
+        self.manager.plan_expiration(self)
 
     ####################################################
 
@@ -83,7 +326,17 @@ class Queue(object):
         if (item.ttl is not None) and (item.ttl <= 0) and not self.connected:
             # do not queue already obsolete items
             return
-        self.queue.append(item)
+        if self.unloaded:
+            # keep the order, the item is queued after the stored items
+            self.tail.append(item)
+        else:
+            self.queue.append(item)
+        self.index[item.uuid] = item
+        # TTL of items pushed into a disconnected queue is counted since the
+        # disconnection
+        self.set_deadline(item, self.ttl_clock)
+        if not self.connected and (item.ttl is not None):
+            self.manager.plan_expiration(self)
         to_store = (item.flags & FLAG_PERSISTENT) and self.manager.storage
         if to_store and ((item.ttl is None) or (item.ttl > 0)):
             # do not store items with ttl==0
@@ -91,6 +344,14 @@ class Queue(object):
 
     ####################################################
 
+    def discard_removed_head(self):
+        queue = self.queue
+        removed = self.removed
+        while removed and queue and (id(queue[0]) in removed):
+            removed.remove(id(queue.popleft()))
+
+    ####################################################
+
     def get(self):
         """
         Get first item but do not remove it. Use {Queue.pop()} to remove it
@@ -99,10 +360,14 @@ class Queue(object):
         :return: item or None if empty
         """
         # no need to test TTL because it is filtered in connect()
-        if self.queue:
-            return self.queue[0]
-        else:
+        self.fill_head()
+        if not self.queue:
             return None
+        item = self.queue[0]
+        deadline = self.deadlines.get(item.uuid)
+        if deadline is not None:
+            item.ttl = deadline - self.ttl_clock
+        return item
 
     ####################################################
 
@@ -112,16 +377,66 @@ class Queue(object):
 
         :return: None
         """
+        self.fill_head()
         if not self.queue:
             return
-        item = self.queue.pop(0)
+        item = self.queue.popleft()
+        if self.index.get(item.uuid) is item:
+            del self.index[item.uuid]
+            self.deadlines.pop(item.uuid, None)
+            self.compact_deadlines()
         if (item.flags & FLAG_PERSISTENT) and self.manager.storage:
             self.manager.storage.delete_items([item])
 
     ####################################################
 
+    def remove(self, item_uuid):
+        """
+        Remove item with the given UUID regardless its position.
+
+        :return: True if the item was found
+        """
+        item = self.find(item_uuid)
+        if item is None:
+            return False
+        del self.index[item_uuid]
+        self.deadlines.pop(item_uuid, None)
+        self.removed.add(id(item))
+        self.discard_removed_head()
+        self.compact_deadlines()
+        if (item.flags & FLAG_PERSISTENT) and self.manager.storage:
+            self.manager.storage.delete_items([item])
+        return True
+
+    ####################################################
+
+    def update_ttl(self, item_uuid, ttl):
+        """
+        Set new TTL of the item with the given UUID.
+
+        :return: True if the item was found
+        """
+        item = self.find(item_uuid)
+        if item is None:
+            return False
+        item.ttl = None if ttl is None else float(ttl)
+        self.set_deadline(item, self.get_ttl_clock())
+        if not self.connected:
+            self.manager.plan_expiration(self)
+        if (item.flags & FLAG_PERSISTENT) and self.manager.storage:
+            self.manager.storage.update_items_ttl([item])
+        return True
+
+    ####################################################
+
+    def __contains__(self, item_uuid):
+        return item_uuid in self.index
+
+    ####################################################
+
     def __len__(self):
-        return len(self.queue)
+        return (len(self.queue) + len(self.tail) + self.unloaded -
+                len(self.removed))
 
 ###########################################################################
 ###########################################################################
@@ -136,6 +451,9 @@ class QueuesManager(object):
         assert (storage is None) or isinstance(storage, QueuesStorageBase)
         self.storage = storage
         self.queues = {}  #: name:Queue
+        #: heap of (absolute time, queue name) of planned expirations
+        self.expiration_plan = []
+        self.planned_expiration = {}  #: queue name:absolute time
         self.log = logging.getLogger("snakemq.queuesmanager")
         if storage:
             self.load_from_storage()
@@ -179,17 +497,60 @@ class QueuesManager(object):
         Delete queues and close persistent storage.
         """
         self.queues.clear()
+        del self.expiration_plan[:]
+        self.planned_expiration.clear()
         if self.storage:
             self.storage.close()
             self.storage = None
 
     ####################################################
 
+    def flush(self):
+        """
+        Make pending changes of the persistent storage persistent.
+        """
+        if self.storage:
+            self.storage.flush()
+
+    ####################################################
+
+    def plan_expiration(self, queue):
+        """
+        Plan garbage collection of the queue to the time of its nearest item
+        expiration.
+        """
+        when = queue.next_expiration()
+        if when is None:
+            return
+        planned = self.planned_expiration.get(queue.name)
+        if (planned is not None) and (planned <= when):
+            return
+        self.planned_expiration[queue.name] = when
+        heapq.heappush(self.expiration_plan, (when, queue.name))
+
+    ####################################################
+
     def collect_garbage(self):
         """
-        Call this periodically to remove obsolete items and empty queues.
+        Call this periodically to remove obsolete items. Only queues with
+        expired items are visited.
         """
-        # TODO
+        plan = self.expiration_plan
+        if not plan:
+            return
+        now = time.time()
+        due = []
+        while plan and (plan[0][0] <= now):
+            when, queue_name = heapq.heappop(plan)
+            if self.planned_expiration.get(queue_name) == when:
+                del self.planned_expiration[queue_name]
+                due.append(queue_name)
+        for queue_name in due:
+            queue = self.queues.get(queue_name)
+            if (queue is None) or queue.connected:
+                continue
+            queue.collect_garbage()
+            self.plan_expiration(queue)
 
     ####################################################
 
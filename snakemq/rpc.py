@@ -16,9 +16,21 @@ import warnings
 import logging
 import time
 import sys
+import struct
+import itertools
 from binascii import b2a_hex
+from contextlib import contextmanager
+
+try:
+    from concurrent.futures import Future
+except ImportError:
+    # python2 without the "futures" backport
+    Future = None
 
 from snakemq.message import Message
+from snakemq.serializers import (PickleSerializer, default_serializers,
+                                  SERIALIZER_PICKLE)
+from snakemq.workers import WorkersPool, DEFAULT_WORKERS, DEFAULT_MAX_PENDING
 
 ###############################################################################
 ###############################################################################
@@ -30,6 +42,47 @@ REPLY_PREFIX = b"rpcrep"
 
 METHOD_RPC_AS_SIGNAL_ATTR = "__snakemw_rpc_as_signal"
 
+# binary envelope following the prefix:
+# requests: version, type, serializer ID, req_id length, name ID,
+#           [object name length, method name length, object name,
+#           method name], req_id, serialized (args, kwargs)
+#   - names are present if the type has the ENVELOPE_NAMES flag, a nonzero
+#     name ID is then assigned to them (interned by the server per peer)
+#   - without the names the name ID refers to the interned names
+#   - only args are serialized if the type has the ENVELOPE_ARGS flag
+# batch: version, type, serializer ID, 0, 0, (request length, request)*
+# replies: version, type, serializer ID, req_id length, req_id,
+#          serialized return value or (exception, exception format)
+ENVELOPE_VERSION = 0xA1  # older versions send a pickled dict
+ENVELOPE_HEADER = struct.Struct("!BBBB")
+REQUEST_HEADER = struct.Struct("!BBBBH")
+NAMES_HEADER = struct.Struct("!BB")
+BATCH_ITEM = struct.Struct("!I")
+
+ENVELOPE_CALL = 1
+ENVELOPE_SIGNAL = 2
+ENVELOPE_BATCH = 3
+ENVELOPE_RETURN = 4
+ENVELOPE_EXCEPTION = 5
+ENVELOPE_NAMES = 0x80  #: request type flag, names follow the header
+ENVELOPE_ARGS = 0x40  #: request type flag, no kwargs
+ENVELOPE_TYPE_MASK = 0x3f
+
+ENVELOPE_BY_COMMAND = {"call": ENVELOPE_CALL, "signal": ENVELOPE_SIGNAL,
+                       "batch": ENVELOPE_BATCH}
+COMMAND_BY_ENVELOPE = dict((v, k) for (k, v) in ENVELOPE_BY_COMMAND.items())
+
+#: serializer "ID" of the old pickled dict format
+SERIALIZER_LEGACY = 0
+
+MAX_NAMES_CACHE = 4096
+MAX_NAME_ID = 0xffff
+
+# python3 deserializers accept memoryview so large payloads are not copied,
+# copying small payloads is cheaper than creating the view
+PAYLOAD_VIEW = sys.version_info[0] >= 3
+PAYLOAD_VIEW_MIN = 4096
+
 # TODO differ between traceback and exception format
 REMOTE_TRACEBACK_ATTR = "__remote_traceback__"
 
@@ -49,6 +102,13 @@ class NoMethodError(Error):
     """ requested method not found """
     pass
 
+class ServerBusyError(Error):
+    """
+    too many pending calls on the server (or it is shut down), the call was
+    not executed
+    """
+    pass
+
 class SignalCallWarning(Warning):
     """ signal method called normally or regular method called as signal """
     pass
@@ -83,6 +143,274 @@ def as_signal(method):
 # for better mock patching
 get_time = time.time
 
+def get_payload(data, start, end=None):
+    if PAYLOAD_VIEW and (len(data) >= PAYLOAD_VIEW_MIN):
+        return memoryview(data)[start:end]
+    return data[start:end]
+
+###############################################################################
+###############################################################################
+# envelope
+###############################################################################
+
+class NameIds(object):
+    """
+    Client side IDs of object/method names interned by a peer. Names are
+    sent along with their ID until a message defining the ID is sent, then
+    the ID alone is enough.
+    """
+
+    def __init__(self):
+        self.ids = {}  #: (object, method):ID
+        self.known = set()  #: IDs defined by already sent messages
+        #: (object, method, req_id length, type):request header with a known
+        #: ID
+        self.headers = {}
+        self.counter = itertools.count(1)
+
+    ######################################################
+
+    def get_id(self, objname, method):
+        """
+        :return: ID of the names or 0 if all IDs are used
+        """
+        key = (objname, method)
+        name_id = self.ids.get(key)
+        if name_id is None:
+            name_id = next(self.counter)
+            if name_id > MAX_NAME_ID:
+                return 0
+            self.ids[key] = name_id
+        return name_id
+
+#########################################################################
+#########################################################################
+
+class Envelope(object):
+    """
+    Encoding of requests and replies. Thread safe.
+    """
+
+    def __init__(self, pickler=pickle, serializer=None):
+        """
+        :param serializer: :class:`snakemq.serializers.Serializer` of sent
+                           requests, None = pickle
+        """
+        self.pickler = pickler
+        self.serializers = default_serializers(pickler)
+        if serializer is None:
+            serializer = PickleSerializer(pickler)
+        self.serializers[serializer.id] = serializer
+        self.serializer = serializer
+        #: (type, object, method, req_id length, name ID):encoded request
+        #: header with names
+        self.headers_cache = {}
+        #: encoded names:(object, method)
+        self.names_cache = {}
+        #: (type, serializer ID, req_id length):encoded reply header
+        self.reply_headers = {}
+
+    ######################################################
+
+    def request_header(self, envelope_type, objname, method, req_id_len,
+                        name_id):
+        key = (envelope_type, objname, method, req_id_len, name_id)
+        header = self.headers_cache.get(key)
+        if header is None:
+            objname_raw = objname.encode("utf-8")
+            method_raw = method.encode("utf-8")
+            header = (REQUEST_HEADER.pack(ENVELOPE_VERSION,
+                                          envelope_type | ENVELOPE_NAMES,
+                                          self.serializer.id, req_id_len,
+                                          name_id) +
+                      NAMES_HEADER.pack(len(objname_raw), len(method_raw)) +
+                      objname_raw + method_raw)
+            if len(self.headers_cache) >= MAX_NAMES_CACHE:
+                self.headers_cache.clear()
+            self.headers_cache[key] = header
+        return header
+
+    ######################################################
+
+    def encode_request(self, params, names=None, defined=None, prefix=b""):
+        """
+        :param params: dict with keys command, req_id, object, method, args,
+                       kwargs or command and requests for batches
+        :param names: :class:`NameIds` of the peer, None = no interning,
+                      signals are never interned (they might outlive the
+                      interned names of a restarted peer)
+        :param defined: set, IDs defined by this request are added
+        :param prefix: bytes prepended to the result (saves a copy)
+        :return: bytes
+        """
+        command = params["command"]
+        if command == "batch":
+            if defined is None:
+                defined = set()
+            parts = [prefix, REQUEST_HEADER.pack(ENVELOPE_VERSION,
+                                                  ENVELOPE_BATCH,
+                                                  self.serializer.id, 0, 0)]
+            for request in params["requests"]:
+                raw = self.encode_request(request, names, defined)
+                parts.append(BATCH_ITEM.pack(len(raw)))
+                parts.append(raw)
+            return b"".join(parts)
+
+        req_id = params.get("req_id") or b""
+        envelope_type = ENVELOPE_BY_COMMAND[command]
+        kwargs = params["kwargs"]
+        if kwargs:
+            payload = self.serializer.dumps((params["args"], kwargs))
+        else:
+            # smaller and faster to serialize
+            payload = self.serializer.dumps(params["args"])
+            envelope_type |= ENVELOPE_ARGS
+        name_id = 0
+        if (names is not None) and (command == "call"):
+            objname = params["object"]
+            method = params["method"]
+            key = (objname, method, len(req_id), envelope_type)
+            header = names.headers.get(key)
+            if header is not None:
+                return b"".join((prefix, header, req_id, payload))
+            name_id = names.get_id(objname, method)
+            if name_id and ((name_id in names.known) or
+                            ((defined is not None) and (name_id in defined))):
+                header = REQUEST_HEADER.pack(ENVELOPE_VERSION, envelope_type,
+                                             self.serializer.id, len(req_id),
+                                             name_id)
+                if name_id in names.known:
+                    names.headers[key] = header
+                return b"".join((prefix, header, req_id, payload))
+            if name_id and (defined is not None):
+                defined.add(name_id)
+        return b"".join((prefix,
+                          self.request_header(envelope_type, params["object"],
+                                              params["method"], len(req_id),
+                                              name_id),
+                          req_id, payload))
+
+    ######################################################
+
+    def decode_request(self, data, offset=0, end=None, names=None):
+        """
+        :param names: dict of interned names of the peer, name ID:(object,
+                      method)
+        :return: params dict, see :meth:`encode_request`, the key
+                 "serializer" is the serializer ID
+        """
+        (version, envelope_type, serializer_id, req_id_len,
+              name_id) = REQUEST_HEADER.unpack_from(data, offset)
+        if version != ENVELOPE_VERSION:
+            params = self.pickler.loads(data[offset:end])
+            params["serializer"] = SERIALIZER_LEGACY
+            return params
+        serializer = self.serializers.get(serializer_id)
+        if serializer is None:
+            raise Error("unknown serializer %i" % serializer_id)
+        offset += REQUEST_HEADER.size
+
+        if envelope_type == ENVELOPE_BATCH:
+            end = len(data) if end is None else end
+            requests = []
+            while offset < end:
+                size = BATCH_ITEM.unpack_from(data, offset)[0]
+                offset += BATCH_ITEM.size
+                requests.append(self.decode_request(data, offset,
+                                                     offset + size, names))
+                offset += size
+            return {"command": "batch", "req_id": b"",
+                    "serializer": serializer_id, "requests": requests}
+
+        if not envelope_type & ENVELOPE_NAMES:
+            pair = None if names is None else names.get(name_id)
+            if pair is None:
+                raise Error("unknown name ID %i" % name_id)
+        else:
+            objname_len, method_len = NAMES_HEADER.unpack_from(data, offset)
+            offset += NAMES_HEADER.size
+            names_end = offset + objname_len + method_len
+            raw_names = data[offset:names_end]
+            pair = self.names_cache.get(raw_names)
+            if pair is None:
+                pair = (raw_names[:objname_len].decode("utf-8"),
+                        raw_names[objname_len:].decode("utf-8"))
+                if len(self.names_cache) >= MAX_NAMES_CACHE:
+                    self.names_cache.clear()
+                self.names_cache[raw_names] = pair
+            if name_id and (names is not None):
+                names[name_id] = pair
+            offset = names_end
+        req_id_end = offset + req_id_len
+        payload = serializer.loads(get_payload(data, req_id_end, end))
+        if envelope_type & ENVELOPE_ARGS:
+            args, kwargs = payload, {}
+        else:
+            args, kwargs = payload
+        return {"command": COMMAND_BY_ENVELOPE[envelope_type &
+                                               ENVELOPE_TYPE_MASK],
+                "req_id": data[offset:req_id_end],
+                "serializer": serializer_id,
+                "object": pair[0],
+                "method": pair[1],
+                "args": args,
+                "kwargs": kwargs}
+
+    ######################################################
+
+    def encode_reply(self, data, serializer_id=None):
+        """
+        :param data: dict with keys req_id, ok, return or exception and
+                     exception_format
+        :param serializer_id: serializer of the request
+        :return: bytes
+        """
+        if serializer_id == SERIALIZER_LEGACY:
+            # older clients ignore the key, newer switch to the envelope
+            return self.pickler.dumps(dict(data, envelope=ENVELOPE_VERSION))
+        if data["ok"]:
+            envelope_type = ENVELOPE_RETURN
+            serializer = self.serializers.get(serializer_id, self.serializer)
+            payload = data["return"]
+        else:
+            # only pickle can transfer exceptions
+            envelope_type = ENVELOPE_EXCEPTION
+            serializer = self.serializers[SERIALIZER_PICKLE]
+            payload = (data["exception"], data["exception_format"])
+        req_id = data["req_id"]
+        key = (envelope_type, serializer.id, len(req_id))
+        header = self.reply_headers.get(key)
+        if header is None:
+            header = ENVELOPE_HEADER.pack(ENVELOPE_VERSION, envelope_type,
+                                          serializer.id, len(req_id))
+            self.reply_headers[key] = header
+        return b"".join((header, req_id, serializer.dumps(payload)))
+
+    ######################################################
+
+    def decode_reply(self, data, offset=0):
+        """
+        :return: dict, see :meth:`encode_reply`, the key "envelope" is the
+                 envelope version supported by the peer (missing for older
+                 peers)
+        """
+        version, envelope_type, serializer_id, req_id_len = \
+                  ENVELOPE_HEADER.unpack_from(data, offset)
+        if version != ENVELOPE_VERSION:
+            return self.pickler.loads(data[offset:])
+        offset += ENVELOPE_HEADER.size
+        req_id = data[offset:offset + req_id_len]
+        serializer = self.serializers.get(serializer_id)
+        if serializer is None:
+            raise Error("unknown serializer %i" % serializer_id)
+        payload = serializer.loads(get_payload(data, offset + req_id_len))
+        if envelope_type == ENVELOPE_RETURN:
+            return {"req_id": req_id, "ok": True, "return": payload,
+                    "envelope": version}
+        else:
+            return {"req_id": req_id, "ok": False, "exception": payload[0],
+                    "exception_format": payload[1], "envelope": version}
+
 ###############################################################################
 ###############################################################################
 # server
@@ -92,28 +420,55 @@ class RpcServer(object):
     """
     Registering and unregistering objects is NOT thread safe.
 
-    Methods of registered objects are called in a different thread other
-    than the link loop.
+    Methods of registered objects are called by a pool of worker threads
+    other than the link loop. If all workers are busy and the count of
+    pending calls reaches the limit then new calls are refused with
+    :class:`ServerBusyError` (and signals are dropped). Waiting for a free
+    worker would block the link loop and a method calling another RPC
+    method over the same link would never get its reply. Calls received
+    after :meth:`shutdown` are refused the same way.
     """
 
-    def __init__(self, receive_hook, pickler=pickle):
+    def __init__(self, receive_hook, pickler=pickle, workers=DEFAULT_WORKERS,
+                  max_pending=DEFAULT_MAX_PENDING):
+        """
+        :param workers: max. count of worker threads
+        :param max_pending: max. count of received but not finished calls
+
+        Replies are serialized by the serializer of the request.
+        """
         self.log = logging.getLogger("snakemq.rpc.server")
         self.receive_hook = receive_hook
         self.pickler = pickler
+        self.envelope = Envelope(pickler)
         receive_hook.register(REQUEST_PREFIX, self.on_recv)
+        receive_hook.messaging.on_disconnect.add(self.on_disconnect)
         self.instances = {}
+        self.serialized = set()  #: names of objects with serialized calls
+        #: remote_ident:interned names of the peer (name ID:(object, method))
+        self.names = {}
+        self.pool = WorkersPool(workers, max_pending, name="mqrpc_call")
         #: transfer call exception back to client (only for non-signal calls)
         self.transfer_exceptions = True
 
     ######################################################
 
-    def register_object(self, instance, name):
+    def register_object(self, instance, name, serialize=False):
+        """
+        :param serialize: if True then methods of the object are called one
+                          by one in the order of reception
+        """
         self.instances[name] = instance
+        if serialize:
+            self.serialized.add(name)
+        else:
+            self.serialized.discard(name)
 
     ######################################################
 
     def unregister_object(self, name):
         del self.instances[name]
+        self.serialized.discard(name)
 
     ######################################################
 
@@ -122,21 +477,75 @@ class RpcServer(object):
 
     ######################################################
 
+    def on_disconnect(self, dummy_conn_id, ident):
+        # the client defines the names again after a reconnection
+        self.names.pop(ident, None)
+
+    ######################################################
+
     def on_recv(self, dummy_conn_id, ident, message):
         try:
-            params = self.pickler.loads(message.data[len(REQUEST_PREFIX):])
-        except self.pickler.PickleError as exc:
-            self.log.error("on_recv unpickle: %r" % exc)
+            names = self.names.get(ident)
+            if names is None:
+                names = self.names[ident] = {}
+            params = self.envelope.decode_request(message.data,
+                                                   len(REQUEST_PREFIX),
+                                                   names=names)
+        except Exception as exc:
+            self.log.error("on_recv decode: %r" % exc)
             return
 
+        self.handle_request(ident, params)
+
+    ######################################################
+
+    def handle_request(self, ident, params):
         cmd = params["command"]
         if cmd in ("call", "signal"):
             # method must not block link loop
-            thr = threading.Thread(target=self.call_method,
-                    name="mqrpc_call;%s;%s" % (params["object"], params["method"]),
-                    args=(ident, params))
-            thr.setDaemon(True)
-            thr.start()
+            objname = params["object"]
+            key = objname if objname in self.serialized else None
+            try:
+                accepted = self.pool.submit(self.call_method, (ident, params),
+                                            key, block=False)
+            except RuntimeError:
+                # the pool is shut down
+                self.refuse_request(ident, params, "server is shut down")
+                return
+            if not accepted:
+                self.refuse_request(ident, params,
+                                    "%i pending calls" % len(self.pool))
+        elif cmd == "batch":
+            for request in params["requests"]:
+                self.handle_request(ident, request)
+
+    ######################################################
+
+    def refuse_request(self, ident, params, reason):
+        self.log.warning("%s refused (%s) ident=%r obj=%r method=%r" %
+                          (params["command"], reason, ident,
+                          params["object"], params["method"]))
+        if params["command"] == "call":
+            # the client would wait for the reply forever
+            self.send_exception(ident, params["req_id"],
+                                ServerBusyError(reason),
+                                params.get("serializer"))
+
+    ######################################################
+
+    def get_stats(self):
+        """
+        :return: :class:`snakemq.workers.WorkersStats` of the calls
+        """
+        return self.pool.get_stats()
+
+    ######################################################
+
+    def shutdown(self):
+        """
+        Stop worker threads. Already received calls are finished.
+        """
+        self.pool.shutdown()
 
     ######################################################
 
@@ -182,16 +591,18 @@ class RpcServer(object):
 
             # signals have no return value
             if is_call:
-                self.send_return(ident, params["req_id"], ret)
+                self.send_return(ident, params["req_id"], ret,
+                                  params.get("serializer"))
         except Exception as exc:
             if self.transfer_exceptions and transfer_exception:
-                self.send_exception(ident, params["req_id"], exc)
+                self.send_exception(ident, params["req_id"], exc,
+                                    params.get("serializer"))
             else:
                 raise
 
     ######################################################
 
-    def send_exception(self, ident, req_id, exc):
+    def send_exception(self, ident, req_id, exc, serializer_id=None):
         if __debug__:
             self.log.debug("send_exception ident=%r" % ident)
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -203,26 +614,32 @@ class RpcServer(object):
         data = {"req_id": req_id, "ok": False,
                 "exception": exc, "exception_format": exc_format}
         try:
-            self.send(ident, data)
+            self.send(ident, data, serializer_id)
         except self.pickler.PickleError:
             # raise the original exception and not the pickler's
             raise exc
 
     ######################################################
 
-    def send_return(self, ident, req_id, res):
+    def send_return(self, ident, req_id, res, serializer_id=None):
         if __debug__:
             self.log.debug("send_return ident=%r req_id=%r" % (ident, b2a_hex(req_id)))
         data = {"ok": True, "return": res, "req_id": req_id}
-        self.send(ident, data)
+        self.send(ident, data, serializer_id)
 
     ######################################################
 
-    def send(self, ident, data):
+    def send(self, ident, data, serializer_id=None):
+        """
+        :param serializer_id: serializer of the request
+        """
         try:
-            data = self.pickler.dumps(data)
-        except TypeError as exc:
-            # TypeError is raised if the object is unpickable
+            data = self.envelope.encode_reply(data, serializer_id)
+        except self.pickler.PickleError:
+            raise
+        except (TypeError, ValueError) as exc:
+            # TypeError is raised if the object is unpickable, ValueError
+            # by marshal
             raise self.pickler.PickleError(exc)
         message = Message(data=REPLY_PREFIX + data)
         self.receive_hook.messaging.send_message(ident, message)
@@ -241,21 +658,26 @@ class RemoteMethod(object):
 
     ######################################################
 
-    def __call__(self, *args, **kwargs):
+    def make_params(self, args, kwargs):
         # pylint: disable=W0212
         if self.signal_timeout is None:
             command = "call"
         else:
             command = "signal"
+        return {
+              "command": command,
+              "object": self.iproxy._name,
+              "method": self.name,
+              "args": args,
+              "kwargs": kwargs
+            }
 
+    ######################################################
+
+    def __call__(self, *args, **kwargs):
+        # pylint: disable=W0212
         try:
-            params = {
-                  "command": command,
-                  "object": self.iproxy._name,
-                  "method": self.name,
-                  "args": args,
-                  "kwargs": kwargs
-                }
+            params = self.make_params(args, kwargs)
             ident = self.iproxy._remote_ident
             return self.iproxy._client.remote_request(ident, self, params)
         except CallError:
@@ -269,6 +691,23 @@ class RemoteMethod(object):
 
     ######################################################
 
+    def call_async(self, *args, **kwargs):
+        """
+        Non-blocking call. The request is sent as soon as the peer is
+        connected (and sent again after reconnection until it is replied).
+        Many calls can be in flight at once. :attr:`call_timeout` is not
+        applied, use ``future.result(timeout)`` and ``future.cancel()``.
+
+        :return: :class:`concurrent.futures.Future` of the result, signals
+                 return a future completed with None
+        """
+        # pylint: disable=W0212
+        params = self.make_params(args, kwargs)
+        ident = self.iproxy._remote_ident
+        return self.iproxy._client.remote_request_async(ident, self, params)
+
+    ######################################################
+
     def as_signal(self, timeout=0):
         """
         Mark the method as a signal method and set timeout. Setting timeout
@@ -327,96 +766,237 @@ class RpcInstProxy(object):
 #########################################################################
 #########################################################################
 
+class PendingCall(object):
+    """
+    Regular call waiting for its result. Only its own reply and connection
+    changes of its peer wake it up.
+    """
+
+    def __init__(self, lock, remote_ident, req_id, params=None, future=None):
+        """
+        :param params: request of an asynchronous call
+        :param future: future of an asynchronous call
+        """
+        self.cond = threading.Condition(lock)
+        self.remote_ident = remote_ident
+        self.req_id = req_id
+        self.params = params
+        self.future = future
+        self.result = None
+
+    def wait(self, timeout=None):
+        self.cond.wait(timeout)
+
+    def notify(self):
+        self.cond.notify()
+
+#########################################################################
+#########################################################################
+
 class Wait(object):
     # helper for condition.wait() with reducing timeout
     # raises exception if the timeout is exceeded
 
-    def __init__(self, client, timeout, remote_ident, req_id):
-        self.client = client
+    def __init__(self, pending, timeout):
+        self.pending = pending
         self.timeout = timeout
-        self.remote_ident = remote_ident
-        self.req_id = req_id
 
     def __call__(self, exc):
         if self.timeout is None:
-            self.client.cond.wait()
+            self.pending.wait()
         else:
             assert self.timeout > 0
             start_time = get_time()
-            self.client.cond.wait(self.timeout)
+            self.pending.wait(self.timeout)
             self.timeout -= get_time() - start_time
             if self.timeout <= 0:
-                self.client.waiting_for_result.discard(self.req_id)
                 raise exc
 
 #########################################################################
 #########################################################################
 
 class RpcClient(object):
-    def __init__(self, receive_hook, pickler=pickle):
+    def __init__(self, receive_hook, pickler=pickle, serializer=None):
+        """
+        :param serializer: :class:`snakemq.serializers.Serializer` of call
+                           arguments and return values, None = pickle
+
+        Without the serializer requests are sent in the format of older
+        versions until the peer replies in the binary envelope (or announces
+        it in its reply). With the serializer the peer must understand the
+        binary envelope.
+        """
         self.log = logging.getLogger("snakemq.rpc.client")
         self.receive_hook = receive_hook
         self.pickler = pickler
+        self.envelope = Envelope(pickler, serializer)
         self.method_proxies = {}
         self.exception_handler = None
-        self.results = {}  #: req_id: result
-        self.waiting_for_result = set()  # req_ids
+        self.pending = {}  #: req_id:PendingCall
+        self.pending_by_ident = {}  #: remote_ident:set of PendingCall
         self.lock = threading.Lock()
-        self.cond = threading.Condition(self.lock)
         self.connected = {}  #: remote_ident:bool
+        #: per-thread list of (remote_ident, batched requests)
+        self.batches = threading.local()
+        self.always_envelope = serializer is not None
+        #: idents of peers which understand the binary envelope
+        self.envelope_peers = set()
+        self.name_ids = {}  #: remote_ident:NameIds
+        #: message uuid:(NameIds, IDs defined by the message)
+        self.definitions = {}
 
         receive_hook.register(REPLY_PREFIX, self.on_recv)
-        receive_hook.messaging.on_connect.add(self.on_connect)
-        receive_hook.messaging.on_disconnect.add(self.on_disconnect)
+        messaging = receive_hook.messaging
+        messaging.on_connect.add(self.on_connect)
+        messaging.on_disconnect.add(self.on_disconnect)
+        messaging.on_message_sent.add(self.on_message_sent)
+        messaging.on_message_drop.add(self.on_message_drop)
 
     ######################################################
 
     def send_params(self, remote_ident, params, ttl):
-        raw = self.pickler.dumps(params)
-        message = Message(data=REQUEST_PREFIX + raw, ttl=ttl)
+        """
+        Must be called with the lock held, the interned names are shared
+        with the link thread.
+        """
+        if not (self.always_envelope or (remote_ident in self.envelope_peers)):
+            self.send_legacy_params(remote_ident, params, ttl)
+            return
+        names = self.name_ids.get(remote_ident)
+        if names is None:
+            names = self.name_ids[remote_ident] = NameIds()
+        defined = set()
+        message = Message(data=self.envelope.encode_request(params, names,
+                                                   defined, REQUEST_PREFIX),
+                          ttl=ttl)
+        if defined:
+            self.definitions[message.uuid] = (names, defined)
+        self.receive_hook.messaging.send_message(remote_ident, message)
+
+    ######################################################
+
+    def send_legacy_params(self, remote_ident, params, ttl):
+        """
+        Pickled dict understood by older versions.
+        """
+        if params["command"] == "batch":
+            for request in params["requests"]:
+                self.send_legacy_params(remote_ident, request, ttl)
+            return
+        message = Message(data=REQUEST_PREFIX + self.pickler.dumps(params),
+                          ttl=ttl)
         self.receive_hook.messaging.send_message(remote_ident, message)
 
     ######################################################
 
+    def on_message_sent(self, dummy_conn_id, dummy_ident, message_uuid):
+        with self.lock:
+            definition = self.definitions.pop(message_uuid, None)
+            if definition is not None:
+                # the peer gets the names before any later message
+                names, defined = definition
+                names.known.update(defined)
+
+    ######################################################
+
+    def on_message_drop(self, dummy_ident, message_uuid):
+        # called with the messaging lock held which is taken by
+        # send_params() under self.lock, a lost definition just means
+        # the names are sent again
+        self.definitions.pop(message_uuid, None)
+
+    ######################################################
+
+    def add_pending(self, pending):
+        self.pending[pending.req_id] = pending
+        self.pending_by_ident.setdefault(pending.remote_ident,
+                                          set()).add(pending)
+
+    ######################################################
+
+    def remove_pending(self, pending):
+        del self.pending[pending.req_id]
+        by_ident = self.pending_by_ident[pending.remote_ident]
+        by_ident.remove(pending)
+        if not by_ident:
+            del self.pending_by_ident[pending.remote_ident]
+
+    ######################################################
+
     def store_result(self, result):
-        req_id = result["req_id"]
-        try:
-            self.waiting_for_result.remove(req_id)
-        except KeyError:
+        """
+        :return: finished asynchronous PendingCall or None
+        """
+        pending = self.pending.get(result["req_id"])
+        if pending is None:
             # this result is no longer needed
-            pass
+            return None
+        pending.result = result
+        if pending.future is None:
+            pending.notify()
+            return None
+        self.remove_pending(pending)
+        return pending
+
+    ######################################################
+
+    def complete_future(self, pending):
+        """
+        Must be called without the lock held, future callbacks are called
+        right away.
+        """
+        future = pending.future
+        if not future.set_running_or_notify_cancel():
+            return
+        res = pending.result
+        if res["ok"]:
+            future.set_result(res["return"])
         else:
-            self.results[req_id] = result
+            exc = res["exception"]
+            setattr(exc, REMOTE_TRACEBACK_ATTR, res["exception_format"])
+            future.set_exception(exc)
 
     ######################################################
 
-    def get_result(self, req_id):
-        assert req_id not in self.waiting_for_result
-        return self.results.pop(req_id)
+    def notify_ident(self, ident):
+        for pending in self.pending_by_ident.get(ident, ()):
+            pending.notify()
 
     ######################################################
 
     def on_connect(self, dummy_conn_id, ident):
-        with self.cond:
+        with self.lock:
             self.connected[ident] = True
-            self.cond.notify_all()
+            self.notify_ident(ident)
+            # (re)send asynchronous calls
+            for pending in list(self.pending_by_ident.get(ident, ())):
+                if pending.params is not None:
+                    self.send_params(ident, pending.params, 0)
 
     ######################################################
 
     def on_disconnect(self, dummy_conn_id, ident):
-        with self.cond:
+        with self.lock:
             self.connected[ident] = False
-            self.cond.notify_all()
+            self.notify_ident(ident)
+            # the peer might be restarted (and even downgraded), interned
+            # calls are not resent because calls have zero TTL and
+            # asynchronous calls are encoded again after the reconnection
+            self.name_ids.pop(ident, None)
+            self.envelope_peers.discard(ident)
 
     ######################################################
 
-    def on_recv(self, dummy_conn_id, dummy_ident, message):
-        res = self.pickler.loads(message.data[len(REPLY_PREFIX):])
+    def on_recv(self, dummy_conn_id, ident, message):
+        res = self.envelope.decode_reply(message.data, len(REPLY_PREFIX))
         if __debug__:
             self.log.debug("reply req_id=%r" % b2a_hex(res["req_id"]))
-        with self.cond:
-            self.store_result(res)
-            self.cond.notify_all()
+        with self.lock:
+            if res.pop("envelope", None) == ENVELOPE_VERSION:
+                self.envelope_peers.add(ident)
+            pending = self.store_result(res)
+        if pending is not None:
+            self.complete_future(pending)
 
     ######################################################
 
@@ -426,34 +1006,41 @@ class RpcClient(object):
             req_id = bytes(uuid.uuid4().bytes)
             params["req_id"] = req_id
 
+        # the reply would never come without sending the batch
+        self.flush_batch(remote_ident)
+
         if __debug__:
             self.log.debug("call_regular ident=%r obj=%r method=%r req_id=%s" %
                 (remote_ident, params["object"], params["method"],
                 b2a_hex(req_id)))
 
-        wait = Wait(self, method.call_timeout, remote_ident, req_id)
+        pending = PendingCall(self.lock, remote_ident, req_id)
+        wait = Wait(pending, method.call_timeout)
 
         # repeat request until it is replied
-        with self.cond:
-            while True:
-                # TODO check also message send failure (disconnect before msg dispatch)
-                # for both with-timeout and without-timeout calls
-                if self.connected.get(remote_ident):
-                    self.waiting_for_result.add(req_id)
-                    self.send_params(remote_ident, params, 0)
-                    while ((req_id not in self.results) and
-                              self.connected.get(remote_ident)):
-                        wait(PartialCall)
-
-                if self.connected.get(remote_ident):
-                    res = self.get_result(req_id)
-                    break
-                else:
-                    # "if" for this "else" serves 2 purposes
-                    # - if the first "if" in the loop fails then this will
-                    #   fail as well - peer is not connected, nothing was sent
-                    # - if params were sent and then peer disconnected
-                    wait(NotConnected)  # for signal from connect/di
+        with self.lock:
+            self.add_pending(pending)
+            try:
+                while True:
+                    # TODO check also message send failure (disconnect before msg dispatch)
+                    # for both with-timeout and without-timeout calls
+                    if self.connected.get(remote_ident):
+                        self.send_params(remote_ident, params, 0)
+                        while ((pending.result is None) and
+                                  self.connected.get(remote_ident)):
+                            wait(PartialCall)
+
+                    if pending.result is not None:
+                        res = pending.result
+                        break
+                    else:
+                        # "if" for this "else" serves 2 purposes
+                        # - if the first "if" in the loop fails then this will
+                        #   fail as well - peer is not connected, nothing was sent
+                        # - if params were sent and then peer disconnected
+                        wait(NotConnected)  # for signal from connect/di
+            finally:
+                self.remove_pending(pending)
 
         if res["ok"]:
             return res["return"]
@@ -467,7 +1054,87 @@ class RpcClient(object):
         if __debug__:
             self.log.debug("call_signal ident=%r obj=%r method=%r" %
                 (remote_ident, params["object"], params["method"]))
-        self.send_params(remote_ident, params, method.signal_timeout)
+        with self.lock:
+            self.send_params(remote_ident, params, method.signal_timeout)
+
+    ######################################################
+
+    def call_async(self, remote_ident, method, params):
+        req_id = bytes(uuid.uuid4().bytes)
+        params["req_id"] = req_id
+
+        if __debug__:
+            self.log.debug("call_async ident=%r obj=%r method=%r req_id=%s" %
+                (remote_ident, params["object"], params["method"],
+                b2a_hex(req_id)))
+
+        future = Future()
+        pending = PendingCall(self.lock, remote_ident, req_id, params, future)
+        with self.lock:
+            self.add_pending(pending)
+            if self.connected.get(remote_ident):
+                stack = getattr(self.batches, "stack", None)
+                if stack and (stack[-1][0] == remote_ident):
+                    stack[-1][1].append(params)
+                else:
+                    self.send_params(remote_ident, params, 0)
+        future.add_done_callback(
+                  lambda future: self.on_future_done(pending))
+        return future
+
+    ######################################################
+
+    def on_future_done(self, pending):
+        if pending.future.cancelled():
+            with self.lock:
+                if self.pending.get(pending.req_id) is pending:
+                    self.remove_pending(pending)
+
+    ######################################################
+
+    def remote_request_async(self, remote_ident, method, params):
+        if Future is None:
+            raise RuntimeError("concurrent.futures is not available")
+        if method.signal_timeout is None:
+            return self.call_async(remote_ident, method, params)
+        else:
+            self.call_signal(remote_ident, method, params)
+            future = Future()
+            future.set_result(None)
+            return future
+
+    ######################################################
+
+    @contextmanager
+    def batch(self, remote_ident):
+        """
+        Context manager. Asynchronous calls to the peer made by this thread
+        in the block are sent in a single message at the end of the block::
+
+            with client.batch("peer"):
+                futures = [proxy.method.call_async(i) for i in range(100)]
+        """
+        stack = getattr(self.batches, "stack", None)
+        if stack is None:
+            stack = self.batches.stack = []
+        stack.append((remote_ident, []))
+        try:
+            yield
+        finally:
+            self.flush_batch(remote_ident)
+            stack.pop()
+
+    ######################################################
+
+    def flush_batch(self, remote_ident):
+        stack = getattr(self.batches, "stack", None)
+        if not stack or (stack[-1][0] != remote_ident) or not stack[-1][1]:
+            return
+        requests = stack[-1][1][:]
+        del stack[-1][1][:]
+        with self.lock:
+            self.send_params(remote_ident,
+                              {"command": "batch", "requests": requests}, 0)
 
     ######################################################
 
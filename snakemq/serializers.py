@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Serializers of RPC arguments and return values. Every serializer has a
+unique ID which is sent along with the data so the peer knows how to decode
+it.
+
+:author: David Siroky (siroky@dasir.cz)
+:license: MIT License (see LICENSE.txt)
+"""
+
+import pickle
+import marshal
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+###########################################################################
+###########################################################################
+
+SERIALIZER_PICKLE = 1
+SERIALIZER_MARSHAL = 2
+SERIALIZER_MSGPACK = 3
+SERIALIZER_PICKLE_OOB = 4
+
+HAS_PICKLE_OOB = pickle.HIGHEST_PROTOCOL >= 5
+
+# count of out-of-band buffers, sizes of the buffers
+OOB_COUNT_FORMAT = "!I"
+OOB_COUNT_SIZE = struct.calcsize(OOB_COUNT_FORMAT)
+OOB_SIZE_FORMAT = "!Q"
+OOB_SIZE_SIZE = struct.calcsize(OOB_SIZE_FORMAT)
+
+###########################################################################
+###########################################################################
+
+class Serializer(object):
+    #: unique ID of the serializer (0-255)
+    id = None
+
+    def dumps(self, obj):
+        """
+        :return: bytes
+        """
+        raise NotImplementedError
+
+    def loads(self, data):
+        """
+        :param data: bytes or memoryview
+        """
+        raise NotImplementedError
+
+###########################################################################
+###########################################################################
+
+class PickleSerializer(Serializer):
+    id = SERIALIZER_PICKLE
+
+    def __init__(self, pickler=pickle, protocol=None):
+        """
+        :param pickler: module with ``dumps()`` and ``loads()``
+        :param protocol: None = pickler's default
+        """
+        self.pickler = pickler
+        self.protocol = protocol
+        # no wrapper call for the most common case
+        if protocol is None:
+            self.dumps = pickler.dumps
+        self.loads = pickler.loads
+
+    def dumps(self, obj):
+        return self.pickler.dumps(obj, self.protocol)
+
+    def loads(self, data):
+        return self.pickler.loads(data)
+
+###########################################################################
+###########################################################################
+
+class PickleOutOfBandSerializer(Serializer):
+    """
+    Pickle protocol 5. Large buffers (e.g. bytearrays, numpy arrays) are
+    not copied into the pickle stream, they are appended after it and
+    unpickled from the received data without copying.
+    """
+    id = SERIALIZER_PICKLE_OOB
+
+    def __init__(self):
+        if not HAS_PICKLE_OOB:
+            raise RuntimeError("pickle protocol 5 is not available")
+
+    def dumps(self, obj):
+        buffers = []
+        main = pickle.dumps(obj, 5, buffer_callback=buffers.append)
+        raws = [buf.raw() for buf in buffers]
+        header = [struct.pack(OOB_COUNT_FORMAT, len(raws))]
+        header.extend(struct.pack(OOB_SIZE_FORMAT, raw.nbytes)
+                      for raw in raws)
+        header.append(struct.pack(OOB_SIZE_FORMAT, len(main)))
+        return b"".join(header + [main] + raws)
+
+    def loads(self, data):
+        view = memoryview(data)
+        count = struct.unpack_from(OOB_COUNT_FORMAT, view)[0]
+        offset = OOB_COUNT_SIZE
+        sizes = []
+        for _ in range(count + 1):
+            sizes.append(struct.unpack_from(OOB_SIZE_FORMAT, view, offset)[0])
+            offset += OOB_SIZE_SIZE
+        main_size = sizes.pop()
+        main = view[offset:offset + main_size]
+        offset += main_size
+        buffers = []
+        for size in sizes:
+            buffers.append(view[offset:offset + size])
+            offset += size
+        return pickle.loads(main, buffers=buffers)
+
+###########################################################################
+###########################################################################
+
+class MarshalSerializer(Serializer):
+    """
+    Fast but only for builtin types. The peer must run the same Python
+    version.
+    """
+    id = SERIALIZER_MARSHAL
+
+    def dumps(self, obj):
+        return marshal.dumps(obj)
+
+    def loads(self, data):
+        return marshal.loads(bytes(data))
+
+###########################################################################
+###########################################################################
+
+class MsgpackSerializer(Serializer):
+    """
+    Needs the ``msgpack`` package. Tuples are decoded as lists.
+    """
+    id = SERIALIZER_MSGPACK
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not available")
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+###########################################################################
+###########################################################################
+
+def default_serializers(pickler=pickle):
+    """
+    :return: dict of all available serializers, id:Serializer
+    """
+    serializers = [PickleSerializer(pickler), MarshalSerializer()]
+    if HAS_PICKLE_OOB:
+        serializers.append(PickleOutOfBandSerializer())
+    if msgpack is not None:
+        serializers.append(MsgpackSerializer())
+    return dict((serializer.id, serializer) for serializer in serializers)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Link with connections spread across several event loop threads.
+
+:author: David Siroky (siroky@dasir.cz)
+:license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import threading
+import logging
+
+try:
+    from multiprocessing import cpu_count
+except ImportError:
+    cpu_count = lambda: 1
+
+from snakemq.link import Link, POLL_TIMEOUT, resolve_address
+
+############################################################################
+############################################################################
+
+SHARD_JOIN_TIMEOUT = 5.0
+
+############################################################################
+############################################################################
+
+class LinkShard(Link):
+    """
+    Link running in its own thread. Other threads must not touch it directly,
+    they :meth:`post` calls into its loop. Callbacks are forwarded to the
+    owner.
+    """
+
+    def __init__(self, index, owner):
+        """
+        :param index: shard index
+        :param owner: :class:`ShardedLink`
+        """
+        Link.__init__(self)
+        self.log = logging.getLogger("snakemq.link.shard%i" % index)
+        self.index = index
+        self.owner = owner
+        self.thread = None
+        self._posted = []  #: (func, args)
+        self._posted_lock = threading.Lock()
+
+        self.on_connect.add(self._on_connect)
+        self.on_disconnect.add(self._on_disconnect)
+        self.on_recv.add(self._on_recv)
+        self.on_ready_to_send.add(self._on_ready_to_send)
+        self.on_loop_pass.add(self.run_posted)
+
+    ##########################################################
+
+    def post(self, func, *args):
+        """
+        Call ``func(*args)`` in the shard's loop. Thread-safe.
+        """
+        with self._posted_lock:
+            self._posted.append((func, args))
+        self.wakeup_poll()
+
+    ##########################################################
+
+    def run_posted(self):
+        with self._posted_lock:
+            if not self._posted:
+                return
+            posted = self._posted
+            self._posted = []
+        for func, args in posted:
+            func(*args)
+
+    ##########################################################
+
+    def start(self, poll_timeout=POLL_TIMEOUT):
+        self.thread = threading.Thread(target=self.loop, args=[poll_timeout],
+                                        name="snakemq_shard_%i" % self.index)
+        self.thread.daemon = True
+        self.thread.start()
+
+    ##########################################################
+
+    def join(self):
+        """
+        Stop the loop and wait for the thread.
+        """
+        if self.thread is None:
+            return
+        self.post(self.stop)
+        self.thread.join(SHARD_JOIN_TIMEOUT)
+        self.thread = None
+
+    ##########################################################
+
+    def new_connection_id(self, sock):
+        # unique across all shards of the owner
+        self._new_conn_id += 1
+        conn_id = "%ifd%is%i" % (self._new_conn_id, sock.fileno(), self.index)
+        sock.conn_id = conn_id
+        self._sock_by_conn[conn_id] = sock
+        return conn_id
+
+    ##########################################################
+
+    def send_posted(self, conn_id, data):
+        # the connection might have been closed before the post was executed
+        if conn_id in self._sock_by_conn:
+            self.send(conn_id, data)
+
+    ##########################################################
+
+    def close_posted(self, conn_id):
+        if conn_id in self._sock_by_conn:
+            self.close(conn_id)
+
+    ##########################################################
+
+    def _on_connect(self, conn_id):
+        self.owner.post_event(self.owner.handle_shard_connect, self, conn_id)
+
+    def _on_disconnect(self, conn_id):
+        self.owner.post_event(self.owner.handle_shard_disconnect, conn_id)
+
+    def _on_recv(self, conn_id, data):
+        self.owner.post_event(self.owner.on_recv, conn_id, data)
+
+    def _on_ready_to_send(self, conn_id, last_send_size):
+        self.owner.post_event(self.owner.on_ready_to_send, conn_id,
+                              last_send_size)
+
+############################################################################
+############################################################################
+
+class ShardedLink(Link):
+    """
+    Drop-in replacement of :class:`~snakemq.link.Link`. Listeners are handled
+    by the main loop (the thread calling :meth:`loop`), accepted connections
+    and connectors are handed over to the least loaded shard. Every shard has
+    its own poller and thread. All callbacks are called from the main loop so
+    the layers above need no changes.
+
+    Shards are started by the first :meth:`loop` call and they run until
+    :meth:`cleanup`.
+    """
+
+    def __init__(self, shards=None):
+        """
+        :param shards: count of shard threads, None = count of CPUs
+        """
+        Link.__init__(self)
+        self.shards = [LinkShard(i, self) for i in range(shards or cpu_count())]
+        self._events = []  #: (func, args)
+        self._events_lock = threading.Lock()
+        self._shard_by_conn = {}
+        self._connector_shards = {}  #: address:shard
+
+    ##########################################################
+
+    def cleanup(self):
+        for shard in self.shards:
+            shard.join()
+        for address in list(self._connector_shards.keys()):
+            self.del_connector(address)
+        for shard in self.shards:
+            shard.run_posted()
+            shard.cleanup()
+        self.dispatch_events()  # the last on_disconnect calls
+        Link.cleanup(self)
+        assert len(self._shard_by_conn) == 0
+
+    ##########################################################
+
+    def select_shard(self):
+        """
+        :return: shard with the least count of connections and connectors
+        """
+        # len() of containers owned by another thread is good enough for
+        # balancing, posted calls count in not yet added connections
+        return min(self.shards,
+                    key=lambda shard: len(shard._sock_by_conn) +
+                                      len(shard._connectors) +
+                                      len(shard._posted))
+
+    ##########################################################
+
+    def add_connector(self, address, reconnect_interval=None, ssl_config=None):
+        address = resolve_address(address)
+        if address in self._connector_shards:
+            raise ValueError("connector '%r' already set", address)
+        shard = self.select_shard()
+        self._connector_shards[address] = shard
+        shard.post(shard.add_connector, address, reconnect_interval,
+                    ssl_config)
+        return address
+
+    ##########################################################
+
+    def del_connector(self, address):
+        shard = self._connector_shards.pop(address)
+        shard.post(shard.del_connector, address)
+
+    ##########################################################
+
+    def add_accepted(self, newsock, address):
+        shard = self.select_shard()
+        shard.post(shard.add_accepted, newsock, address)
+
+    ##########################################################
+
+    def send(self, conn_id, data):
+        shard = self._shard_by_conn.get(conn_id)
+        if shard is not None:
+            shard.post(shard.send_posted, conn_id, data)
+
+    ##########################################################
+
+    def close(self, conn_id):
+        shard = self._shard_by_conn.get(conn_id)
+        if shard is not None:
+            shard.post(shard.close_posted, conn_id)
+
+    ##########################################################
+
+    def loop(self, poll_timeout=POLL_TIMEOUT, count=None, runtime=None):
+        for shard in self.shards:
+            if shard.thread is None:
+                shard.start(poll_timeout)
+        Link.loop(self, poll_timeout, count, runtime)
+
+    ##########################################################
+
+    def get_socket_by_conn(self, conn):
+        """
+        :return: LinkSocket, it is owned by the shard's thread
+        """
+        return self._shard_by_conn[conn].get_socket_by_conn(conn)
+
+    ##########################################################
+
+    def post_event(self, func, *args):
+        """
+        Call ``func(*args)`` in the main loop. Called from shard threads.
+        """
+        with self._events_lock:
+            self._events.append((func, args))
+        self.wakeup_poll()
+
+    ##########################################################
+
+    def dispatch_events(self):
+        with self._events_lock:
+            if not self._events:
+                return
+            events = self._events
+            self._events = []
+        for func, args in events:
+            func(*args)
+
+    ##########################################################
+
+    def handle_shard_connect(self, shard, conn_id):
+        self._shard_by_conn[conn_id] = shard
+        self.on_connect(conn_id)
+
+    ##########################################################
+
+    def handle_shard_disconnect(self, conn_id):
+        self.on_disconnect(conn_id)
+        del self._shard_by_conn[conn_id]
+
+    ##########################################################
+
+    def poll(self, poll_timeout):
+        fds = Link.poll(self, poll_timeout)
+        self.dispatch_events()
+        return fds
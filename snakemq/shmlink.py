@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""
+Shared memory transport for peers on the same host.
+
+Every connection of the wrapped :class:`~snakemq.link.Link` (typically
+``"unix:..."`` addresses) carries just a handshake and doorbells. Data is
+exchanged through two ring buffers (one per direction) in a memory mapped
+file. The connector creates the file and sends its path
+``[4B magic|4B ring size|2B path length|path]``, the listener checks the file
+(a regular file of the connector's size owned by the same user), maps it,
+removes it and acknowledges by a doorbell. Disconnection of the link connection is the
+disconnection of the shared memory connection.
+
+:author: David Siroky (siroky@dasir.cz)
+:license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import os
+import stat
+import mmap
+import struct
+import tempfile
+import logging
+
+from snakemq.link import Link
+from snakemq.exceptions import SendNotFinished
+from snakemq.callbacks import Callback
+
+############################################################################
+############################################################################
+
+RING_SIZE = 4 * 1024 * 1024  #: default capacity of a ring in bytes
+MAX_RING_SIZE = 1024 * 1024 * 1024  #: accepted from the connector
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SHM_PREFIX = "snakemq_shm_"
+
+HELLO_MAGIC = b"SMQS"
+HELLO_HEADER = struct.Struct("!4sIH")
+DOORBELL = b"d"
+
+# head, tail and the waiting flag are in separate cache lines
+POSITION = struct.Struct("=Q")
+FLAG = struct.Struct("=I")
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+WAITING_OFFSET = 128
+RING_HEADER_SIZE = 192
+
+STATE_HELLO = 0  #: listener waits for the connector's hello
+STATE_ACK = 1  #: connector waits for the listener's acknowledgement
+STATE_READY = 2
+
+############################################################################
+############################################################################
+
+class ShmRing(object):
+    """
+    Single producer, single consumer byte ring. Positions are absolute
+    (never wrapped) counters of written and read bytes.
+    """
+
+    def __init__(self, mm, offset, size):
+        """
+        :param mm: mmap
+        :param offset: start of the ring in the map
+        :param size: size of the ring including its header
+        """
+        self.mm = mm
+        self.offset = offset
+        self.data_offset = offset + RING_HEADER_SIZE
+        self.capacity = size - RING_HEADER_SIZE
+
+    ##########################################################
+
+    def get_position(self, offset):
+        return POSITION.unpack_from(self.mm, self.offset + offset)[0]
+
+    def set_position(self, offset, value):
+        POSITION.pack_into(self.mm, self.offset + offset, value)
+
+    ##########################################################
+
+    @property
+    def writer_waiting(self):
+        return FLAG.unpack_from(self.mm, self.offset + WAITING_OFFSET)[0]
+
+    @writer_waiting.setter
+    def writer_waiting(self, value):
+        FLAG.pack_into(self.mm, self.offset + WAITING_OFFSET, int(value))
+
+    ##########################################################
+
+    def __len__(self):
+        """
+        :return: count of bytes ready to be read
+        """
+        return self.get_position(HEAD_OFFSET) - self.get_position(TAIL_OFFSET)
+
+    ##########################################################
+
+    def write(self, data):
+        """
+        :param data: bytes or list of bytes-like fragments
+        :return: count of written bytes (might be less than the data size)
+        """
+        head = self.get_position(HEAD_OFFSET)
+        free = self.capacity - (head - self.get_position(TAIL_OFFSET))
+        if not isinstance(data, list):
+            data = [data]
+        written = 0
+        for fragment in data:
+            size = min(len(fragment), free - written)
+            if size <= 0:
+                break
+            self.copy_in(head + written, memoryview(fragment)[:size])
+            written += size
+        if written:
+            # publish the data after it is copied
+            self.set_position(HEAD_OFFSET, head + written)
+        return written
+
+    ##########################################################
+
+    def copy_in(self, position, buf):
+        start = position % self.capacity
+        first = min(len(buf), self.capacity - start)
+        offset = self.data_offset + start
+        self.mm[offset:offset + first] = buf[:first]
+        if first < len(buf):
+            rest = len(buf) - first
+            self.mm[self.data_offset:self.data_offset + rest] = buf[first:]
+
+    ##########################################################
+
+    def read(self):
+        """
+        :return: all available bytes or None
+        """
+        tail = self.get_position(TAIL_OFFSET)
+        available = self.get_position(HEAD_OFFSET) - tail
+        if available == 0:
+            return None
+        start = tail % self.capacity
+        offset = self.data_offset + start
+        if start + available <= self.capacity:
+            data = self.mm[offset:offset + available]
+        else:
+            first = self.capacity - start
+            data = (self.mm[offset:offset + first] +
+                    self.mm[self.data_offset:
+                            self.data_offset + available - first])
+        self.set_position(TAIL_OFFSET, tail + available)
+        return data
+
+############################################################################
+############################################################################
+
+class ShmConnection(object):
+    def __init__(self, conn_id, state):
+        self.conn_id = conn_id
+        self.state = state
+        self.hello = b""  #: incomplete hello
+        self.path = None
+        self.mm = None
+        self.tx = None  #: ShmRing
+        self.rx = None  #: ShmRing
+        self.pending = None  #: data waiting for a free space in tx
+        self.link_send_in_progress = False
+        self.doorbell = False  #: doorbell waiting for the link send
+
+    ##########################################################
+
+    def map(self, fd, ring_size, is_connector):
+        self.mm = mmap.mmap(fd, ring_size * 2)
+        first = ShmRing(self.mm, 0, ring_size)
+        second = ShmRing(self.mm, ring_size, ring_size)
+        if is_connector:
+            self.tx, self.rx = first, second
+        else:
+            self.tx, self.rx = second, first
+
+    ##########################################################
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass  # already removed by the listener
+            self.path = None
+
+############################################################################
+############################################################################
+
+class ShmLink(object):
+    """
+    Drop-in replacement of :class:`~snakemq.link.Link` for
+    :class:`~snakemq.packeter.Packeter`. Both peers must use ``ShmLink``.
+    """
+
+    def __init__(self, link=None, ring_size=RING_SIZE):
+        """
+        :param link: :class:`~snakemq.link.Link` for handshakes and
+                     doorbells, a new one if None
+        :param ring_size: capacity of each ring in bytes (set by the
+                          connector)
+        """
+        self.link = link or Link()
+        self.ring_size = ring_size + RING_HEADER_SIZE
+        self.log = logging.getLogger("snakemq.shmlink")
+
+        #{ callbacks
+        self.on_connect = Callback()  #: ``func(conn_id)``
+        self.on_disconnect = Callback()  #: ``func(conn_id)``
+        self.on_recv = Callback()  #: ``func(conn_id, data)``
+        #: ``func(conn_id, last_send_size)``
+        self.on_ready_to_send = Callback()
+        self.on_loop_pass = Callback()  #: ``func()``
+        #}
+
+        # pass on the link's methods
+        self.add_connector = self.link.add_connector
+        self.del_connector = self.link.del_connector
+        self.add_listener = self.link.add_listener
+        self.del_listener = self.link.del_listener
+        self.wakeup_poll = self.link.wakeup_poll
+        self.loop = self.link.loop
+        self.stop = self.link.stop
+        self.cleanup = self.link.cleanup
+        self.get_socket_by_conn = self.link.get_socket_by_conn
+
+        self.connections = {}  #: conn_id:ShmConnection
+        self.to_confirm = []  #: (conn_id, written size)
+
+        self.link.on_connect.add(self._on_link_connect)
+        self.link.on_disconnect.add(self._on_link_disconnect)
+        self.link.on_recv.add(self._on_link_recv)
+        self.link.on_ready_to_send.add(self._on_link_ready_to_send)
+        self.link.on_loop_pass.add(self._on_link_loop_pass)
+
+    ##########################################################
+
+    def send(self, conn_id, data):
+        """
+        Copy as much data as possible to the shared memory. Wait for
+        :attr:`on_ready_to_send` before the next send.
+
+        :param data: bytes or list of bytes-like fragments
+        """
+        conn = self.connections[conn_id]
+        if conn.pending is not None:
+            raise SendNotFinished(("previous send on %r is not finished, " +
+                              "wait for on_ready_to_send") % conn_id)
+        self.write(conn, data)
+
+    ##########################################################
+
+    def close(self, conn_id):
+        self.link.close(conn_id)
+
+    ##########################################################
+    ##########################################################
+
+    def write(self, conn, data):
+        written = conn.tx.write(data)
+        if written:
+            conn.pending = None
+            self.to_confirm.append((conn.conn_id, written))
+            self.ring(conn)
+        else:
+            # the reader rings when it frees some space
+            conn.pending = data
+            conn.tx.writer_waiting = True
+
+    ##########################################################
+
+    def ring(self, conn):
+        if conn.link_send_in_progress:
+            conn.doorbell = True
+        else:
+            conn.doorbell = False
+            conn.link_send_in_progress = True
+            self.link.send(conn.conn_id, DOORBELL)
+
+    ##########################################################
+
+    def receive(self, conn):
+        data = conn.rx.read()
+        if data is None:
+            return
+        if conn.rx.writer_waiting:
+            conn.rx.writer_waiting = False
+            self.ring(conn)
+        self.on_recv(conn.conn_id, data)
+
+    ##########################################################
+
+    def _on_link_connect(self, conn_id):
+        if not self.link.get_socket_by_conn(conn_id).is_connector:
+            self.connections[conn_id] = ShmConnection(conn_id, STATE_HELLO)
+            return
+
+        conn = ShmConnection(conn_id, STATE_ACK)
+        fd, conn.path = tempfile.mkstemp(prefix=SHM_PREFIX, dir=SHM_DIR)
+        with os.fdopen(fd, "r+b") as fileobj:
+            fileobj.truncate(self.ring_size * 2)
+            conn.map(fileobj.fileno(), self.ring_size, True)
+        self.connections[conn_id] = conn
+        path = conn.path.encode("utf-8")
+        conn.link_send_in_progress = True
+        self.link.send(conn_id,
+                      HELLO_HEADER.pack(HELLO_MAGIC, self.ring_size,
+                                        len(path)) + path)
+
+    ##########################################################
+
+    def _on_link_disconnect(self, conn_id):
+        conn = self.connections.pop(conn_id, None)
+        if conn is None:
+            return
+        conn.close()
+        if conn.state == STATE_READY:
+            self.on_disconnect(conn_id)
+
+    ##########################################################
+
+    def map_peer_file(self, conn, path, ring_size):
+        """
+        Map the connector's file and remove it. The path is supplied by the
+        peer so symlinks and files of other users or sizes are refused.
+        """
+        if not RING_HEADER_SIZE < ring_size <= MAX_RING_SIZE:
+            raise ValueError("invalid ring size %i" % ring_size)
+        fd = os.open(path, os.O_RDWR | getattr(os, "O_NOFOLLOW", 0))
+        try:
+            fdstat = os.fstat(fd)
+            if not stat.S_ISREG(fdstat.st_mode):
+                raise ValueError("not a regular file")
+            if fdstat.st_uid != os.getuid():
+                raise ValueError("file owned by uid %i" % fdstat.st_uid)
+            if fdstat.st_size != ring_size * 2:
+                raise ValueError("file size %i, expected %i" %
+                                  (fdstat.st_size, ring_size * 2))
+            conn.map(fd, ring_size, False)
+        finally:
+            os.close(fd)
+        # the path might have been replaced meanwhile
+        pathstat = os.lstat(path)
+        if ((pathstat.st_dev, pathstat.st_ino) ==
+            (fdstat.st_dev, fdstat.st_ino)):
+            os.unlink(path)
+
+    ##########################################################
+
+    def parse_hello(self, conn, data):
+        conn.hello += data
+        if len(conn.hello) < HELLO_HEADER.size:
+            return
+        magic, ring_size, length = HELLO_HEADER.unpack_from(conn.hello)
+        if len(conn.hello) < HELLO_HEADER.size + length:
+            return
+        path = conn.hello[HELLO_HEADER.size:HELLO_HEADER.size + length]
+        try:
+            path = path.decode("utf-8")
+            if ((magic != HELLO_MAGIC) or
+                (os.path.dirname(path) != SHM_DIR) or
+                not os.path.basename(path).startswith(SHM_PREFIX)):
+                raise ValueError("invalid hello")
+            self.map_peer_file(conn, path, ring_size)
+        except (OSError, ValueError) as exc:
+            self.log.error("conn=%s shared memory refused: %r" %
+                            (conn.conn_id, exc))
+            self.link.close(conn.conn_id)
+            return
+        conn.hello = None
+        conn.state = STATE_READY
+        self.ring(conn)  # acknowledge
+        self.on_connect(conn.conn_id)
+
+    ##########################################################
+
+    def _on_link_recv(self, conn_id, data):
+        conn = self.connections[conn_id]
+        if conn.state == STATE_HELLO:
+            self.parse_hello(conn, data)
+        elif conn.state == STATE_ACK:
+            conn.state = STATE_READY
+            self.on_connect(conn_id)
+        # doorbells are served in the loop pass which follows the poll
+
+    ##########################################################
+
+    def _on_link_ready_to_send(self, conn_id, last_send_size):
+        conn = self.connections.get(conn_id)
+        if conn is None:
+            return
+        conn.link_send_in_progress = False
+        if conn.doorbell:
+            self.ring(conn)
+
+    ##########################################################
+
+    def _on_link_loop_pass(self):
+        self.on_loop_pass()
+        # rings are checked in every pass so a lost doorbell (or a missed
+        # waiting flag) costs at most a poll timeout
+        for conn in list(self.connections.values()):
+            if (conn.state == STATE_READY) and (conn.conn_id in self.connections):
+                self.receive(conn)
+                if (conn.pending is not None) and (conn.mm is not None):
+                    self.write(conn, conn.pending)
+
+        # one round per pass, other connections must not starve
+        to_confirm = self.to_confirm
+        self.to_confirm = []
+        for conn_id, written in to_confirm:
+            if conn_id in self.connections:
+                self.on_ready_to_send(conn_id, written)
+        if self.to_confirm:
+            self.link.wakeup_poll()
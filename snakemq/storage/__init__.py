@@ -27,6 +27,21 @@ class QueuesStorageBase(object):
         """
         raise NotImplementedError
 
+    def iter_items(self, queue_name):
+        """
+        Items of the queue present at the time of the call. Storages should
+        override this to load the items lazily.
+
+        :return: iterator
+        """
+        return iter(list(self.get_items(queue_name)))
+
+    def get_items_count(self, queue_name):
+        """
+        :return: count of items of the queue
+        """
+        return len(self.get_items(queue_name))
+
     def push(self, queue_name, item):
         raise NotImplementedError
 
@@ -42,6 +57,28 @@ class QueuesStorageBase(object):
     def update_items_ttl(self, items):
         raise NotImplementedError
 
+    def shift_items_ttl(self, queue_name, delta):
+        """
+        Decrease TTLs of all items of the queue by ``delta``. Items without
+        TTL are not changed. Storages should override this by a bulk update.
+
+        :return: items with TTL below 0 (they are not deleted)
+        """
+        items = [item for item in self.get_items(queue_name)
+                 if item.ttl is not None]
+        for item in items:
+            item.ttl -= delta
+        self.update_items_ttl(items)
+        return [item for item in items if item.ttl < 0]
+
+    def flush(self):
+        """
+        Make pending changes persistent. Called by the messaging at the end
+        of every link loop pass so the storage can group changes made in the
+        pass into a single transaction.
+        """
+        pass
+
 ###########################################################################
 ###########################################################################
 
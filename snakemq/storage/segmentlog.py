@@ -0,0 +1,658 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only segmented log queue storage. No external services are needed.
+
+Each queue has its own directory with segment files and an acknowledgement
+log. Items are appended to the active segment which is rolled when it
+reaches the size limit. Deletions and TTL updates are appended to the
+acknowledgement log as small records referring the item by its sequence
+number. Segments without live items are removed, segments with many dead
+items are rewritten by the compaction (at most once per
+``compact_interval``, it blocks the caller of :meth:`flush`). Segments opened by a running
+:meth:`~SegmentedLogQueuesStorage.iter_items` generator are not removed
+until the generator releases them and the queue is not compacted meanwhile
+(an open or mapped file can't be replaced or removed on Windows).
+
+Damaged records are skipped when the storage is loaded. Only an incomplete
+tail of the last segment (an interrupted write) is truncated, other damaged
+segments are logged and kept as they are.
+
+:author: David Siroky (siroky@dasir.cz)
+:license: MIT License (see LICENSE.txt)
+"""
+
+import os
+import mmap
+import struct
+import shutil
+import time
+import zlib
+import logging
+from binascii import b2a_hex, a2b_hex
+
+from snakemq.message import Message
+from snakemq.storage import QueuesStorageBase
+
+###########################################################################
+###########################################################################
+
+SYNC_ALWAYS = "always"  #: fsync after every change
+SYNC_FLUSH = "flush"  #: fsync in :meth:`flush` (once per link loop pass)
+SYNC_NEVER = "never"  #: leave it to the OS
+
+SEGMENT_SIZE = 64 * 1024 * 1024  #: roll segments bigger than this
+#: compact queues with at least this count of dead items...
+COMPACT_MIN_DEAD = 1024
+#: ...and more dead items than live items times this ratio
+COMPACT_RATIO = 1.0
+COMPACT_INTERVAL = 60.0  #: seconds between compactions done by flush()
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+SEGMENT_SUFFIX = ".seg"
+ACKS_FILENAME = "acks.log"
+
+# crc32, seq, data length, flags, uuid length, ttl (NaN = None)
+ITEM_HEADER_FORMAT = "!IQIIBd"
+ITEM_HEADER_SIZE = struct.calcsize(ITEM_HEADER_FORMAT)
+# crc32, type, seq, ttl
+ACK_FORMAT = "!IBQd"
+ACK_SIZE = struct.calcsize(ACK_FORMAT)
+
+ACK_TYPE_DELETE = 1
+ACK_TYPE_TTL = 2
+
+###########################################################################
+###########################################################################
+
+def encode_ttl(ttl):
+    return float("nan") if ttl is None else ttl
+
+def decode_ttl(ttl):
+    return None if ttl != ttl else ttl
+
+###########################################################################
+###########################################################################
+
+def pack_item(seq, item):
+    body = struct.pack(ITEM_HEADER_FORMAT[:1] + ITEM_HEADER_FORMAT[2:],
+                        seq, len(item.data), item.flags, len(item.uuid),
+                        encode_ttl(item.ttl))
+    body += item.uuid + item.data
+    return struct.pack("!I", zlib.crc32(body) & 0xffffffff) + body
+
+###########################################################################
+
+def iter_records(buf, size, damaged=None):
+    """
+    Walk through item records in the buffer. Records with a wrong checksum
+    are skipped. Stops at an incomplete record.
+
+    :param damaged: list, offsets of skipped records are appended
+    :return: generator of (offset, seq, flags, ttl, uuid slice, data slice)
+    """
+    offset = 0
+    while offset + ITEM_HEADER_SIZE <= size:
+        crc, seq, data_len, flags, uuid_len, ttl = \
+                  struct.unpack_from(ITEM_HEADER_FORMAT, buf, offset)
+        uuid_start = offset + ITEM_HEADER_SIZE
+        end = uuid_start + uuid_len + data_len
+        if end > size:
+            break
+        if zlib.crc32(buf[offset + 4:end]) & 0xffffffff != crc:
+            if damaged is not None:
+                damaged.append(offset)
+            offset = end
+            continue
+        yield (offset, seq, flags, ttl,
+                slice(uuid_start, uuid_start + uuid_len),
+                slice(uuid_start + uuid_len, end))
+        offset = end
+
+###########################################################################
+###########################################################################
+
+class Segment(object):
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        self.size = 0  #: valid bytes
+        self.total = 0  #: count of all items
+        self.live = 0  #: count of not deleted items
+        self.readers = 0  #: count of generators having the file open
+        self.removed = False  #: the file is removed after the last reader
+        #: the file has an unreadable part, it is never rewritten or removed
+        self.damaged = False
+
+###########################################################################
+###########################################################################
+
+class SegmentedQueue(object):
+    """
+    Files of a single queue.
+    """
+    def __init__(self, storage, name, directory):
+        self.storage = storage
+        self.name = name
+        self.directory = directory
+        self.segments = []  #: ordered Segments
+        self.live = {}  #: seq:(uuid, Segment) of live items
+        self.ttls = {}  #: seq:ttl updated by the acknowledgement log
+        self.acks_count = 0
+        self.active_file = None
+        self.acks_file = None
+        #: number of the next segment, files of removed segments might
+        #: still exist
+        self.next_number = 0
+        #: removed segments with readers, the file is not deleted yet
+        self.pending_removal = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.load()
+
+    ####################################################
+
+    def load(self):
+        """
+        Read the acknowledgement log and scan segments.
+        """
+        deleted = set()
+        acks_path = os.path.join(self.directory, ACKS_FILENAME)
+        if os.path.isfile(acks_path):
+            with open(acks_path, "rb") as f:
+                data = f.read()
+            valid_size = len(data) - len(data) % ACK_SIZE
+            damaged = 0
+            for offset in range(0, valid_size, ACK_SIZE):
+                crc, ack_type, seq, ttl = struct.unpack_from(ACK_FORMAT,
+                                                            data, offset)
+                body = data[offset + 4:offset + ACK_SIZE]
+                if zlib.crc32(body) & 0xffffffff != crc:
+                    damaged += 1
+                    continue
+                self.storage.seen_seq(seq)
+                if ack_type == ACK_TYPE_DELETE:
+                    deleted.add(seq)
+                    self.ttls.pop(seq, None)
+                elif ack_type == ACK_TYPE_TTL:
+                    self.ttls[seq] = decode_ttl(ttl)
+            self.acks_count = valid_size // ACK_SIZE
+            if damaged:
+                self.storage.log.error("queue %r: %i damaged acks skipped" %
+                                        (self.name, damaged))
+            if valid_size < len(data):
+                truncate_file(acks_path, valid_size)
+
+        filenames = sorted(fn for fn in os.listdir(self.directory)
+                            if fn.endswith(SEGMENT_SUFFIX))
+        for i, filename in enumerate(filenames):
+            number = int(filename[:-len(SEGMENT_SUFFIX)], 16)
+            self.next_number = max(self.next_number, number + 1)
+            segment = Segment(number, os.path.join(self.directory, filename))
+            self.scan_segment(segment, deleted, i == len(filenames) - 1)
+            if segment.live or segment.damaged:
+                self.segments.append(segment)
+            else:
+                os.unlink(segment.path)
+
+        for seq in list(self.ttls):
+            if seq not in self.live:
+                del self.ttls[seq]
+
+    ####################################################
+
+    def scan_segment(self, segment, deleted, last):
+        """
+        :param last: the last segment, an incomplete write is truncated
+        """
+        file_size = os.path.getsize(segment.path)
+        damaged = []
+        if file_size:
+            with open(segment.path, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for record in iter_records(buf, file_size, damaged):
+                        offset, seq, _, _, uuid_slice, data_slice = record
+                        segment.size = data_slice.stop
+                        segment.total += 1
+                        self.storage.seen_seq(seq)
+                        if seq not in deleted:
+                            uuid = buf[uuid_slice]
+                            segment.live += 1
+                            self.live[seq] = (uuid, segment)
+                            self.storage.index[uuid] = (self, seq)
+                finally:
+                    buf.close()
+        if damaged:
+            self.storage.log.error("%s: %i damaged records skipped" %
+                                    (segment.path, len(damaged)))
+        if segment.size < file_size:
+            if last:
+                # incomplete write
+                truncate_file(segment.path, segment.size)
+            else:
+                self.storage.log.error("%s: unreadable since offset %i" %
+                                        (segment.path, segment.size))
+                segment.damaged = True
+
+    ####################################################
+
+    def close(self):
+        for f in (self.active_file, self.acks_file):
+            if f is not None:
+                f.close()
+        self.active_file = None
+        self.acks_file = None
+
+    ####################################################
+
+    def flush(self, fsync):
+        for f in (self.active_file, self.acks_file):
+            if f is not None:
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+
+    ####################################################
+
+    def dead_count(self):
+        return sum(segment.total - segment.live for segment in self.segments)
+
+    ####################################################
+
+    def need_compaction(self):
+        dead = self.dead_count() + self.acks_count
+        return ((dead >= COMPACT_MIN_DEAD) and
+                (dead > len(self.live) * COMPACT_RATIO))
+
+    ####################################################
+
+    def roll(self):
+        """
+        Close the active segment and start a new one.
+        """
+        if self.active_file is not None:
+            self.active_file.close()
+        number = self.next_number
+        self.next_number += 1
+        segment = Segment(number, os.path.join(self.directory,
+                                    "%016x%s" % (number, SEGMENT_SUFFIX)))
+        self.segments.append(segment)
+        self.active_file = open(segment.path, "ab", WRITE_BUFFER_SIZE)
+
+    ####################################################
+
+    def get_active_segment(self):
+        if ((self.active_file is None) or
+            (self.segments[-1].size >= self.storage.segment_size)):
+            self.roll()
+        return self.segments[-1]
+
+    ####################################################
+
+    def is_active(self, segment):
+        return ((self.active_file is not None) and
+                (segment is self.segments[-1]))
+
+    ####################################################
+
+    def append(self, seq, item):
+        segment = self.get_active_segment()
+        record = pack_item(seq, item)
+        self.active_file.write(record)
+        segment.size += len(record)
+        segment.total += 1
+        segment.live += 1
+        self.live[seq] = (item.uuid, segment)
+
+    ####################################################
+
+    def append_ack(self, ack_type, seq, ttl=None):
+        if self.acks_file is None:
+            self.acks_file = open(os.path.join(self.directory, ACKS_FILENAME),
+                                  "ab", WRITE_BUFFER_SIZE)
+        body = struct.pack(ACK_FORMAT[:1] + ACK_FORMAT[2:],
+                            ack_type, seq, encode_ttl(ttl))
+        self.acks_file.write(struct.pack("!I", zlib.crc32(body) & 0xffffffff))
+        self.acks_file.write(body)
+        self.acks_count += 1
+
+    ####################################################
+
+    def delete(self, seq):
+        _, segment = self.live.pop(seq)
+        self.ttls.pop(seq, None)
+        segment.live -= 1
+        self.append_ack(ACK_TYPE_DELETE, seq)
+        if not (segment.live or segment.damaged or self.is_active(segment)):
+            self.remove_segment(segment)
+
+    ####################################################
+
+    def remove_segment(self, segment):
+        self.segments.remove(segment)
+        segment.removed = True
+        if segment.readers:
+            self.pending_removal.add(segment)
+        else:
+            os.unlink(segment.path)
+
+    ####################################################
+
+    def release_segment(self, segment):
+        segment.readers -= 1
+        if segment.removed and not segment.readers:
+            self.pending_removal.discard(segment)
+            os.unlink(segment.path)
+
+    ####################################################
+
+    def is_held(self):
+        """
+        :return: True if a generator holds a file with deleted items
+        """
+        return bool(self.pending_removal) or any(
+                        segment.readers and (segment.live != segment.total)
+                        for segment in self.segments)
+
+    ####################################################
+
+    def update_ttl(self, seq, ttl):
+        self.ttls[seq] = ttl
+        self.append_ack(ACK_TYPE_TTL, seq, ttl)
+
+    ####################################################
+
+    def iter_items(self):
+        # items pushed after this call are not included
+        if self.active_file is not None:
+            self.active_file.flush()
+        top_seq = self.storage.next_seq
+        return self._iter_items(list(self.segments), top_seq)
+
+    def _iter_items(self, segments, top_seq):
+        for segment in segments:
+            if segment.live == 0:
+                continue
+            if self.is_active(segment):
+                self.active_file.flush()
+            try:
+                f = open(segment.path, "rb")
+            except IOError:
+                continue  # removed meanwhile
+            # items might be deleted while the generator is suspended but the
+            # file is kept until it is released
+            segment.readers += 1
+            try:
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    if not size:
+                        continue
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        for record in iter_records(buf, size):
+                            _, seq, flags, ttl, uuid_slice, data_slice = record
+                            if seq >= top_seq:
+                                return
+                            if seq not in self.live:
+                                continue
+                            yield Message(uuid=buf[uuid_slice],
+                                          data=buf[data_slice],
+                                          ttl=self.ttls.get(seq,
+                                                            decode_ttl(ttl)),
+                                          flags=flags)
+                    finally:
+                        buf.close()
+            finally:
+                self.release_segment(segment)
+
+    ####################################################
+
+    def compact(self):
+        """
+        Rewrite segments containing dead items and the acknowledgement log.
+        Nothing is done while a generator holds a segment with dead items
+        (the rewritten log must keep their deletions).
+        """
+        if self.is_held():
+            return
+        self.flush(True)
+        if self.active_file is not None:
+            self.active_file.close()
+            self.active_file = None
+
+        for segment in list(self.segments):
+            if (segment.live == segment.total) or segment.damaged:
+                continue
+            if segment.live == 0:
+                self.remove_segment(segment)
+                continue
+            tmp_path = segment.path + ".tmp"
+            with open(segment.path, "rb") as src:
+                buf = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    with open(tmp_path, "wb", WRITE_BUFFER_SIZE) as dst:
+                        size = 0
+                        for record in iter_records(buf, segment.size):
+                            offset, seq, _, _, _, data_slice = record
+                            if seq in self.live:
+                                dst.write(buf[offset:data_slice.stop])
+                                size += data_slice.stop - offset
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                finally:
+                    buf.close()
+            replace_file(tmp_path, segment.path)
+            segment.size = size
+            segment.total = segment.live
+
+        if self.acks_file is not None:
+            self.acks_file.close()
+            self.acks_file = None
+        acks_path = os.path.join(self.directory, ACKS_FILENAME)
+        tmp_path = acks_path + ".tmp"
+        self.acks_count = 0
+        with open(tmp_path, "wb") as f:
+            self.acks_file = f
+            for seq, ttl in self.ttls.items():
+                self.append_ack(ACK_TYPE_TTL, seq, ttl)
+            f.flush()
+            os.fsync(f.fileno())
+        self.acks_file = None
+        replace_file(tmp_path, acks_path)
+
+###########################################################################
+###########################################################################
+
+replace_file = getattr(os, "replace", os.rename)
+
+def truncate_file(path, size):
+    with open(path, "r+b") as f:
+        f.truncate(size)
+
+###########################################################################
+###########################################################################
+
+class SegmentedLogQueuesStorage(QueuesStorageBase):
+    def __init__(self, directory, sync=SYNC_FLUSH, segment_size=SEGMENT_SIZE,
+                  compact_interval=COMPACT_INTERVAL):
+        """
+        :param directory: storage directory, it is created if missing
+        :param sync: fsync policy - SYNC_ALWAYS, SYNC_FLUSH or SYNC_NEVER
+        :param segment_size: roll segments bigger than this (bytes)
+        :param compact_interval: min. seconds between compactions done by
+                                 :meth:`flush`
+        """
+        assert sync in (SYNC_ALWAYS, SYNC_FLUSH, SYNC_NEVER)
+        self.directory = directory
+        self.sync = sync
+        self.segment_size = segment_size
+        self.compact_interval = compact_interval
+        self.next_compaction = time.time() + compact_interval
+        self.log = logging.getLogger("snakemq.storage.segmentlog")
+        self.queues = {}  #: name:SegmentedQueue
+        self.index = {}  #: uuid:(SegmentedQueue, seq)
+        self.next_seq = 0
+        self.dirty = set()  #: queues with unflushed changes
+        self.to_compact = set()  #: queues with new dead items
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.load()
+
+    ####################################################
+
+    def load(self):
+        for dirname in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, dirname)
+            if not os.path.isdir(path):
+                continue
+            name = a2b_hex(dirname.encode("ascii")).decode("utf-8")
+            self.queues[name] = SegmentedQueue(self, name, path)
+
+    ####################################################
+
+    def seen_seq(self, seq):
+        if seq >= self.next_seq:
+            self.next_seq = seq + 1
+
+    ####################################################
+
+    def get_queue(self, queue_name):
+        queue = self.queues.get(queue_name)
+        if queue is None:
+            dirname = b2a_hex(queue_name.encode("utf-8")).decode("ascii")
+            queue = SegmentedQueue(self, queue_name,
+                                    os.path.join(self.directory, dirname))
+            self.queues[queue_name] = queue
+        return queue
+
+    ####################################################
+
+    def changed(self, queue):
+        if self.sync == SYNC_ALWAYS:
+            queue.flush(True)
+        else:
+            self.dirty.add(queue)
+
+    ####################################################
+
+    def close(self):
+        if self.queues is not None:
+            self.flush()
+            for queue in self.queues.values():
+                queue.close()
+        self.queues = None
+        self.index = None
+
+    ####################################################
+
+    def flush(self):
+        fsync = self.sync != SYNC_NEVER
+        for queue in self.dirty:
+            queue.flush(fsync)
+        self.dirty.clear()
+        if self.to_compact and (time.time() >= self.next_compaction):
+            self.compact_changed()
+
+    ####################################################
+
+    def compact_changed(self):
+        """
+        Compact queues with enough dead items.
+        """
+        for queue in list(self.to_compact):
+            if queue.need_compaction():
+                queue.compact()
+            if not queue.is_held():
+                # held queues are tried again next time
+                self.to_compact.discard(queue)
+        self.next_compaction = time.time() + self.compact_interval
+
+    ####################################################
+
+    def compact(self):
+        """
+        Compact all queues regardless the count of dead items.
+        """
+        for queue in self.queues.values():
+            queue.compact()
+        self.dirty.clear()
+        self.to_compact.clear()
+
+    ####################################################
+
+    def get_queues(self):
+        return [name for name, queue in self.queues.items() if queue.live]
+
+    ####################################################
+
+    def get_items(self, queue_name):
+        return list(self.iter_items(queue_name))
+
+    ####################################################
+
+    def iter_items(self, queue_name):
+        queue = self.queues.get(queue_name)
+        if queue is None:
+            return iter([])
+        return queue.iter_items()
+
+    ####################################################
+
+    def get_items_count(self, queue_name):
+        queue = self.queues.get(queue_name)
+        return 0 if queue is None else len(queue.live)
+
+    ####################################################
+
+    def push(self, queue_name, item):
+        queue = self.get_queue(queue_name)
+        previous = self.index.get(item.uuid)
+        if previous is not None:
+            previous[0].delete(previous[1])
+        seq = self.next_seq
+        self.next_seq += 1
+        queue.append(seq, item)
+        self.index[item.uuid] = (queue, seq)
+        self.changed(queue)
+
+    ####################################################
+
+    def delete_items(self, items):
+        changed = set()
+        for item in items:
+            location = self.index.pop(item.uuid, None)
+            if location is None:
+                continue
+            queue, seq = location
+            queue.delete(seq)
+            changed.add(queue)
+        for queue in changed:
+            self.to_compact.add(queue)
+            self.changed(queue)
+
+    ####################################################
+
+    def delete_all(self):
+        for queue in self.queues.values():
+            queue.close()
+            shutil.rmtree(queue.directory)
+        self.queues.clear()
+        self.index.clear()
+        self.dirty.clear()
+        self.to_compact.clear()
+        self.next_seq = 0
+
+    ####################################################
+
+    def update_items_ttl(self, items):
+        changed = set()
+        for item in items:
+            location = self.index.get(item.uuid)
+            if location is None:
+                continue
+            queue, seq = location
+            queue.update_ttl(seq, item.ttl)
+            changed.add(queue)
+        for queue in changed:
+            self.to_compact.add(queue)
+            self.changed(queue)
@@ -17,18 +17,48 @@ from snakemq.storage import QueuesStorageBase
 ###########################################################################
 ###########################################################################
 
+AUTO_VACUUM_INCREMENTAL = 2
+LOAD_PAGE_SIZE = 1000
+
+###########################################################################
+###########################################################################
+
 class SqliteQueuesStorage(QueuesStorageBase):
-    def __init__(self, filename):
+    def __init__(self, filename, group_commit=False):
+        """
+        :param filename: database file
+        :param group_commit: if True then changes are committed only by
+            :meth:`flush` (called by the messaging once per link loop pass),
+            otherwise every change is committed immediately
+        """
+        self.group_commit = group_commit
         self.conn = sqlite3.connect(filename)
         self.crs = self.conn.cursor()
+        self.crs.execute("PRAGMA journal_mode=WAL")
         self.test_format()
-        self.sweep()
+        self.create_indexes()
 
     ####################################################
 
-    def sweep(self):
-        # PyPy has broken VACUUM implementation
-        if platform.python_implementation() != "PyPy":
+    def sweep(self, pages=None):
+        """
+        Return free pages to the filesystem. Databases created with the
+        incremental auto vacuum are vacuumed incrementally, others by a full
+        ``VACUUM``.
+
+        :param pages: max. count of pages to be freed by the incremental
+                      vacuum, None = all
+        """
+        self.flush()
+        self.crs.execute("PRAGMA auto_vacuum")
+        if self.crs.fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            if pages is None:
+                self.crs.execute("PRAGMA incremental_vacuum")
+            else:
+                self.crs.execute("PRAGMA incremental_vacuum(%i)" % pages)
+            self.crs.fetchall()  # pages are freed while stepping
+        elif platform.python_implementation() != "PyPy":
+            # PyPy has broken VACUUM implementation
             with self.conn:
                 self.crs.execute("""VACUUM""")
 
@@ -49,6 +79,8 @@ class SqliteQueuesStorage(QueuesStorageBase):
     ####################################################
 
     def close(self):
+        if self.conn:
+            self.flush()
         if self.crs:
             self.crs.close()
             self.crs = None
@@ -59,6 +91,8 @@ class SqliteQueuesStorage(QueuesStorageBase):
     ####################################################
 
     def create_structures(self):
+        # must be set before the first table is created
+        self.crs.execute("PRAGMA auto_vacuum=%i" % AUTO_VACUUM_INCREMENTAL)
         with self.conn:
             # UUID is stored as hex
             self.crs.execute("""CREATE TABLE items (queue_name VARCHAR(%i),
@@ -70,54 +104,130 @@ class SqliteQueuesStorage(QueuesStorageBase):
 
     ####################################################
 
+    def create_indexes(self):
+        # databases created by older versions have no index
+        with self.conn:
+            self.crs.execute("""CREATE INDEX IF NOT EXISTS items_uuid
+                                    ON items (uuid)""")
+            self.crs.execute("""CREATE INDEX IF NOT EXISTS items_queue_name
+                                    ON items (queue_name)""")
+
+    ####################################################
+
+    def commit(self):
+        if not self.group_commit:
+            self.conn.commit()
+
+    ####################################################
+
+    def flush(self):
+        self.conn.commit()
+
+    ####################################################
+
     def get_queues(self):
         self.crs.execute("""SELECT queue_name FROM items GROUP BY queue_name""")
         return [r[0] for r in self.crs.fetchall()]
 
     ####################################################
 
+    @staticmethod
+    def row_to_message(row):
+        return Message(uuid=a2b_hex(row[0]),  # XXX python2 hack
+                      data=bytes(row[1]),  # XXX python2 hack
+                      ttl=row[2],
+                      flags=row[3])
+
+    ####################################################
+
     def get_items(self, queue_name):
         self.crs.execute("""SELECT uuid, data, ttl, flags FROM items
-                                   WHERE queue_name = ?""",
+                                   WHERE queue_name = ? ORDER BY rowid""",
                           (queue_name,))
-        items = []
-        for res in self.crs.fetchall():
-            uuid = a2b_hex(res[0])  # XXX python2 hack
-            data = bytes(res[1])  # XXX python2 hack
-            items.append(Message(uuid=uuid,
-                                data=data,
-                                ttl=res[2],
-                                flags=res[3]))
-        return items
+        return [self.row_to_message(row) for row in self.crs.fetchall()]
+
+    ####################################################
+
+    def iter_items(self, queue_name, page_size=LOAD_PAGE_SIZE):
+        """
+        Items are fetched in pages by separate queries so no cursor is left
+        open between the pages.
+        """
+        # items pushed after this call are not included
+        self.crs.execute("""SELECT max(rowid) FROM items""")
+        last_rowid = self.crs.fetchone()[0] or 0
+        return self._iter_items(queue_name, page_size, last_rowid)
+
+    ####################################################
+
+    def _iter_items(self, queue_name, page_size, last_rowid):
+        rowid = 0
+        while True:
+            crs = self.conn.execute("""SELECT rowid, uuid, data, ttl, flags
+                                        FROM items
+                                        WHERE queue_name = ? AND
+                                              rowid > ? AND rowid <= ?
+                                        ORDER BY rowid LIMIT ?""",
+                                    (queue_name, rowid, last_rowid, page_size))
+            rows = crs.fetchall()
+            crs.close()
+            for row in rows:
+                yield self.row_to_message(row[1:])
+            if len(rows) < page_size:
+                break
+            rowid = rows[-1][0]
+
+    ####################################################
+
+    def get_items_count(self, queue_name):
+        self.crs.execute("""SELECT count(1) FROM items WHERE queue_name = ?""",
+                          (queue_name,))
+        return self.crs.fetchone()[0]
 
     ####################################################
 
     def push(self, queue_name, item):
-        with self.conn:
-            self.crs.execute("""INSERT INTO items
-                                    (queue_name, uuid, data, ttl, flags)
-                                    VALUES (?, ?, ?, ?, ?)""",
-                          (queue_name, b2a_hex(item.uuid), item.data,
-                          item.ttl, item.flags))
+        self.crs.execute("""INSERT INTO items
+                                (queue_name, uuid, data, ttl, flags)
+                                VALUES (?, ?, ?, ?, ?)""",
+                      (queue_name, b2a_hex(item.uuid), item.data,
+                      item.ttl, item.flags))
+        self.commit()
 
     ####################################################
 
     def delete_items(self, items):
-        with self.conn:
-            for item in items:
-                self.crs.execute("""DELETE FROM items WHERE uuid = ?""",
-                              (b2a_hex(item.uuid),))
+        if not items:
+            return
+        self.crs.executemany("""DELETE FROM items WHERE uuid = ?""",
+                            [(b2a_hex(item.uuid),) for item in items])
+        self.commit()
 
     ####################################################
 
     def delete_all(self):
-        with self.conn:
-            self.crs.execute("DELETE FROM items")
+        self.crs.execute("DELETE FROM items")
+        self.commit()
 
     ####################################################
 
     def update_items_ttl(self, items):
-        with self.conn:
-            for item in items:
-                self.crs.execute("""UPDATE items SET ttl = ? WHERE uuid = ?""",
-                                  (item.ttl, b2a_hex(item.uuid)))
+        if not items:
+            return
+        self.crs.executemany("""UPDATE items SET ttl = ? WHERE uuid = ?""",
+                            [(item.ttl, b2a_hex(item.uuid)) for item in items])
+        self.commit()
+
+    ####################################################
+
+    def shift_items_ttl(self, queue_name, delta):
+        self.crs.execute("""UPDATE items SET ttl = ttl - ?
+                                WHERE queue_name = ? AND ttl IS NOT NULL""",
+                          (delta, queue_name))
+        self.crs.execute("""SELECT uuid, data, ttl, flags FROM items
+                                WHERE queue_name = ? AND ttl < 0
+                                ORDER BY rowid""",
+                          (queue_name,))
+        items = [self.row_to_message(row) for row in self.crs.fetchall()]
+        self.commit()
+        return items
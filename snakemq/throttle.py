@@ -10,6 +10,7 @@ Data bandwidth throttle.
 import time
 
 from snakemq.link import POLL_TIMEOUT
+from snakemq.buffers import fragments_head
 from snakemq.callbacks import Callback
 
 ############################################################################
@@ -87,7 +88,11 @@ class Throttle(object):
         send_size = self.connections[conn_id].can_send()
         if send_size > 0:
             self.stopped.discard(conn_id)
-            self.link.send(conn_id, buf[:send_size])
+            if isinstance(buf, list):
+                buf = fragments_head(buf, send_size)
+            else:
+                buf = buf[:send_size]
+            self.link.send(conn_id, buf)
         else:
             self.stopped.add(conn_id)
 
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of worker threads with a bounded queue of pending tasks.
+
+:author: David Siroky (siroky@dasir.cz)
+:license: MIT License (see LICENSE.txt)
+"""
+
+import threading
+import logging
+import time
+from collections import deque
+
+###########################################################################
+###########################################################################
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_PENDING = 1024
+
+# for better mock patching
+get_time = time.time
+
+###########################################################################
+###########################################################################
+
+class WorkersStats(object):
+    """
+    Times are in seconds. Wait time is measured from the task submission to
+    its start.
+    """
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.wait_time = 0.0  #: sum
+        self.max_wait_time = 0.0
+        self.run_time = 0.0  #: sum
+        self.max_run_time = 0.0
+
+    ############################################################
+
+    def copy(self):
+        stats = WorkersStats()
+        stats.__dict__.update(self.__dict__)
+        return stats
+
+    ############################################################
+
+    def __repr__(self):
+        return ("<%s submitted=%i completed=%i wait=%.6f/%.6f "
+                "run=%.6f/%.6f>" % (self.__class__.__name__,
+                self.submitted, self.completed, self.wait_time,
+                self.max_wait_time, self.run_time, self.max_run_time))
+
+###########################################################################
+###########################################################################
+
+class WorkersPool(object):
+    """
+    Threads are started lazily up to the given count. Tasks with the same key
+    are executed one by one in the order of submission. Thread safe.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS,
+                  max_pending=DEFAULT_MAX_PENDING, name="snakemq_worker"):
+        """
+        :param workers: max. count of threads
+        :param max_pending: max. count of submitted but not finished tasks,
+                            :meth:`submit` blocks (or refuses the task) if
+                            the limit is reached
+        :param name: threads name prefix
+        """
+        assert workers > 0
+        assert max_pending > 0
+        self.log = logging.getLogger("snakemq.workers")
+        self.workers = workers
+        self.max_pending = max_pending
+        self.name = name
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.tasks = deque()  #: (key, func, args, submit time)
+        #: key:deque of tasks waiting for the running task with the same key
+        self.keyed = {}
+        self.pending = 0
+        self.idle = 0
+        self.threads = []
+        self.running = True
+        self.stats = WorkersStats()
+
+    ############################################################
+
+    def submit(self, func, args=(), key=None, block=True):
+        """
+        Execute ``func(*args)`` in a worker thread. Blocks while the count
+        of pending tasks reaches the limit.
+
+        :param key: tasks with the same key (not None) are serialized
+        :param block: if False then the task is refused instead of waiting
+        :return: False if the task was refused, True otherwise
+        """
+        with self.lock:
+            while self.running and (self.pending >= self.max_pending):
+                if not block:
+                    return False
+                self.not_full.wait()
+            if not self.running:
+                raise RuntimeError("workers pool is shut down")
+            task = (key, func, args, get_time())
+            self.pending += 1
+            self.stats.submitted += 1
+            if key is not None:
+                if key in self.keyed:
+                    self.keyed[key].append(task)
+                    return True
+                self.keyed[key] = deque()
+            self.tasks.append(task)
+            self.not_empty.notify()
+            if ((len(self.tasks) > self.idle) and
+                (len(self.threads) < self.workers)):
+                self.start_thread()
+        return True
+
+    ############################################################
+
+    def start_thread(self):
+        thr = threading.Thread(target=self.run,
+                                name="%s_%i" % (self.name, len(self.threads)))
+        thr.daemon = True
+        self.threads.append(thr)
+        thr.start()
+
+    ############################################################
+
+    def run(self):
+        while True:
+            with self.lock:
+                while self.running and not self.tasks:
+                    self.idle += 1
+                    self.not_empty.wait()
+                    self.idle -= 1
+                if not self.tasks:
+                    return
+                task = self.tasks.popleft()
+
+            while task is not None:
+                key, func, args, submit_time = task
+                start_time = get_time()
+                try:
+                    func(*args)
+                except Exception:
+                    self.log.exception("task %r failed" % func)
+                end_time = get_time()
+
+                with self.lock:
+                    stats = self.stats
+                    stats.completed += 1
+                    wait_time = start_time - submit_time
+                    stats.wait_time += wait_time
+                    stats.max_wait_time = max(stats.max_wait_time, wait_time)
+                    run_time = end_time - start_time
+                    stats.run_time += run_time
+                    stats.max_run_time = max(stats.max_run_time, run_time)
+                    self.pending -= 1
+                    self.not_full.notify()
+                    # continue with the next task of the same key
+                    task = None
+                    if key is not None:
+                        waiting = self.keyed[key]
+                        if waiting:
+                            task = waiting.popleft()
+                        else:
+                            del self.keyed[key]
+
+    ############################################################
+
+    def get_stats(self):
+        """
+        :return: snapshot of :class:`WorkersStats`
+        """
+        with self.lock:
+            return self.stats.copy()
+
+    ############################################################
+
+    def shutdown(self, wait=True):
+        """
+        Stop threads after all already submitted tasks are executed.
+        """
+        with self.lock:
+            self.running = False
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+            threads = list(self.threads)
+        if wait:
+            for thr in threads:
+                if thr is not threading.current_thread():
+                    thr.join()
+
+    ############################################################
+
+    def __len__(self):
+        """
+        :return: count of pending tasks
+        """
+        return self.pending
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Ping-pong of small packets between two processes over TCP (loopback) and
+over a Unix domain socket. Prints round trips per second and CPU time of
+both processes.
+
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+from __future__ import print_function
+
+import time
+import logging
+import sys
+import os
+import tempfile
+
+sys.path.insert(0, "../..")
+
+import snakemq
+import snakemq.link
+import snakemq.packeter
+
+###########################################################################
+
+DATA_SIZE = 100
+COUNT = 20000
+PORT = 4000
+
+###########################################################################
+
+def srv(address):
+    s = snakemq.link.Link()
+
+    def on_packet_recv(conn_id, packet):
+        tr.send_packet(conn_id, packet)
+
+    def on_disconnect(conn_id):
+        s.stop()
+
+    s.add_listener(address)
+    tr = snakemq.packeter.Packeter(s)
+    tr.on_packet_recv = on_packet_recv
+    tr.on_disconnect = on_disconnect
+    s.loop()
+    s.cleanup()
+
+###########################################################################
+
+def cli(address):
+    s = snakemq.link.Link()
+    container = {"start_time": None, "count": 0}
+    data = b"x" * DATA_SIZE
+
+    def on_connect(conn_id):
+        container["start_time"] = time.time()
+        tr.send_packet(conn_id, data)
+
+    def on_packet_recv(conn_id, packet):
+        container["count"] += 1
+        if container["count"] == COUNT:
+            s.stop()
+        else:
+            tr.send_packet(conn_id, data)
+
+    s.add_connector(address)
+    tr = snakemq.packeter.Packeter(s)
+    tr.on_connect = on_connect
+    tr.on_packet_recv = on_packet_recv
+    s.loop()
+    diff = time.time() - container["start_time"]
+    s.cleanup()
+    return diff
+
+###########################################################################
+
+def run(name, address):
+    times_start = os.times()
+    pid = os.fork()
+    if pid == 0:
+        srv(address)
+        os._exit(0)
+    time.sleep(0.5)  # let the server listen
+    diff = cli(address)
+    os.waitpid(pid, 0)
+    times = os.times()
+    cpu = sum(times[:4]) - sum(times_start[:4])
+    print("%s: %i round trips/s, %.1f us per round trip, CPU %.2fs" %
+          (name, COUNT / diff, diff / COUNT * 1e6, cpu))
+
+###########################################################################
+
+# avoid logging overhead
+logger = logging.getLogger("snakemq")
+logger.setLevel(logging.ERROR)
+
+tmpdir = tempfile.mkdtemp()
+try:
+    run("tcp ", ("localhost", PORT))
+    run("unix", "unix:" + os.path.join(tmpdir, "bench.sock"))
+finally:
+    os.rmdir(tmpdir)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Send large packets between two processes over a Unix domain socket and over
+the shared memory link. Prints the flow and CPU time of both processes.
+
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+from __future__ import print_function
+
+import time
+import logging
+import sys
+import os
+import tempfile
+
+sys.path.insert(0, "../..")
+
+import snakemq
+import snakemq.link
+import snakemq.shmlink
+import snakemq.packeter
+
+###########################################################################
+
+DATA_SIZE = 1024 * 1024
+COUNT = 500
+
+###########################################################################
+
+def srv(link_class, address):
+    s = link_class()
+    container = {"count": 0}
+
+    def on_packet_recv(conn_id, packet):
+        assert len(packet) == DATA_SIZE
+        container["count"] += 1
+        if container["count"] == COUNT:
+            s.stop()
+
+    s.add_listener(address)
+    tr = snakemq.packeter.Packeter(s)
+    tr.on_packet_recv = on_packet_recv
+    s.loop()
+    s.cleanup()
+
+###########################################################################
+
+def cli(link_class, address):
+    s = link_class()
+    container = {"start_time": None, "count": 0}
+    data = b"x" * DATA_SIZE
+
+    def on_connect(conn_id):
+        container["start_time"] = time.time()
+        for i in range(COUNT):
+            tr.send_packet(conn_id, data)
+
+    def on_packet_sent(conn_id, packet_id):
+        container["count"] += 1
+        if container["count"] == COUNT:
+            s.stop()
+
+    s.add_connector(address)
+    tr = snakemq.packeter.Packeter(s)
+    tr.on_connect = on_connect
+    tr.on_packet_sent = on_packet_sent
+    s.loop()
+    diff = time.time() - container["start_time"]
+    s.cleanup()
+    return diff
+
+###########################################################################
+
+def run(name, link_class, address):
+    times_start = os.times()
+    pid = os.fork()
+    if pid == 0:
+        srv(link_class, address)
+        os._exit(0)
+    time.sleep(0.5)  # let the server listen
+    diff = cli(link_class, address)
+    os.waitpid(pid, 0)
+    times = os.times()
+    cpu = sum(times[:4]) - sum(times_start[:4])
+    print("%s: %.0f MBps, CPU %.2fs" %
+          (name, DATA_SIZE * COUNT / diff / 1024**2, cpu))
+
+###########################################################################
+
+# avoid logging overhead
+logger = logging.getLogger("snakemq")
+logger.setLevel(logging.ERROR)
+
+tmpdir = tempfile.mkdtemp()
+try:
+    address = "unix:" + os.path.join(tmpdir, "bench.sock")
+    run("unix", snakemq.link.Link, address)
+    run("shm ", snakemq.shmlink.ShmLink, address)
+finally:
+    os.rmdir(tmpdir)
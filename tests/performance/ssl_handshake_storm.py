@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Ping-pong over an established SSL connection while a storm of new SSL
+connections hits the same server. Prints round trip times of the
+established connection with handshakes in the loop and in the SSL workers.
+
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+from __future__ import print_function
+
+import time
+import logging
+import sys
+import os
+
+sys.path.insert(0, "../..")
+
+import snakemq
+import snakemq.link
+
+###########################################################################
+
+PORT = 4000
+STORM = 1000  # count of new connections
+PINGS = 20000
+CERT = "../unittests/testcert.pem"
+KEY = "../unittests/testkey.pem"
+
+###########################################################################
+
+def srv(offload):
+    s = snakemq.link.Link()
+    if offload:
+        s.offload_ssl()
+    cfg = snakemq.link.SSLConfig(KEY, CERT)
+
+    def on_recv(conn_id, data):
+        if data == b"stop":
+            s.stop()
+        else:
+            s.send(conn_id, data)
+
+    s.add_listener(("", PORT), ssl_config=cfg)
+    s.on_recv.add(on_recv)
+    s.loop()
+    s.cleanup()
+
+###########################################################################
+
+def storm():
+    s = snakemq.link.Link()
+    cfg = snakemq.link.SSLConfig()
+    container = {"count": 0}
+    for i in range(STORM):
+        # every connector needs its own address, all 127.x.x.x are loopback
+        s.add_connector(("127.0.%i.%i" % (1 + i // 250, 1 + i % 250), PORT),
+                        ssl_config=cfg)
+
+    def on_connect(conn_id):
+        container["count"] += 1
+        if container["count"] == STORM:
+            s.stop()
+
+    s.on_connect.add(on_connect)
+    s.loop(runtime=30)
+
+###########################################################################
+
+def cli():
+    s = snakemq.link.Link()
+    cfg = snakemq.link.SSLConfig()
+    container = {"sent": None, "count": 0, "storm": None}
+    times = []
+
+    def on_connect(conn_id):
+        container["sent"] = time.time()
+        s.send(conn_id, b"ping")
+
+    def on_recv(conn_id, data):
+        now = time.time()
+        times.append(now - container["sent"])
+        container["count"] += 1
+        if container["count"] == 10:
+            # connection is established, start the storm
+            container["storm"] = os.fork()
+            if container["storm"] == 0:
+                storm()
+                os._exit(0)
+        if container["count"] == PINGS:
+            s.send(conn_id, b"stop")
+            s.stop()
+        else:
+            container["sent"] = time.time()
+            s.send(conn_id, b"ping")
+
+    s.add_connector(("localhost", PORT), ssl_config=cfg)
+    s.on_connect.add(on_connect)
+    s.on_recv.add(on_recv)
+    s.loop()
+    s.loop(runtime=0.5)  # flush the stop
+    s.cleanup()
+    os.kill(container["storm"], 9)
+    os.waitpid(container["storm"], 0)
+    return times[10:]
+
+###########################################################################
+
+def run(name, offload):
+    pid = os.fork()
+    if pid == 0:
+        srv(offload)
+        os._exit(0)
+    time.sleep(0.5)  # let the server listen
+    times = sorted(cli())
+    os.waitpid(pid, 0)
+    print("%s: round trip avg %.2f ms, 99%% %.2f ms, max %.2f ms" %
+          (name, sum(times) / len(times) * 1000,
+            times[int(len(times) * 0.99)] * 1000, times[-1] * 1000))
+
+###########################################################################
+
+# avoid logging overhead
+logger = logging.getLogger("snakemq")
+logger.setLevel(logging.CRITICAL)
+
+run("handshakes in the loop   ", False)
+run("handshakes in the workers", True)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Compare the locking and the lockless stream buffer on many small puts, gets
+and cuts - similar to what the packeter does with small packets.
+
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import time
+import sys
+
+sys.path.insert(0, "../..")
+
+import snakemq.buffers
+
+###########################################################################
+
+DATA_SIZE = 9
+COUNT = 500000
+BLOCK_SIZE = 64 * 1024
+
+###########################################################################
+
+def run(buf):
+    data = b"x" * DATA_SIZE
+    time_start = time.time()
+    for i in range(COUNT):
+        buf.put(data)
+        if len(buf) >= BLOCK_SIZE:
+            buf.cut(len(buf.get_fragments(BLOCK_SIZE)) * DATA_SIZE)
+    buf.get(len(buf))
+    return time.time() - time_start
+
+###########################################################################
+
+for cls in (snakemq.buffers.StreamBuffer,
+            snakemq.buffers.LocklessStreamBuffer):
+    diff = run(cls())
+    print("%s: %.02f s, %i puts/s" % (cls.__name__, diff, COUNT / diff))
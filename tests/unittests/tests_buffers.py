@@ -68,6 +68,29 @@ class TestBuffers(utils.TestCase):
 
     ##########################################################
 
+    def test_get_fragments(self):
+        self.buf.put(b"abcd")
+        self.buf.put(b"efgh")
+        self.assertEqual([bytes(f) for f in self.buf.get_fragments(6)],
+                          [b"abcd", b"ef"])
+        self.assertEqual([bytes(f) for f in self.buf.get_fragments(10)],
+                          [b"abcd", b"efgh"])
+        self.assertEqual(len(self.buf), 8)  # nothing is removed
+        self.buf.cut(5)
+        self.assertEqual([bytes(f) for f in self.buf.get_fragments(10)],
+                          [b"fgh"])
+
+    ##########################################################
+
+    def test_fragments_head(self):
+        fragments = [b"ab", b"cde", b"f"]
+        head = snakemq.buffers.fragments_head
+        self.assertEqual(head(fragments, 0), [])
+        self.assertEqual([bytes(f) for f in head(fragments, 4)], [b"ab", b"cd"])
+        self.assertEqual([bytes(f) for f in head(fragments, 10)], fragments)
+
+    ##########################################################
+
     def test_cut(self):
         self.buf.put(b"abcd")
         self.buf.put(b"efgh")
@@ -81,6 +104,20 @@ class TestBuffers(utils.TestCase):
 ############################################################################
 ############################################################################
 
+class TestLocklessBuffers(TestBuffers):
+    def setUp(self):
+        self.buf = snakemq.buffers.LocklessStreamBuffer()
+
+    ##########################################################
+
+    def test_no_max_size(self):
+        self.buf.set_max_size(None)
+        self.assertRaises(snakemq.buffers.BufferException,
+                          self.buf.set_max_size, 100)
+
+############################################################################
+############################################################################
+
 class TestBuffersMaxSize(utils.TestCase):
     def setUp(self):
         self.buf = snakemq.buffers.StreamBuffer()
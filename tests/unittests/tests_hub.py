@@ -0,0 +1,198 @@
+#! -*- coding: utf-8 -*-
+"""
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import threading
+
+import mock
+from nose.tools import timed
+
+import snakemq.link
+import snakemq.packeter
+import snakemq.messaging
+import snakemq.message
+import snakemq.hub
+
+import utils
+
+#############################################################################
+#############################################################################
+
+TEST_PORT = 40070
+MESH_ADDRESSES = [("localhost", TEST_PORT + 1), ("localhost", TEST_PORT + 2)]
+
+LOOP_RUNTIME = 3.0
+LOOP_RUNTIME_ASSERT = 3.5
+
+HUB0 = snakemq.hub.HUB_IDENT % 0
+
+#############################################################################
+#############################################################################
+
+def create_stack(ident):
+    link = snakemq.link.Link()
+    packeter = snakemq.packeter.Packeter(link)
+    messaging = snakemq.messaging.Messaging(ident, "", packeter)
+    return link, messaging
+
+#############################################################################
+#############################################################################
+
+class TestHubForwarder(utils.TestCase):
+    def setUp(self):
+        self.link, self.messaging = create_stack("server")
+        self.hub = snakemq.hub.HubForwarder(self.messaging, 1, MESH_ADDRESSES)
+        self.hub.mesh = mock.Mock()
+
+    def tearDown(self):
+        self.hub.cleanup()
+        self.link.cleanup()
+
+    ########################################################
+
+    def test_ownership(self):
+        hub = self.hub
+        frame = hub.frame(snakemq.hub.HUB_OWN, "alice")
+        hub._on_mesh_message("c", HUB0, snakemq.message.Message(frame))
+        self.assertEqual(hub.get_owner("alice"), 0)
+
+        # the ident moves to this worker
+        hub._on_connect("c1", "alice")
+        self.assertEqual(hub.get_owner("alice"), 1)
+        self.assertEqual(hub.mesh.send_message.call_count, 1)
+        frame = hub.frame(snakemq.hub.HUB_DISOWN, "alice")
+        hub._on_mesh_message("c", HUB0, snakemq.message.Message(frame))
+        self.assertEqual(hub.get_owner("alice"), 1)
+
+        hub._on_disconnect("c1", "alice")
+        self.assertEqual(hub.get_owner("alice"), None)
+
+    ########################################################
+
+    def test_forward_queued(self):
+        hub = self.hub
+        msg = snakemq.message.Message(b"data", ttl=None)
+        self.messaging.send_message("alice", msg)
+        hub.owners["alice"] = 0
+        hub._on_loop_pass()
+        self.assertEqual(len(self.messaging.queues_manager.get_queue("alice")),
+                          0)
+        hub_ident, fwd = hub.mesh.send_message.call_args[0]
+        self.assertEqual(hub_ident, HUB0)
+        self.assertEqual(fwd.uuid, msg.uuid)
+
+        # and back to the messaging of the owner
+        with mock.patch.object(self.messaging, "send_message") as send_mock:
+            hub._on_mesh_message("c", HUB0, fwd)
+        ident, msg2 = send_mock.call_args[0]
+        self.assertEqual(ident, "alice")
+        self.assertEqual(msg2.data, b"data")
+        self.assertEqual(msg2.uuid, msg.uuid)
+
+    ########################################################
+
+    def test_delivery_report(self):
+        hub = self.hub
+        sent = mock.Mock()
+        self.messaging.on_message_sent.add(sent)
+        msg = snakemq.message.Message(b"data", ttl=None)
+        self.messaging.send_message("alice", msg)
+        hub.owners["alice"] = 0
+        hub._on_loop_pass()
+        self.assertEqual(hub.outgoing, {msg.uuid: "alice"})
+
+        # the owner reports the message sent
+        owner = snakemq.hub.HubForwarder(self.messaging, 0, MESH_ADDRESSES)
+        owner.mesh = mock.Mock()
+        try:
+            fwd = hub.mesh.send_message.call_args[0][1]
+            with mock.patch.object(self.messaging, "send_message"):
+                owner._on_mesh_message("c", snakemq.hub.HUB_IDENT % 1, fwd)
+            owner._on_message_sent("c1", "alice", msg.uuid)
+            hub_ident, report = owner.mesh.send_message.call_args[0]
+            self.assertEqual(hub_ident, snakemq.hub.HUB_IDENT % 1)
+            self.assertEqual(owner.incoming, {})
+        finally:
+            owner.cleanup()
+
+        hub._on_mesh_message("c", HUB0, report)
+        self.assertEqual(sent.call_count, 0)  # in the worker's thread
+        hub._on_loop_pass()
+        sent.assert_called_once_with(None, "alice", msg.uuid)
+        self.assertEqual(hub.outgoing, {})
+
+    ########################################################
+
+    def test_mesh_drop_report(self):
+        hub = self.hub
+        dropped = mock.Mock()
+        self.messaging.on_message_drop.add(dropped)
+        msg = snakemq.message.Message(b"data", ttl=1)
+        self.messaging.send_message("alice", msg)
+        hub.owners["alice"] = 0
+        hub._on_loop_pass()
+        hub._on_mesh_message_drop(HUB0, msg.uuid)
+        hub._on_loop_pass()
+        dropped.assert_called_once_with("alice", msg.uuid)
+
+    ########################################################
+
+    def test_reserved_ident(self):
+        with mock.patch.object(self.link, "close") as close_mock:
+            self.hub._on_connect("c1", HUB0)
+        close_mock.assert_called_once_with("c1")
+        self.assertEqual(self.hub.get_owner(HUB0), None)
+        self.assertEqual(self.hub.mesh.send_message.call_count, 0)
+
+#############################################################################
+#############################################################################
+
+class TestHub(utils.TestCase):
+    @timed(LOOP_RUNTIME_ASSERT)
+    def test_forwarding(self):
+        """
+        Message sent by worker 0 is delivered to the peer connected to
+        worker 1.
+        """
+        workers = []
+        for i in range(len(MESH_ADDRESSES)):
+            link, messaging = create_stack("server")
+            link.add_listener(("", TEST_PORT + 10 + i))
+            hub = snakemq.hub.HubForwarder(messaging, i, MESH_ADDRESSES)
+            workers.append((link, messaging, hub))
+
+        client_link, client_messaging = create_stack("client")
+        client_link.add_connector(("localhost", TEST_PORT + 11))
+        received = []
+
+        def on_recv(conn_id, ident, message):
+            received.append(message.data)
+            client_link.stop()
+        client_messaging.on_message_recv.add(on_recv)
+
+        msg = snakemq.message.Message(b"hello", ttl=LOOP_RUNTIME)
+        workers[0][1].send_message("client", msg)
+
+        threads = []
+        for link, messaging, hub in workers:
+            hub.start()
+            thr = threading.Thread(target=link.loop,
+                                    kwargs={"runtime": LOOP_RUNTIME})
+            thr.start()
+            threads.append(thr)
+        try:
+            client_link.loop(runtime=LOOP_RUNTIME)
+        finally:
+            for link, messaging, hub in workers:
+                link.stop()
+            for thr in threads:
+                thr.join()
+            for link, messaging, hub in workers:
+                hub.cleanup()
+                link.cleanup()
+            client_link.cleanup()
+
+        self.assertEqual(received, [b"hello"])
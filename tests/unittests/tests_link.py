@@ -11,9 +11,11 @@ except ImportError:
     import __builtin__ as builtins
 import os
 import errno
+import select
 import threading
 import socket
-import sys
+import ssl
+import tempfile
 
 import mock
 from nose.tools import timed
@@ -34,7 +36,7 @@ LOOP_RUNTIME_ASSERT = 2.2  # SSL needs more time, this should be fine
 #############################################################################
 #############################################################################
 
-has_ssl = sys.version_info < (3, 5)
+has_ssl = snakemq.link.HAS_SSL
 
 #############################################################################
 #############################################################################
@@ -79,6 +81,21 @@ class TestConnector(utils.TestCase):
 #############################################################################
 #############################################################################
 
+class TestListener(utils.TestCase):
+    def test_reuse_port(self):
+        if not snakemq.link.HAS_REUSEPORT:
+            return
+        links = [snakemq.link.Link(), snakemq.link.Link()]
+        try:
+            for link in links:
+                link.add_listener(("localhost", TEST_PORT), reuse_port=True)
+        finally:
+            for link in links:
+                link.cleanup()
+
+#############################################################################
+#############################################################################
+
 class TestLink(utils.TestCase):
     def setUp(self):
         self.link_server, self.link_client = self.create_links()
@@ -189,6 +206,187 @@ class TestLink(utils.TestCase):
         # this must not raise an exception
         self.link_server.handle_recv(sock)
 
+    ########################################################
+
+    def test_recv_budget(self):
+        link = self.link_server
+        link.recv_block_size = 4
+        link.recv_budget = 8
+        sock = snakemq.link.LinkSocket(mock.Mock(spec=socket.socket))
+        sock.conn_id = "c"
+        def recv_into(buf):
+            buf[:] = b"abcd"
+            return 4
+        sock.sock.recv_into.side_effect = recv_into
+        on_recv = mock.Mock()
+        link.on_recv.add(on_recv)
+        link.handle_recv(sock)
+        # the socket is full of data but the budget is reached
+        self.assertEqual(sock.sock.recv_into.call_count, 2)
+        self.assertEqual(on_recv.call_args_list,
+                          [mock.call("c", b"abcd")] * 2)
+
+    ########################################################
+
+    def test_recv_drained(self):
+        link = self.link_server
+        link.recv_memoryview = True
+        sock = snakemq.link.LinkSocket(mock.Mock(spec=socket.socket))
+        sock.conn_id = "c"
+        sock.sock.recv_into.return_value = 3
+        received = []
+        link.on_recv.add(lambda conn_id, data: received.append(data))
+        link.handle_recv(sock)
+        # short read - nothing more to read
+        self.assertEqual(sock.sock.recv_into.call_count, 1)
+        self.assertIsInstance(received[0], memoryview)
+        self.assertEqual(len(received[0]), 3)
+
+    ########################################################
+
+    def test_poll_mask_cached(self):
+        link = self.link_server
+        link.poller = mock.Mock()
+        sock = snakemq.link.LinkSocket()
+        link.register_sock(sock, select.EPOLLIN)
+        link.set_poll_mask(sock, select.EPOLLIN)
+        self.assertEqual(link.poller.modify.call_count, 0)
+        link.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
+        link.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
+        self.assertEqual(link.poller.modify.call_count, 1)
+        sock.sock.close()
+
+    ########################################################
+
+    def test_ready_to_send_keeps_mask(self):
+        """
+        If more data is sent from on_ready_to_send then EPOLLOUT stays.
+        """
+        link = self.link_server
+        link.poller = mock.Mock()
+        sock = snakemq.link.LinkSocket(mock.Mock(spec=socket.socket))
+        sock.sock.send.return_value = 1
+        sock.sock.fileno.return_value = 100
+        link.new_connection_id(sock)
+        link.register_sock(sock, select.EPOLLIN)
+        link.send(sock.conn_id, b"a")
+        link.on_ready_to_send.add(
+                    lambda conn_id, size: link.send(conn_id, b"b"))
+        link.handle_ready_to_send(sock)
+        self.assertEqual(link.poller.modify.call_args_list,
+                    [mock.call(sock, select.EPOLLIN | select.EPOLLOUT)])
+        link.on_ready_to_send.callbacks[:] = []
+        link.handle_ready_to_send(sock)
+        self.assertEqual(link.poller.modify.call_args,
+                          mock.call(sock, select.EPOLLIN))
+        link.del_connection_id(sock)
+
+    ########################################################
+
+    def test_send_fragments(self):
+        sock = snakemq.link.LinkSocket(mock.Mock(spec=socket.socket))
+        sock.sock.sendmsg.return_value = 5
+        sock.sock.send.return_value = 5
+        fragments = [b"ab", b"cde"]
+        sock.send(fragments)
+        if snakemq.link.HAS_SENDMSG:
+            sock.sock.sendmsg.assert_called_once_with(fragments)
+        else:
+            sock.sock.send.assert_called_once_with(b"abcde")
+        self.assertEqual(sock.last_send_size, 5)
+
+#############################################################################
+#############################################################################
+
+class TestLinkEdgeTriggered(TestLink):
+    __test__ = snakemq.link.HAS_EPOLLET
+
+    def create_links(self):
+        link_server, link_client = TestLink.create_links(self)
+        link_server.edge_triggered = True
+        link_client.edge_triggered = True
+        return link_server, link_client
+
+#############################################################################
+#############################################################################
+
+class TestLinkUnix(TestLink):
+    __test__ = snakemq.link.HAS_UNIX
+
+    def create_links(self):
+        self.tmpdir = tempfile.mkdtemp()
+        address = "unix:" + os.path.join(self.tmpdir, "sock")
+        link_server = snakemq.link.Link()
+        link_server.add_listener(address)
+        link_client = snakemq.link.Link()
+        link_client.add_connector(address)
+        return link_server, link_client
+
+    def tearDown(self):
+        TestLink.tearDown(self)
+        # the listener has removed its socket file
+        os.rmdir(self.tmpdir)
+
+    ########################################################
+
+    def test_stale_socket_file(self):
+        address = "unix:" + os.path.join(self.tmpdir, "stale")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(snakemq.link.to_sockaddr(address))
+        sock.close()  # the file remains
+        link = snakemq.link.Link()
+        try:
+            link.add_listener(address)
+        finally:
+            link.cleanup()
+
+    ########################################################
+
+    def test_connection_refused(self):
+        link = snakemq.link.Link()
+        addr = link.add_connector("unix:" + os.path.join(self.tmpdir, "none"))
+        with mock.patch.object(link, "handle_conn_refused",
+                                mock.Mock(wraps=link.handle_conn_refused)):
+            self.assertFalse(link.connect(addr))
+            self.assertEqual(link.handle_conn_refused.call_count, 1)
+        link.cleanup()
+
+    ########################################################
+
+    def test_adopt_socket(self):
+        link = self.link_server
+        sock_a, sock_b = socket.socketpair()
+        on_connect = mock.Mock()
+        link.on_connect.add(on_connect)
+        link.adopt_socket(sock_a)
+        self.assertEqual(on_connect.call_count, 1)
+        sock_b.sendall(b"abc")
+        on_recv = mock.Mock()
+        link.on_recv.add(on_recv)
+        link.poll(1)
+        on_recv.assert_called_once_with(on_connect.call_args[0][0], b"abc")
+        sock_b.close()
+
+    ########################################################
+
+    def test_recv_before_hangup(self):
+        """
+        Data sent just before the peer's close must not be lost.
+        """
+        link = self.link_server
+        sock_a, sock_b = socket.socketpair()
+        received = []
+        link.on_recv.add(lambda conn_id, data: received.append(data))
+        on_disconnect = mock.Mock()
+        link.on_disconnect.add(on_disconnect)
+        link.adopt_socket(sock_a)
+        sock_b.sendall(b"abc")
+        sock_b.close()
+        link.poll(1)
+        link.poll(1)
+        self.assertEqual(received, [b"abc"])
+        self.assertEqual(on_disconnect.call_count, 1)
+
 #############################################################################
 #############################################################################
 
@@ -205,22 +403,24 @@ class TestLinkSSL(TestLink):
 
     ########################################################
 
-    def test_ssl_handshake_none_sslobj(self):
+    def test_handshake_closed_by_peer(self):
         link = snakemq.link.Link()
-        sock = mock.Mock()
-        sock.sock._sslobj = None
+        cfg = snakemq.link.SSLConfig("testkey.pem", "testcert.pem")
+        sock = snakemq.link.LinkSocket(mock.Mock(spec=socket.socket), cfg)
+        sock.sock.recv.return_value = b""
+        sock.start_ssl(server_side=True)
         link._in_ssl_handshake.add(sock)
-        link.poller = mock.Mock()
+        link.handle_close = mock.Mock()
         self.assertEqual(link.ssl_handshake(sock), snakemq.link.SSL_HANDSHAKE_FAILED)
         self.assertNotIn(sock, link._in_ssl_handshake)
+        self.assertEqual(link.handle_close.call_count, 1)
 
     ########################################################
 
     def test_failed_handshake_cleanup(self):
         link = snakemq.link.Link()
         sock = mock.Mock()
-        sock.sock._sslobj = mock.Mock()  # anything but None
-        sock.sock.do_handshake.side_effect = socket.error()
+        sock.do_handshake.side_effect = ssl.SSLError()
         link._in_ssl_handshake.add(sock)
         def handle_close(sock):
             # during handle_close() the socket must be still have
@@ -232,6 +432,154 @@ class TestLinkSSL(TestLink):
         self.assertNotIn(sock, link._in_ssl_handshake)
         self.assertEqual(link.handle_close.call_count, 1)
 
+    ########################################################
+
+    def test_lingering_close(self):
+        """
+        Closed SSL socket reads (and discards) data until the peer closes.
+        """
+        link = snakemq.link.Link()
+        sock_a, sock_b = socket.socketpair()
+        sock_a.setblocking(False)
+        sock = snakemq.link.LinkSocket(sock_a)
+        sock.ssl_obj = mock.Mock()
+        link.handle_close(sock)
+        fd = sock_a.fileno()
+        self.assertIn(fd, link._lingering)
+        sock_b.send(b"late data")
+        link.poll(0.1)
+        self.assertIn(fd, link._lingering)
+        sock_b.close()
+        link.poll(0.1)
+        self.assertNotIn(fd, link._lingering)
+        self.assertEqual(sock_a.fileno(), -1)
+        link.cleanup()
+
+    ########################################################
+
+    def test_context_shared(self):
+        cfg = snakemq.link.SSLConfig("testkey.pem", "testcert.pem")
+        socks = [snakemq.link.LinkSocket(mock.Mock(spec=socket.socket), cfg)
+                  for i in range(2)]
+        for sock in socks:
+            sock.start_ssl(server_side=True)
+        self.assertIs(socks[0].ssl_obj.context, socks[1].ssl_obj.context)
+        self.assertIs(cfg.get_context(True), socks[0].ssl_obj.context)
+        self.assertIsNot(cfg.get_context(False), cfg.get_context(True))
+
+    ########################################################
+
+    @timed(LOOP_RUNTIME_ASSERT)
+    def test_session_resumption(self):
+        """
+        Reconnected connector resumes the previous TLS session.
+        """
+        link_server = self.link_server
+        link_client = self.link_client
+        # reconnect quickly with the same configuration
+        sock = list(link_client._connectors.values())[0]
+        link_client.del_connector(sock.remote_peer)
+        link_client.add_connector(sock.remote_peer, reconnect_interval=0.1,
+                                  ssl_config=sock.ssl_config)
+        resumed = []
+        container = {"count": 0}
+
+        def on_connect(conn_id):
+            sock = link_client.get_socket_by_conn(conn_id)
+            resumed.append(sock.ssl_obj.session_reused)
+            link_client.send(conn_id, b"x")
+        def on_recv(conn_id, data):
+            container["count"] += 1
+            if container["count"] == 2:
+                link_client.stop()
+            link_client.close(conn_id)
+        link_client.on_connect.add(on_connect)
+        link_client.on_recv.add(on_recv)
+        # the server answers so the client has read the session ticket
+        link_server.on_recv.add(lambda conn_id, data:
+                                      link_server.send(conn_id, b"y"))
+
+        thr = threading.Thread(target=link_server.loop,
+                                kwargs={"runtime": LOOP_RUNTIME})
+        thr.start()
+        try:
+            link_client.loop(runtime=LOOP_RUNTIME)
+        finally:
+            link_server.stop()
+            thr.join()
+
+        self.assertEqual(resumed, [False, True])
+
+#############################################################################
+#############################################################################
+
+class TestLinkSSLOffloaded(TestLinkSSL):
+    """
+    Handshakes and records in the SSL workers.
+    """
+    def create_links(self):
+        link_server, link_client = TestLinkSSL.create_links(self)
+        link_server.offload_ssl(workers=2, records=True)
+        link_client.offload_ssl(workers=2, records=True)
+        return link_server, link_client
+
+    ########################################################
+
+    def test_stale_result(self):
+        """
+        Result of a task for a closed connection is ignored.
+        """
+        link = self.link_server
+        sock = mock.Mock()
+        sock.conn_id = None
+        handler = mock.Mock()
+        link._ssl_results.append((sock, sock.ssl_obj, handler, None, None))
+        link.handle_ssl_results()
+        self.assertEqual(handler.call_count, 0)
+
+    ########################################################
+
+    def test_ready_to_send_waits_for_encryption(self):
+        link = self.link_server
+        link.poller = mock.Mock()
+        sock = snakemq.link.LinkSocket(mock.Mock(spec=socket.socket))
+        sock.sock.fileno.return_value = 100
+        sock.ssl_obj = mock.Mock()
+        link.new_connection_id(sock)
+        link.register_sock(sock, select.EPOLLIN | select.EPOLLOUT)
+        with mock.patch.object(link, "ssl_pool") as pool:
+            link.send(sock.conn_id, [b"a", b"b"])
+        func, args = pool.submit.call_args[0]
+        self.assertEqual(args[5], b"ab")
+        self.assertEqual(sock.last_send_size, 2)
+
+        on_ready_to_send = mock.Mock()
+        link.on_ready_to_send.add(on_ready_to_send)
+        link.handle_ready_to_send(sock)
+        self.assertEqual(on_ready_to_send.call_count, 0)
+        self.assertEqual(sock.poll_mask, select.EPOLLIN)
+
+        sock.sock.send.return_value = 3
+        link._ssl_results.append((sock, sock.ssl_obj,
+                                  link.handle_ssl_encrypted, b"xyz", None))
+        link.handle_ssl_results()
+        self.assertEqual(sock.poll_mask, select.EPOLLIN | select.EPOLLOUT)
+        link.handle_ready_to_send(sock)
+        on_ready_to_send.assert_called_once_with(sock.conn_id, 2)
+        link.del_connection_id(sock)
+
+#############################################################################
+
+class TestLinkSSLOffloadedHandshake(TestLinkSSL):
+    """
+    Just handshakes in the SSL workers.
+    """
+    def create_links(self):
+        link_server, link_client = TestLinkSSL.create_links(self)
+        link_server.offload_ssl(workers=2)
+        link_client.offload_ssl(workers=2)
+        return link_server, link_client
+
 #############################################################################
 #############################################################################
 
@@ -0,0 +1,57 @@
+#! -*- coding: utf-8 -*-
+"""
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import pickle
+
+import snakemq.message
+
+import utils
+
+#############################################################################
+#############################################################################
+
+class TestMessage(utils.TestCase):
+    def test_lazy_uuid(self):
+        msg = snakemq.message.Message(b"data")
+        self.assertEqual(msg._uuid, None)
+        uuid = msg.uuid
+        self.assertEqual(len(uuid), snakemq.message.MAX_UUID_LENGTH)
+        self.assertEqual(msg.uuid, uuid)
+        self.assertNotEqual(snakemq.message.Message(b"data").uuid, uuid)
+
+    ##############################################################
+
+    def test_explicit_uuid(self):
+        msg = snakemq.message.Message(b"data", uuid=b"x" * 20)
+        self.assertEqual(msg.uuid, b"x" * snakemq.message.MAX_UUID_LENGTH)
+        msg = snakemq.message.Message(b"data", uuid=b"")
+        self.assertEqual(len(msg.uuid), snakemq.message.MAX_UUID_LENGTH)
+
+    ##############################################################
+
+    def test_generate_uuid(self):
+        uuids = set(snakemq.message.generate_uuid() for i in range(1000))
+        self.assertEqual(len(uuids), 1000)
+        prefixes = set(uuid[:snakemq.message.UUID_PREFIX_LENGTH]
+                       for uuid in uuids)
+        self.assertEqual(len(prefixes), 1)
+
+    ##############################################################
+
+    def test_slots(self):
+        msg = snakemq.message.Message(b"data", ttl=None, flags=1, uuid=b"abc")
+        self.assertFalse(hasattr(msg, "__dict__"))
+        copy = pickle.loads(pickle.dumps(msg, 2))
+        self.assertEqual((copy.data, copy.ttl, copy.flags, copy.uuid),
+                         (msg.data, msg.ttl, msg.flags, msg.uuid))
+
+    ##############################################################
+
+    def test_reserved_flags(self):
+        for flag in (0x40000000, 0x80000000):
+            self.assertRaises(ValueError, snakemq.message.Message, b"data",
+                              flags=flag | snakemq.message.FLAG_PERSISTENT)
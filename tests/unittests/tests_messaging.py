@@ -5,6 +5,9 @@
           U{http://www.opensource.org/licenses/mit-license.php})
 """
 
+import re
+import struct
+
 import mock
 import nose
 
@@ -132,6 +135,285 @@ class TestMessaging(utils.TestCase):
         # sending identification
         self.messaging._on_packet_sent("conn_id1", 123)
 
+    ##############################################################
+
+    def test_send_window_messages(self):
+        """
+        Queued messages are passed to the packeter until the window is full.
+        """
+        packet_ids = iter(range(100))
+        self.messaging.packeter.send_packet.side_effect = \
+                                                lambda *args: next(packet_ids)
+        self.messaging.send_window_messages = 3
+        self.messaging.parse_identification(b"peerident", "conn_id1")
+        for i in range(5):
+            self.messaging.send_message("peerident",
+                                        snakemq.message.Message(b"data"))
+
+        self.messaging._on_link_loop_pass()
+        self.assertEqual(self.messaging.packeter.send_packet.call_count, 3)
+        self.messaging._on_link_loop_pass()
+        self.assertEqual(self.messaging.packeter.send_packet.call_count, 3)
+
+        # sent packet refills the window without waiting for the loop pass
+        self.messaging._on_packet_sent("conn_id1", 0)
+        self.assertEqual(self.messaging.packeter.send_packet.call_count, 4)
+        self.messaging._on_packet_sent("conn_id1", 1)
+        self.messaging._on_packet_sent("conn_id1", 2)
+        self.assertEqual(self.messaging.packeter.send_packet.call_count, 5)
+        self.assertEqual(self.messaging._in_flight["conn_id1"][0], 2)
+
+    ##############################################################
+
+    def test_send_window_size(self):
+        """
+        Window size is measured in bytes but a single message is always sent.
+        """
+        packet_ids = iter(range(100))
+        self.messaging.packeter.send_packet.side_effect = \
+                                                lambda *args: next(packet_ids)
+        self.messaging.send_window_size = 10
+        self.messaging.parse_identification(b"peerident", "conn_id1")
+        for i in range(2):
+            self.messaging.send_message("peerident",
+                                        snakemq.message.Message(b"x" * 100))
+
+        self.messaging._on_link_loop_pass()
+        self.assertEqual(self.messaging.packeter.send_packet.call_count, 1)
+        self.messaging._on_packet_sent("conn_id1", 0)
+        self.assertEqual(self.messaging.packeter.send_packet.call_count, 2)
+        self.messaging._on_packet_sent("conn_id1", 1)
+        self.assertEqual(self.messaging._in_flight["conn_id1"], [0, 0])
+
+    ##############################################################
+
+    def test_message_batch(self):
+        """
+        Queued messages are packed into a single frame, sent notifications
+        are delivered for all of them.
+        """
+        self.messaging.on_message_sent = mock.Mock()
+        packet_ids = iter(range(100))
+        self.messaging.packeter.send_packet.side_effect = \
+                                                lambda *args: next(packet_ids)
+        self.messaging.batch_max_size = 100
+        self.messaging.parse_identification(b"peerident", "conn_id1")
+        capabilities = self.messaging.frame_capabilities()
+        self.messaging._on_packet_recv("conn_id1", capabilities)
+        messages = [snakemq.message.Message(b"x" * 30, ttl=None)
+                    for i in range(5)]
+        for msg in messages:
+            self.messaging.send_message("peerident", msg)
+
+        self.messaging._on_link_loop_pass()
+        # 3 messages fit into the batch, the rest goes in another one
+        send_packet = self.messaging.packeter.send_packet
+        self.assertEqual(send_packet.call_count, 2)
+        self.assertEqual(self.messaging._in_flight["conn_id1"][0], 2)
+        frame = send_packet.call_args_list[0][0][1]
+        self.messaging._on_packet_sent("conn_id1", 0)
+        self.assertEqual([call[0][2] for call in
+                          self.messaging.on_message_sent.call_args_list],
+                         [msg.uuid for msg in messages[:3]])
+
+        self.messaging.on_message_recv = mock.Mock()
+        payload = memview(frame)[snakemq.messaging.FRAME_TYPE_SIZE:]
+        self.messaging.parse_message_batch(payload, "conn_id1")
+        received = [call[0][2] for call in
+                    self.messaging.on_message_recv.call_args_list]
+        self.assertEqual([(msg.uuid, msg.data, msg.ttl) for msg in received],
+                         [(msg.uuid, msg.data, None) for msg in messages[:3]])
+
+    ##############################################################
+
+    def test_broken_message_batch(self):
+        self.messaging.on_message_recv = mock.Mock()
+        self.messaging.parse_identification(b"peerident", "conn_id1")
+        messages = [snakemq.message.Message(b"data") for i in range(2)]
+        frame = self.messaging.frame_message_batch(messages)
+        self.messaging._on_packet_recv("conn_id1", frame[:-1])
+        self.assertEqual(self.messaging.on_message_recv.call_count, 0)
+        self.assertEqual(self.messaging.packeter.link.close.call_count, 1)
+
+    ##############################################################
+
+    def test_message_batch_entries(self):
+        """
+        TTL, flags and UUID prefix are sent only when they change.
+        """
+        self.messaging.on_message_recv = mock.Mock()
+        self.messaging.parse_identification(b"peerident", "conn_id1")
+        messages = [snakemq.message.Message(b"a"),
+                    snakemq.message.Message(b"b" * 200),
+                    snakemq.message.Message(b"c", ttl=5, flags=1),
+                    snakemq.message.Message(b"d", ttl=5, flags=1,
+                                            uuid=b"x" * 16),
+                    snakemq.message.Message(b"e", uuid=b"short")]
+        frame = self.messaging.frame_message_batch(messages[:2])
+        # presence, UUID, length | presence, UUID suffix, 2B length
+        self.assertEqual(len(frame),
+                         snakemq.messaging.FRAME_TYPE_SIZE + 1 + 16 + 1 + 1 +
+                         1 + 8 + 2 + 200)
+        frame = self.messaging.frame_message_batch(messages)
+        payload = memview(frame)[snakemq.messaging.FRAME_TYPE_SIZE:]
+        self.messaging.parse_message_batch(payload, "conn_id1")
+        received = [call[0][2] for call in
+                    self.messaging.on_message_recv.call_args_list]
+        self.assertEqual([(msg.uuid, msg.data, msg.ttl, msg.flags)
+                          for msg in received],
+                         [(msg.uuid.ljust(16, b"\0"), msg.data, msg.ttl,
+                           msg.flags) for msg in messages])
+
+    def test_message_batch_suffix_first(self):
+        self.messaging.on_message_recv = mock.Mock()
+        self.messaging.parse_identification(b"peerident", "conn_id1")
+        payload = bytes(bytearray([snakemq.messaging.BATCH_ENTRY_UUID_SUFFIX])) \
+                    + b"x" * 8 + b"\0"
+        self.messaging._on_packet_recv("conn_id1",
+              bytes(bytearray([snakemq.messaging.FRAME_TYPE_MESSAGE_BATCH])) +
+              payload)
+        self.assertEqual(self.messaging.on_message_recv.call_count, 0)
+        self.assertEqual(self.messaging.packeter.link.close.call_count, 1)
+
+    def test_varint(self):
+        for value in (0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 0xffffffff):
+            packed = snakemq.messaging.pack_varint(value)
+            self.assertEqual(snakemq.messaging.unpack_varint(b"_" + packed, 1),
+                             (value, len(packed) + 1))
+        self.assertEqual(len(snakemq.messaging.pack_varint(0x7f)), 1)
+        self.assertEqual(len(snakemq.messaging.pack_varint(0x80)), 2)
+        # truncated
+        self.assertRaises(snakemq.exceptions.SnakeMQBrokenMessage,
+                          snakemq.messaging.unpack_varint, b"\x80", 0)
+        # overlong
+        self.assertRaises(snakemq.exceptions.SnakeMQBrokenMessage,
+                          snakemq.messaging.unpack_varint, b"\x80" * 6, 0)
+
+#############################################################################
+#############################################################################
+
+class TestMessagingCompression(utils.TestCase):
+    def setUp(self):
+        self.sender = snakemq.messaging.Messaging("sender", "", mock.Mock())
+        self.receiver = snakemq.messaging.Messaging("receiver", "",
+                                                    mock.Mock())
+        self.receiver.on_message_recv = mock.Mock()
+        self.receiver.parse_identification(b"sender", "conn_id1")
+        self.sender.compression_threshold = 100
+
+    ##############################################################
+
+    def announce(self):
+        frame = self.receiver.frame_capabilities()
+        self.sender._on_packet_recv("conn_id1", frame)
+
+    def transfer(self, message):
+        frame = self.sender.frame_message(message, "conn_id1")
+        self.receiver._on_packet_recv("conn_id1", frame)
+        return frame, self.receiver.on_message_recv.call_args[0][2]
+
+    ##############################################################
+
+    def test_zlib_stream(self):
+        self.sender.compression = snakemq.messaging.COMPRESSION_ZLIB
+        self.announce()
+        data = b'{"key": "value", "counter": 1234}' * 10
+        sizes = []
+        for i in range(3):
+            msg = snakemq.message.Message(data,
+                          flags=snakemq.message.FLAG_PERSISTENT)
+            frame, message = self.transfer(msg)
+            sizes.append(len(frame))
+            self.assertEqual(message.data, data)
+            self.assertEqual(message.flags, snakemq.message.FLAG_PERSISTENT)
+        self.assertTrue(sizes[0] < len(data))
+        # the stream context remembers previous messages
+        self.assertTrue(sizes[1] < sizes[0])
+
+    ##############################################################
+
+    def test_lzma(self):
+        if snakemq.messaging.lzma is None:
+            raise nose.SkipTest("lzma is not available")
+        self.sender.compression = snakemq.messaging.COMPRESSION_LZMA
+        self.announce()
+        data = b"x" * 1000
+        frame, message = self.transfer(snakemq.message.Message(data))
+        self.assertTrue(len(frame) < len(data))
+        self.assertEqual(message.data, data)
+        self.assertEqual(message.flags, 0)
+
+    ##############################################################
+
+    def test_not_compressed(self):
+        """
+        Small messages and peers without the capability get raw data.
+        """
+        self.sender.compression = snakemq.messaging.COMPRESSION_ZLIB
+        data = b"x" * 1000
+        frame, message = self.transfer(snakemq.message.Message(data))
+        self.assertTrue(frame.endswith(data))
+        self.announce()
+        frame, message = self.transfer(snakemq.message.Message(b"x" * 99))
+        self.assertTrue(frame.endswith(b"x" * 99))
+
+    ##############################################################
+
+    def test_broken_compressed_message(self):
+        frame = (struct.pack(snakemq.messaging.FRAME_TYPE_TYPE,
+                             snakemq.messaging.FRAME_TYPE_MESSAGE) +
+                 struct.pack(snakemq.messaging.FRAME_FORMAT_MESSAGE,
+                             b"uuid", 0, snakemq.messaging.FRAME_FLAG_ZLIB) +
+                 b"garbage")
+        self.receiver._on_packet_recv("conn_id1", frame)
+        self.assertEqual(self.receiver.on_message_recv.call_count, 0)
+        self.assertEqual(self.receiver.packeter.link.close.call_count, 1)
+
+    ##############################################################
+
+    def check_decompress_limit(self, compression):
+        self.sender.compression = compression
+        self.announce()
+        self.receiver.decompress_limit = 1000
+        frame, message = self.transfer(snakemq.message.Message(b"x" * 1000))
+        self.assertEqual(message.data, b"x" * 1000)
+        self.assertEqual(self.receiver.packeter.link.close.call_count, 0)
+
+        # a small frame must not be inflated beyond the limit
+        frame = self.sender.frame_message(snakemq.message.Message(b"x" * 1001),
+                                          "conn_id1")
+        self.assertTrue(len(frame) < 100)
+        self.receiver._on_packet_recv("conn_id1", frame)
+        self.assertEqual(self.receiver.on_message_recv.call_count, 1)
+        self.assertEqual(self.receiver.packeter.link.close.call_count, 1)
+
+    def test_decompress_limit_zlib(self):
+        self.check_decompress_limit(snakemq.messaging.COMPRESSION_ZLIB)
+
+    def test_decompress_limit_lzma(self):
+        if snakemq.messaging.lzma is None:
+            raise nose.SkipTest("lzma is not available")
+        self.check_decompress_limit(snakemq.messaging.COMPRESSION_LZMA)
+
+    ##############################################################
+
+    def test_reserved_flags(self):
+        msg = snakemq.message.Message(b"data")
+        msg.flags = snakemq.messaging.FRAME_FLAG_ZLIB
+        self.assertRaises(ValueError, self.sender.send_message, "receiver", msg)
+
+    ##############################################################
+
+    def test_disconnect_resets_stream(self):
+        self.sender.compression = snakemq.messaging.COMPRESSION_ZLIB
+        self.sender._touch_keepalive("conn_id1")
+        self.announce()
+        self.transfer(snakemq.message.Message(b"x" * 1000))
+        self.assertEqual(len(self.sender._compressors), 1)
+        self.sender._on_disconnect("conn_id1")
+        self.assertEqual(self.sender._compressors, {})
+        self.assertEqual(self.sender._capabilities, {})
+
 #############################################################################
 #############################################################################
 
@@ -152,3 +434,50 @@ class TestReceiveHook(utils.TestCase):
         self.assertEqual(set(self.hook._get_callbacks("aa")), set(["1", "2"]))
         self.assertEqual(set(self.hook._get_callbacks("aax")), set(["1", "2"]))
         self.assertEqual(set(self.hook._get_callbacks("abx")), set(["2", "3"]))
+
+    ##############################################################
+
+    def test_registration_order(self):
+        self.hook.register(b"ab", "1")
+        self.hook.register(b"a.", "2")  # pattern
+        self.hook.register(b"a", "3")
+        self.hook.register(b"abc", "4")
+        self.assertEqual(self.hook._get_callbacks(b"abcd"), ["1", "2", "3", "4"])
+        self.assertEqual(self.hook._get_callbacks(b"ax"), ["2", "3"])
+        self.assertEqual(self.hook._get_callbacks(b"a"), ["3"])
+        self.assertEqual(self.hook._get_callbacks(b"b"), [])
+        self.hook.unregister(b"a.")
+        self.assertEqual(self.hook._get_callbacks(b"abcd"), ["1", "3", "4"])
+        # re-registration moves the hook to the end
+        self.hook.register(b"ab", "5")
+        self.assertEqual(self.hook._get_callbacks(b"abcd"), ["3", "4", "5"])
+
+    ##############################################################
+
+    def test_literal_routing(self):
+        self.hook.register(b"rpcreq", "1")
+        self.hook.register(b"rpcrep", "2")
+        self.assertEqual(self.hook._patterns, [])
+        self.assertEqual(self.hook._get_callbacks(b"rpcreq\x01"), ["1"])
+        self.assertEqual(self.hook._get_callbacks(b"rpcrep\x01"), ["2"])
+        self.assertEqual(self.hook._get_callbacks(b"rpcre"), [])
+        self.assertEqual(set(self.hook._routes), set([b"rpcreq", b"rpcrep",
+                                                      b"rpcre"]))
+
+    ##############################################################
+
+    def test_compiled_regexp(self):
+        self.hook.register(re.compile(b"a.c"), "1")
+        self.hook.register(re.compile(b"ab"), "2")
+        self.assertEqual(self.hook._get_callbacks(b"abc"), ["1", "2"])
+        self.assertEqual(self.hook._get_callbacks(b"ab"), ["2"])
+
+    ##############################################################
+
+    def test_invalid_regexp(self):
+        self.hook.register(b"a", "1")
+        self.assertRaises(re.error, self.hook.register, b"(", "2")
+        self.assertEqual(list(self.hook._hooks), [b"a"])
+        self.hook.register(b"b", "3")
+        self.hook.unregister(b"a")
+        self.assertEqual(self.hook._get_callbacks(b"b"), ["3"])
@@ -6,7 +6,7 @@
 """
 
 import threading
-import sys
+import socket
 
 import nose
 import mock
@@ -26,7 +26,7 @@ LOOP_RUNTIME = 1.5
 #############################################################################
 #############################################################################
 
-has_ssl = sys.version_info < (3, 5)
+has_ssl = snakemq.link.HAS_SSL
 
 #############################################################################
 #############################################################################
@@ -156,6 +156,75 @@ class TestPacketer(utils.TestCase):
         self.assertEqual(packeter.on_packet_sent.call_args[0],
                             ("connid2", pid2))
 
+    ########################################################
+
+    def test_recv_memoryview(self):
+        link = snakemq.link.Link()
+        try:
+            packeter = snakemq.packeter.Packeter(link=link)
+            self.assertTrue(link.recv_memoryview)
+            packeter.on_packet_recv = mock.Mock()
+            received = []
+            link.on_recv.add(lambda conn_id, data: received.append(data))
+            packeter._on_connect("c")
+            sock = snakemq.link.LinkSocket(mock.Mock(spec=socket.socket))
+            sock.conn_id = "c"
+            data = snakemq.packeter.size_to_bin(3) + b"abc"
+            def recv_into(buf):
+                buf[:len(data)] = data
+                return len(data)
+            sock.sock.recv_into.side_effect = recv_into
+            link.handle_recv(sock)
+            self.assertIsInstance(received[0], memoryview)
+            packeter.on_packet_recv.assert_called_once_with("c", b"abc")
+        finally:
+            link.cleanup()
+
+#############################################################################
+#############################################################################
+
+class TestReceiveBuffer(utils.TestCase):
+    def setUp(self):
+        self.buf = snakemq.packeter.ReceiveBuffer()
+
+    ########################################################
+
+    def packet(self, data):
+        return snakemq.packeter.size_to_bin(len(data)) + data
+
+    ########################################################
+
+    def test_multiple_packets(self):
+        self.buf.put(self.packet(b"ab") + self.packet(b"") + self.packet(b"cde"))
+        self.assertEqual(self.buf.get_packets(), [b"ab", b"", b"cde"])
+        self.assertEqual(len(self.buf), 0)
+        self.assertEqual(self.buf.get_packets(), [])
+
+    ########################################################
+
+    def test_fragmented_packets(self):
+        data = self.packet(b"abcd") + self.packet(b"efg")
+        # header and payload split in all possible places
+        for i in range(len(data) + 1):
+            self.buf.put(data[:i])
+            packets = self.buf.get_packets()
+            self.buf.put(memoryview(data)[i:])
+            packets += self.buf.get_packets()
+            self.assertEqual(packets, [b"abcd", b"efg"], i)
+            self.assertEqual(len(self.buf), 0)
+
+    ########################################################
+
+    def test_compaction(self):
+        data = self.packet(b"a" * 10)
+        self.buf.put(data + data[:5])
+        self.assertEqual(self.buf.get_packets(), [b"a" * 10])
+        self.buf.put(data[5:])
+        # consumed data (including the already parsed header) were discarded
+        self.assertEqual(len(self.buf.buf),
+                          len(data) - snakemq.packeter.SIZEOF_BIN_SIZE)
+        self.assertEqual(self.buf.get_packets(), [b"a" * 10])
+
 #############################################################################
 #############################################################################
 
@@ -170,3 +239,12 @@ class TestPacketerSSL(TestPacketer):
         link_client.add_connector(("localhost", TEST_PORT), ssl_config=cfg)
         return link_server, link_client
 
+#############################################################################
+#############################################################################
+
+class TestPacketerSSLOffloaded(TestPacketerSSL):
+    def create_links(self):
+        link_server, link_client = TestPacketerSSL.create_links(self)
+        link_server.offload_ssl(records=True)
+        link_client.offload_ssl(records=True)
+        return link_server, link_client
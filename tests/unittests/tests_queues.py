@@ -8,12 +8,16 @@
 import os
 import warnings
 import glob
+import shutil
 
 import mock
 
-from snakemq.queues import QueuesManager
+from snakemq.queues import QueuesManager, LOAD_PAGE_SIZE
 from snakemq.storage import MemoryQueuesStorage
 from snakemq.storage.sqlite import SqliteQueuesStorage
+from snakemq.storage.segmentlog import (SegmentedLogQueuesStorage,
+                                        SYNC_ALWAYS, ITEM_HEADER_SIZE,
+                                        ACK_SIZE, ACKS_FILENAME)
 from snakemq.message import Message, FLAG_PERSISTENT
 
 try:
@@ -78,6 +82,41 @@ class TestQueue(utils.TestCase):
 
     ##################################################################
 
+    def test_remove(self):
+        queue = self.queues_manager.get_queue("testqueue")
+        queue.connect()
+        for uuid in (b"a", b"b", b"c"):
+            queue.push(Message(b"data", uuid=uuid, flags=FLAG_PERSISTENT,
+                               ttl=1))
+        self.assertTrue(queue.remove(b"b"))
+        self.assertFalse(queue.remove(b"b"))
+        self.assertFalse(queue.remove(b"x"))
+        self.assertEqual(len(queue), 2)
+        self.assertNotIn(b"b", queue)
+        stored_items = self.queues_manager.storage.get_items("testqueue")
+        self.assertEqual([item.uuid for item in stored_items], [b"a", b"c"])
+
+        queue.pop()
+        self.assertEqual(queue.get().uuid, b"c")  # "b" is skipped
+        self.assertTrue(queue.remove(b"c"))
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.get(), None)
+        self.assertEqual(len(queue.removed), 0)
+
+    ##################################################################
+
+    def test_update_ttl(self):
+        queue = self.queues_manager.get_queue("testqueue")
+        queue.connect()
+        queue.push(Message(b"data a", uuid=b"a", ttl=1))
+        queue.push(Message(b"data b", uuid=b"b", ttl=1))
+        self.assertTrue(queue.update_ttl(b"b", 5))
+        self.assertFalse(queue.update_ttl(b"x", 5))
+        queue.pop()
+        self.assertEqual(queue.get().ttl, 5)
+
+    ##################################################################
+
     def test_ttl(self):
         """
         Push 2 items, one will expire on connect.
@@ -97,6 +136,60 @@ class TestQueue(utils.TestCase):
 
     ##################################################################
 
+    def test_collect_garbage(self):
+        """
+        Expired items of a disconnected queue are dropped by the manager
+        without waiting for the queue connection.
+        """
+        on_item_drop = mock.Mock()
+        self.queues_manager.on_item_drop.add(on_item_drop)
+        queue = self.queues_manager.get_queue("testqueue")
+        with mock.patch("time.time") as time_mock:
+            time_mock.return_value = 0
+            queue.disconnect()
+            queue.push(Message(b"data a", uuid=b"a", ttl=5))
+            queue.push(Message(b"data b", uuid=b"b", ttl=1))
+            queue.push(Message(b"data c", uuid=b"c", ttl=None))
+
+            time_mock.return_value = 0.5
+            self.queues_manager.collect_garbage()
+            self.assertEqual(len(queue), 3)
+
+            time_mock.return_value = 2
+            self.queues_manager.collect_garbage()
+            self.assertEqual(len(queue), 2)
+            on_item_drop.assert_called_once_with("testqueue", b"b")
+
+            time_mock.return_value = 6
+            self.queues_manager.collect_garbage()
+            self.assertEqual(len(queue), 1)
+            self.assertEqual(queue.get().uuid, b"c")
+            self.assertEqual(self.queues_manager.expiration_plan, [])
+
+    ##################################################################
+
+    def test_ttl_decreases_only_when_disconnected(self):
+        queue = self.queues_manager.get_queue("testqueue")
+        with mock.patch("time.time") as time_mock:
+            time_mock.return_value = 0
+            queue.disconnect()
+            queue.push(Message(b"data a", uuid=b"a", ttl=5))
+            time_mock.return_value = 2
+            queue.connect()
+            time_mock.return_value = 100
+            self.queues_manager.collect_garbage()
+            self.assertEqual(queue.get().ttl, 3)
+            queue.disconnect()
+            time_mock.return_value = 102.5
+            queue.connect()
+            self.assertEqual(queue.get().ttl, 0.5)
+            queue.disconnect()
+            time_mock.return_value = 104
+            self.queues_manager.collect_garbage()
+            self.assertEqual(len(queue), 0)
+
+    ##################################################################
+
     def test_ttl_none(self):
         queue = self.queues_manager.get_queue("testqueue")
         queue.disconnect()
@@ -198,6 +291,103 @@ class TestQueue(utils.TestCase):
             queue.connect()
             self.assertEqual(len(queue), 1)
 
+    ##################################################################
+
+    def test_lazy_loading(self):
+        queue = self.queues_manager.get_queue("testqueue")
+        count = LOAD_PAGE_SIZE * 2 + 10
+        for i in range(count):
+            queue.push(Message(b"data", uuid=str(i).encode(), ttl=None,
+                                flags=FLAG_PERSISTENT))
+
+        self.queue_manager_restart()
+        queue = self.queues_manager.get_queue("testqueue")
+        self.assertEqual(len(queue.queue), 0)
+        self.assertEqual(len(queue), count)
+        queue.push(Message(b"data", uuid=b"new", ttl=None,
+                            flags=FLAG_PERSISTENT))
+        self.assertEqual(len(queue), count + 1)
+
+        queue.connect()
+        self.assertEqual(len(queue.queue), LOAD_PAGE_SIZE)
+        self.assertTrue(queue.remove(str(LOAD_PAGE_SIZE + 1).encode()))
+        self.assertEqual(len(queue), count)
+        uuids = []
+        while queue:
+            uuids.append(queue.get().uuid)
+            queue.pop()
+        expected = [str(i).encode() for i in range(count)
+                    if i != LOAD_PAGE_SIZE + 1]
+        self.assertEqual(uuids, expected + [b"new"])
+        self.assertEqual(len(self.storage.get_items("testqueue")), 0)
+
+    ##################################################################
+
+    def test_lazy_loading_ttl(self):
+        queue = self.queues_manager.get_queue("testqueue")
+        queue.connect()
+        queue.push(Message(b"data a", uuid=b"a", ttl=1, flags=FLAG_PERSISTENT))
+        queue.push(Message(b"data b", uuid=b"b", ttl=5, flags=FLAG_PERSISTENT))
+
+        self.queue_manager_restart()
+        queue = self.queues_manager.get_queue("testqueue")
+
+        with mock.patch("time.time") as time_mock:
+            time_mock.return_value = 0
+            queue.disconnect()
+            time_mock.return_value = 3
+            queue.collect_garbage()  # nothing is loaded yet
+            self.assertEqual(len(queue), 2)
+            self.assertEqual(queue.get().uuid, b"b")
+            self.assertEqual(len(queue), 1)
+            self.assertEqual(len(self.storage.get_items("testqueue")), 1)
+
+    ##################################################################
+
+    def test_lazy_loading_ttl_restart(self):
+        """
+        Disconnected time is applied to items which have never been loaded.
+        """
+        queue = self.queues_manager.get_queue("testqueue")
+        queue.connect()
+        for i in range(LOAD_PAGE_SIZE):
+            queue.push(Message(b"data", uuid=str(i).encode(), ttl=None,
+                                flags=FLAG_PERSISTENT))
+        queue.push(Message(b"data a", uuid=b"a", ttl=5, flags=FLAG_PERSISTENT))
+        queue.push(Message(b"data b", uuid=b"b", ttl=10, flags=FLAG_PERSISTENT))
+
+        ttls = lambda: dict((item.uuid, item.ttl) for item in
+                            self.storage.get_items("testqueue")
+                            if item.ttl is not None)
+        dropped = []
+        with mock.patch("time.time") as time_mock:
+            self.queue_manager_restart()
+            queue = self.queues_manager.get_queue("testqueue")
+            time_mock.return_value = 0
+            queue.disconnect()
+            time_mock.return_value = 3
+            queue.connect()  # loads just the first page
+            self.assertEqual(queue.unloaded, 2)
+            self.assertEqual(ttls(), {b"a": 2, b"b": 7})
+
+            self.queue_manager_restart()
+            self.queues_manager.on_item_drop.add(
+                      lambda queue_name, item_uuid: dropped.append(item_uuid))
+            queue = self.queues_manager.get_queue("testqueue")
+            time_mock.return_value = 0
+            queue.disconnect()
+            time_mock.return_value = 4
+            queue.connect()
+            self.assertEqual(dropped, [b"a"])
+            self.assertEqual(len(queue), LOAD_PAGE_SIZE + 1)
+            self.assertEqual(ttls(), {b"b": 3})
+
+        uuids = []
+        while queue:
+            uuids.append(queue.get().uuid)
+            queue.pop()
+        self.assertEqual(uuids[-2:], [str(LOAD_PAGE_SIZE - 1).encode(), b"b"])
+
 ############################################################################
 ############################################################################
 
@@ -315,11 +505,36 @@ class BaseTestStorageMixin(object):
 
     ####################################################
 
+    def test_shift_ttl(self):
+        self.storage.push("q1", Message(b"a", ttl=10))
+        self.storage.push("q1", Message(b"b", ttl=None))
+        self.storage.push("q1", Message(b"c", ttl=1))
+        self.storage.push("q2", Message(b"d", ttl=1))
+        expired = self.storage.shift_items_ttl("q1", 5)
+        self.assertEqual([item.data for item in expired], [b"c"])
+        self.assertEqual([item.ttl for item in self.storage.get_items("q1")],
+                         [5, None, -4])
+        self.assertEqual(self.storage.get_items("q2")[0].ttl, 1)
+
+    ####################################################
+
     def test_queue_ordering(self):
         self.storage.push("q1", Message(b"a"))
         self.storage.push("q1", Message(b"b"))
         self.assertEqual(self.storage.get_items("q1")[0].data, b"a")
 
+    ####################################################
+
+    def test_iter_items(self):
+        self.storage.push("q1", Message(b"a"))
+        self.storage.push("q2", Message(b"b"))
+        self.storage.push("q1", Message(b"c"))
+        self.assertEqual(self.storage.get_items_count("q1"), 2)
+        items = self.storage.iter_items("q1")
+        self.storage.push("q1", Message(b"d"))  # not in the iteration
+        self.assertEqual([item.data for item in items], [b"a", b"c"])
+        self.assertEqual(self.storage.get_items_count("q1"), 3)
+
 ############################################################################
 ############################################################################
 
@@ -351,6 +566,319 @@ class TestSqliteStorage(BaseTestStorageMixin, utils.TestCase):
         if os.path.isfile(TestSqliteStorage.STORAGE_FILENAME):
             os.unlink(TestSqliteStorage.STORAGE_FILENAME)
 
+    ####################################################
+
+    def test_iter_items_pages(self):
+        for i in range(5):
+            self.storage.push("q1", Message(str(i).encode()))
+        items = self.storage.iter_items("q1", page_size=2)
+        self.assertEqual([item.data for item in items],
+                          [b"0", b"1", b"2", b"3", b"4"])
+
+    ####################################################
+
+    def test_sweep(self):
+        for i in range(100):
+            self.storage.push("q1", Message(b"x" * 10000))
+        self.storage.delete_all()
+        self.storage.flush()
+        crs = self.storage.crs
+        crs.execute("PRAGMA freelist_count")
+        self.assertGreater(crs.fetchone()[0], 0)
+        self.storage.sweep()
+        crs.execute("PRAGMA freelist_count")
+        self.assertEqual(crs.fetchone()[0], 0)
+
+    ####################################################
+
+    def test_lazy_loading_reused_rowid(self):
+        """
+        Item pushed while loading lazily might get a rowid of a deleted item
+        and it must not be delivered twice.
+        """
+        manager = QueuesManager(self.storage)
+        for uuid in (b"a0", b"a1", b"a2"):
+            manager.get_queue("a").push(Message(b"data", uuid=uuid, ttl=None,
+                                                flags=FLAG_PERSISTENT))
+        manager.get_queue("b").push(Message(b"data", uuid=b"b0", ttl=None,
+                                            flags=FLAG_PERSISTENT))
+        manager.close()
+
+        self.storage_factory()
+        manager = QueuesManager(self.storage)
+        queue = manager.get_queue("b")
+        queue.connect()
+        queue.pop()
+        queue = manager.get_queue("a")
+        queue.push(Message(b"data", uuid=b"new", ttl=None,
+                           flags=FLAG_PERSISTENT))
+        queue.connect()
+        uuids = []
+        while queue:
+            uuids.append(queue.get().uuid)
+            queue.pop()
+        self.assertEqual(uuids, [b"a0", b"a1", b"a2", b"new"])
+
+############################################################################
+############################################################################
+
+class TestSqliteGroupCommitStorage(TestSqliteStorage):
+    def storage_factory(self):
+        self.storage = SqliteQueuesStorage(TestSqliteStorage.STORAGE_FILENAME,
+                                          group_commit=True)
+
+    ####################################################
+
+    def test_flush(self):
+        other = SqliteQueuesStorage(TestSqliteStorage.STORAGE_FILENAME)
+        try:
+            self.storage.push("q1", Message(b"a"))
+            self.storage.push("q1", Message(b"b"))
+            self.assertEqual(len(other.get_items("q1")), 0)
+            self.storage.flush()
+            self.assertEqual(len(other.get_items("q1")), 2)
+        finally:
+            other.close()
+
+############################################################################
+############################################################################
+
+class TestSegmentedLogStorage(BaseTestStorageMixin, utils.TestCase):
+    STORAGE_DIRECTORY = "testqueuestorage.segmentlog"
+
+    def storage_factory(self, **kwargs):
+        self.storage = SegmentedLogQueuesStorage(
+                            TestSegmentedLogStorage.STORAGE_DIRECTORY, **kwargs)
+
+    def delete_storage(self):
+        if os.path.isdir(TestSegmentedLogStorage.STORAGE_DIRECTORY):
+            shutil.rmtree(TestSegmentedLogStorage.STORAGE_DIRECTORY)
+
+    def reopen(self, **kwargs):
+        self.storage.close()
+        self.storage_factory(**kwargs)
+
+    def segment_files(self, queue_name):
+        queue = self.storage.queues[queue_name]
+        return glob.glob(os.path.join(queue.directory, "*.seg"))
+
+    ####################################################
+
+    def test_acks_persistence(self):
+        msgs = [Message(b"a", ttl=10), Message(b"b", ttl=None),
+                Message(b"c", ttl=1)]
+        for msg in msgs:
+            self.storage.push("q1", msg)
+        self.storage.delete_items([msgs[1]])
+        msgs[2].ttl = 5
+        self.storage.update_items_ttl([msgs[2]])
+        self.reopen()
+        items = self.storage.get_items("q1")
+        self.assertEqual([item.data for item in items], [b"a", b"c"])
+        self.assertEqual(items[1].ttl, 5)
+        self.storage.delete_items(items)
+        self.reopen()
+        self.assertEqual(self.storage.get_queues(), [])
+
+    ####################################################
+
+    def test_segment_rolling(self):
+        self.reopen(segment_size=100)
+        msgs = [Message(b"x" * 60) for i in range(4)]
+        for msg in msgs:
+            self.storage.push("q1", msg)
+        self.assertEqual(len(self.segment_files("q1")), 4)
+        # the segment without live items is removed
+        self.storage.delete_items(msgs[:2])
+        self.assertEqual(len(self.segment_files("q1")), 2)
+        self.reopen(segment_size=100)
+        self.assertEqual(len(self.storage.get_items("q1")), 2)
+
+    ####################################################
+
+    def test_compaction(self):
+        msgs = [Message(b"x" * 10) for i in range(10)]
+        for msg in msgs:
+            self.storage.push("q1", msg)
+        self.storage.delete_items(msgs[::2])
+        self.storage.compact()
+        queue = self.storage.queues["q1"]
+        self.assertEqual(queue.dead_count(), 0)
+        self.assertEqual(queue.acks_count, 0)
+        self.storage.push("q1", Message(b"new"))
+        self.reopen()
+        items = self.storage.get_items("q1")
+        self.assertEqual([item.uuid for item in items[:-1]],
+                          [msg.uuid for msg in msgs[1::2]])
+        self.assertEqual(items[-1].data, b"new")
+
+    ####################################################
+
+    def test_iter_items_survives_compaction(self):
+        msgs = [Message(str(i).encode()) for i in range(6)]
+        for msg in msgs:
+            self.storage.push("q1", msg)
+        items = self.storage.iter_items("q1")
+        self.assertEqual(next(items).data, b"0")
+        self.storage.delete_items(msgs[1:3])
+        self.storage.compact()
+        self.assertEqual([item.data for item in items], [b"3", b"4", b"5"])
+
+    ####################################################
+
+    def test_iter_items_holds_segments(self):
+        self.reopen(segment_size=10)
+        msgs = [Message(str(i).encode() * 10) for i in range(4)]
+        for msg in msgs:
+            self.storage.push("q1", msg)
+        queue = self.storage.queues["q1"]
+        items = self.storage.iter_items("q1")
+        self.assertEqual(next(items).uuid, msgs[0].uuid)
+        held = queue.segments[0].path
+
+        # the open segment is not removed, the queue is not compacted
+        self.storage.delete_items(msgs[:2])
+        self.assertTrue(os.path.exists(held))
+        self.assertEqual(len(self.segment_files("q1")), 3)
+        self.storage.compact()
+        self.assertNotEqual(queue.acks_count, 0)
+        self.storage.push("q1", Message(b"new"))
+
+        self.assertEqual([item.uuid for item in items],
+                          [msg.uuid for msg in msgs[2:]])
+        self.assertFalse(os.path.exists(held))
+        self.storage.compact()
+        self.assertEqual(queue.acks_count, 0)
+        self.reopen(segment_size=10)
+        self.assertEqual([item.data for item in self.storage.get_items("q1")],
+                          [b"2" * 10, b"3" * 10, b"new"])
+
+    ####################################################
+
+    def test_held_segment_number_not_reused(self):
+        msg = Message(b"a")
+        self.storage.push("q1", msg)
+        self.storage.compact()  # closes the active segment
+        items = self.storage.iter_items("q1")
+        self.assertEqual(next(items).data, b"a")
+        self.storage.delete_items([msg])
+        self.storage.push("q1", Message(b"b"))
+        self.assertEqual(list(items), [])
+        self.reopen()
+        self.assertEqual([item.data for item in self.storage.get_items("q1")],
+                          [b"b"])
+
+    ####################################################
+
+    def test_incomplete_write(self):
+        self.reopen(sync=SYNC_ALWAYS)
+        self.storage.push("q1", Message(b"a"))
+        self.storage.push("q1", Message(b"b"))
+        filename = self.segment_files("q1")[0]
+        self.storage.close()
+        with open(filename, "r+b") as f:
+            f.truncate(os.path.getsize(filename) - 1)
+        self.storage_factory()
+        self.assertEqual([item.data for item in self.storage.get_items("q1")],
+                          [b"a"])
+        self.storage.push("q1", Message(b"c"))
+        self.reopen()
+        self.assertEqual([item.data for item in self.storage.get_items("q1")],
+                          [b"a", b"c"])
+
+    ####################################################
+
+    def push_sealed(self, msgs):
+        """
+        :return: path of the segment with the messages, new messages go to
+                 another one
+        """
+        for msg in msgs:
+            self.storage.push("q1", msg)
+        path = self.segment_files("q1")[0]
+        self.reopen()
+        return path
+
+    def corrupt(self, path, offset, data):
+        with open(path, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+
+    ####################################################
+
+    def test_damaged_record(self):
+        """
+        Records after a damaged one are kept, even in the last segment.
+        """
+        msgs = [Message(c, uuid=c * 16) for c in (b"a", b"b", b"c")]
+        record_size = ITEM_HEADER_SIZE + 16 + 1
+        path = self.push_sealed(msgs)
+        self.corrupt(path, record_size * 2 - 1, b"x")  # data of "b"
+        size = os.path.getsize(path)
+        self.reopen()
+        self.assertEqual([item.data for item in self.storage.get_items("q1")],
+                          [b"a", b"c"])
+        self.assertEqual(os.path.getsize(path), size)
+
+        self.storage.push("q1", Message(b"d"))
+        self.reopen()
+        self.assertEqual([item.data for item in self.storage.get_items("q1")],
+                          [b"a", b"c", b"d"])
+
+    ####################################################
+
+    def test_damaged_sealed_segment(self):
+        """
+        Unreadable rest of a sealed segment is not truncated.
+        """
+        msgs = [Message(c, uuid=c * 16) for c in (b"a", b"b", b"c")]
+        record_size = ITEM_HEADER_SIZE + 16 + 1
+        path = self.push_sealed(msgs)
+        self.storage.push("q1", Message(b"d"))
+        # data length of "b" points beyond the file
+        self.corrupt(path, record_size + 12, b"\xff")
+        size = os.path.getsize(path)
+        self.reopen()
+        items = self.storage.get_items("q1")
+        self.assertEqual([item.data for item in items], [b"a", b"d"])
+        self.assertEqual(os.path.getsize(path), size)
+        self.storage.delete_items(items[:1])
+        self.storage.compact()
+        self.assertEqual(os.path.getsize(path), size)
+
+    ####################################################
+
+    def test_damaged_ack(self):
+        msgs = [Message(c) for c in (b"a", b"b", b"c")]
+        for msg in msgs:
+            self.storage.push("q1", msg)
+        self.storage.delete_items(msgs[:2])
+        queue_dir = self.storage.queues["q1"].directory
+        self.storage.close()
+        self.corrupt(os.path.join(queue_dir, ACKS_FILENAME), 5, b"\xff")
+        self.storage_factory()
+        # the first deletion is lost, the second one is still applied
+        self.assertEqual([item.data for item in self.storage.get_items("q1")],
+                          [b"a", b"c"])
+
+    ####################################################
+
+    def test_compaction_interval(self):
+        with mock.patch("time.time") as time_mock:
+            time_mock.return_value = 0
+            self.reopen(compact_interval=10)
+            msgs = [Message(b"x") for i in range(20)]
+            for msg in msgs:
+                self.storage.push("q1", msg)
+            self.storage.delete_items(msgs[:15])
+            queue = self.storage.queues["q1"]
+            with mock.patch("snakemq.storage.segmentlog.COMPACT_MIN_DEAD", 1):
+                self.storage.flush()
+                self.assertEqual(queue.dead_count(), 15)
+                time_mock.return_value = 10
+                self.storage.flush()
+                self.assertEqual(queue.dead_count(), 0)
+
 ############################################################################
 ############################################################################
 
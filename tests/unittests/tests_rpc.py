@@ -5,11 +5,15 @@
           U{http://www.opensource.org/licenses/mit-license.php})
 """
 
+import pickle
+import marshal
 from collections import defaultdict
 
 import mock
 
 import snakemq.rpc
+import snakemq.message
+import snakemq.serializers
 
 import utils
 
@@ -40,10 +44,139 @@ class TestRpc(utils.TestCase):
 #############################################################################
 #############################################################################
 
+class TestEnvelope(utils.TestCase):
+    def setUp(self):
+        self.envelope = snakemq.rpc.Envelope()
+
+    ##############################################################
+
+    def test_request(self):
+        params = {"command": "call", "req_id": b"x" * 16, "object": "obj",
+                  "method": "m\u00e9thod", "args": (1, b"a"),
+                  "kwargs": {"k": None}}
+        raw = self.envelope.encode_request(params)
+        decoded = self.envelope.decode_request(b"prefix" + raw, 6)
+        self.assertEqual(decoded.pop("serializer"),
+                          snakemq.serializers.SERIALIZER_PICKLE)
+        self.assertEqual(decoded, params)
+        # cached names
+        self.assertEqual(self.envelope.decode_request(raw)["method"],
+                          params["method"])
+
+    ##############################################################
+
+    def test_batch(self):
+        requests = [{"command": "call", "req_id": b"a", "object": "obj",
+                     "method": "m", "args": (i,), "kwargs": {}}
+                    for i in range(3)]
+        raw = self.envelope.encode_request({"command": "batch",
+                                            "requests": requests})
+        decoded = self.envelope.decode_request(raw)
+        self.assertEqual(decoded["command"], "batch")
+        for request in decoded["requests"]:
+            del request["serializer"]
+        self.assertEqual(decoded["requests"], requests)
+
+    ##############################################################
+
+    def test_reply(self):
+        data = {"req_id": b"a", "ok": True, "return": [1, 2]}
+        self.assertEqual(self.envelope.decode_reply(
+                              self.envelope.encode_reply(data)),
+                          dict(data, envelope=snakemq.rpc.ENVELOPE_VERSION))
+        data = {"req_id": b"a", "ok": False, "exception": ValueError("x"),
+                "exception_format": "tb"}
+        decoded = self.envelope.decode_reply(
+                              self.envelope.encode_reply(data))
+        self.assertTrue(isinstance(decoded["exception"], ValueError))
+        self.assertEqual(decoded["exception_format"], "tb")
+
+    ##############################################################
+
+    def test_legacy(self):
+        params = {"command": "call", "req_id": b"a", "object": "obj",
+                  "method": "m", "args": (), "kwargs": {}}
+        decoded = self.envelope.decode_request(pickle.dumps(params))
+        self.assertEqual(decoded.pop("serializer"),
+                          snakemq.rpc.SERIALIZER_LEGACY)
+        self.assertEqual(decoded, params)
+        data = {"req_id": b"a", "ok": True, "return": 1}
+        raw = self.envelope.encode_reply(data, snakemq.rpc.SERIALIZER_LEGACY)
+        self.assertEqual(pickle.loads(raw),
+                          dict(data, envelope=snakemq.rpc.ENVELOPE_VERSION))
+
+    ##############################################################
+
+    def test_reply_serializer(self):
+        envelope = snakemq.rpc.Envelope(
+                            serializer=snakemq.serializers.MarshalSerializer())
+        params = {"command": "call", "req_id": b"a", "object": "obj",
+                  "method": "m", "args": (1,), "kwargs": {}}
+        decoded = self.envelope.decode_request(
+                            envelope.encode_request(params))
+        self.assertEqual(decoded["serializer"],
+                          snakemq.serializers.SERIALIZER_MARSHAL)
+        data = {"req_id": b"a", "ok": True, "return": 1}
+        raw = self.envelope.encode_reply(data, decoded["serializer"])
+        self.assertEqual(marshal.loads(raw[-len(marshal.dumps(1)):]), 1)
+        self.assertEqual(envelope.decode_reply(raw),
+                          dict(data, envelope=snakemq.rpc.ENVELOPE_VERSION))
+
+    ##############################################################
+
+    def test_interned_names(self):
+        params = {"command": "call", "req_id": b"a", "object": "obj",
+                  "method": "m", "args": (), "kwargs": {}}
+        names = snakemq.rpc.NameIds()
+        peer_names = {}
+        defined = set()
+        raw_defining = self.envelope.encode_request(params, names, defined)
+        self.assertEqual(defined, set([1]))
+        # not known until the defining message is sent
+        self.assertEqual(self.envelope.encode_request(params, names),
+                          raw_defining)
+        names.known.update(defined)
+        raw = self.envelope.encode_request(params, names)
+        self.assertTrue(len(raw) < len(raw_defining))
+
+        # the ID alone is not enough before the definition
+        self.assertRaises(snakemq.rpc.Error,
+                          self.envelope.decode_request, raw, names=peer_names)
+        self.envelope.decode_request(raw_defining, names=peer_names)
+        decoded = self.envelope.decode_request(raw, names=peer_names)
+        del decoded["serializer"]
+        self.assertEqual(decoded, params)
+
+        # signals are not interned
+        signal = dict(params, command="signal")
+        self.assertEqual(self.envelope.decode_request(
+              self.envelope.encode_request(signal, names))["method"], "m")
+
+    ##############################################################
+
+    def test_interned_names_batch(self):
+        requests = [{"command": "call", "req_id": b"a", "object": "obj",
+                     "method": "m", "args": (i,), "kwargs": {}}
+                    for i in range(3)]
+        names = snakemq.rpc.NameIds()
+        defined = set()
+        raw = self.envelope.encode_request({"command": "batch",
+                                            "requests": requests},
+                                           names, defined)
+        self.assertEqual(defined, set([1]))
+        # names are sent only in the first request of the batch
+        self.assertEqual(raw.count(b"obj"), 1)
+        decoded = self.envelope.decode_request(raw, names={})
+        for request in decoded["requests"]:
+            del request["serializer"]
+        self.assertEqual(decoded["requests"], requests)
+
+#############################################################################
+#############################################################################
+
 class TestRpcClient(utils.TestCase):
     def setUp(self):
         self.client = snakemq.rpc.RpcClient(mock.Mock())
-        self.client.cond = mock.MagicMock()
         self.proxy = self.client.get_proxy("peer", "some_proxy")
 
     ##############################################################
@@ -73,15 +206,15 @@ class TestRpcClient(utils.TestCase):
             self.assertEqual(result["return"],
                   self.client.remote_request("some ident", self.proxy.some_method,
                                               params))
-            self.assertEqual(self.client.waiting_for_result, set())
-            self.assertEqual(self.client.results, {})
+            self.assertEqual(self.client.pending, {})
+            self.assertEqual(self.client.pending_by_ident, {})
 
             # respond is an exception
             result["ok"] = False
             self.assertRaises(TestException, self.client.remote_request,
                                   "some ident", self.proxy.some_method, params)
-            self.assertEqual(self.client.waiting_for_result, set())
-            self.assertEqual(self.client.results, {})
+            self.assertEqual(self.client.pending, {})
+            self.assertEqual(self.client.pending_by_ident, {})
 
     ##############################################################
 
@@ -97,10 +230,11 @@ class TestRpcClient(utils.TestCase):
         with mock.patch("snakemq.rpc.get_time") as time_mock:
             time_results = iter([0.0, timeout * 1.1])
             time_mock.side_effect = lambda: next(time_results)
-            self.assertRaises(snakemq.rpc.NotConnected, method)
-        self.assertEqual(self.client.cond.wait.call_count, 1)
-        self.assertEqual(self.client.connected.get.call_count, 2)
-        self.assertEqual(self.client.waiting_for_result, set())
+            with mock.patch.object(snakemq.rpc.PendingCall, "wait") as wait_mock:
+                self.assertRaises(snakemq.rpc.NotConnected, method)
+        self.assertEqual(wait_mock.call_count, 1)
+        self.assertEqual(self.client.connected.get.call_count, 1)
+        self.assertEqual(self.client.pending, {})
 
     ##############################################################
 
@@ -119,16 +253,189 @@ class TestRpcClient(utils.TestCase):
         with mock.patch("snakemq.rpc.get_time") as time_mock:
             time_results = iter([0.0, timeout * 1.1])
             time_mock.side_effect = lambda: next(time_results)
-            self.assertRaises(snakemq.rpc.PartialCall, method)
-        self.assertEqual(self.client.cond.wait.call_count, 1)
+            with mock.patch.object(snakemq.rpc.PendingCall, "wait") as wait_mock:
+                self.assertRaises(snakemq.rpc.PartialCall, method)
+        self.assertEqual(wait_mock.call_count, 1)
         self.assertEqual(self.client.connected.get.call_count, 2)
 
         # subsequent reception of result must not be saved
         req_id = self.client.send_params.call_args[0][1]["req_id"]
-        self.assertEqual(self.client.waiting_for_result, set())
+        self.assertEqual(self.client.pending, {})
         result = {"req_id": req_id}
         self.client.store_result(result)
-        self.assertEqual(self.client.results, {})
+        self.assertEqual(self.client.pending, {})
+
+    ##############################################################
+
+    def test_reply_wakes_only_its_caller(self):
+        lock = self.client.lock
+        pending_a = snakemq.rpc.PendingCall(lock, "peer", b"a")
+        pending_b = snakemq.rpc.PendingCall(lock, "peer", b"b")
+        pending_c = snakemq.rpc.PendingCall(lock, "other", b"c")
+        for pending in (pending_a, pending_b, pending_c):
+            pending.notify = mock.Mock()
+            self.client.add_pending(pending)
+
+        with lock:
+            self.client.store_result({"req_id": b"a"})
+        self.assertEqual(pending_a.notify.call_count, 1)
+        self.assertEqual(pending_b.notify.call_count, 0)
+        self.assertEqual(pending_c.notify.call_count, 0)
+
+        self.client.on_disconnect(None, "other")
+        self.assertEqual(pending_a.notify.call_count, 1)
+        self.assertEqual(pending_b.notify.call_count, 0)
+        self.assertEqual(pending_c.notify.call_count, 1)
+
+    ##############################################################
+
+    def reply(self, data):
+        message = snakemq.message.Message(snakemq.rpc.REPLY_PREFIX +
+                                            self.client.pickler.dumps(data))
+        self.client.on_recv(None, "peer", message)
+
+    ##############################################################
+
+    def test_call_async(self):
+        self.client.send_params = mock.Mock()
+        future = self.proxy.some_method.call_async(1, 2)
+        self.assertFalse(self.client.send_params.called)  # not connected
+
+        self.client.on_connect(None, "peer")
+        params = self.client.send_params.call_args[0][1]
+        self.assertEqual(params["args"], (1, 2))
+        self.assertFalse(future.done())
+
+        # sent again after reconnection
+        self.client.on_disconnect(None, "peer")
+        self.client.on_connect(None, "peer")
+        self.assertEqual(self.client.send_params.call_count, 2)
+
+        self.reply({"req_id": params["req_id"], "ok": True, "return": 3})
+        self.assertEqual(future.result(0), 3)
+        self.assertEqual(self.client.pending, {})
+
+    ##############################################################
+
+    def test_call_async_exception(self):
+        self.client.send_params = mock.Mock()
+        self.client.on_connect(None, "peer")
+        future = self.proxy.some_method.call_async()
+        req_id = self.client.send_params.call_args[0][1]["req_id"]
+        self.reply({"req_id": req_id, "ok": False,
+                    "exception": TestException(), "exception_format": "tb"})
+        exc = future.exception(0)
+        self.assertTrue(isinstance(exc, TestException))
+        self.assertEqual(getattr(exc, snakemq.rpc.REMOTE_TRACEBACK_ATTR), "tb")
+
+    ##############################################################
+
+    def test_call_async_cancel(self):
+        self.client.send_params = mock.Mock()
+        future = self.proxy.some_method.call_async()
+        self.assertTrue(future.cancel())
+        self.assertEqual(self.client.pending, {})
+        self.assertEqual(self.client.pending_by_ident, {})
+
+    ##############################################################
+
+    def test_call_async_no_futures(self):
+        self.client.send_params = mock.Mock()
+        self.client.on_connect(None, "peer")
+        method = self.proxy.some_method
+        with mock.patch("snakemq.rpc.Future", None):
+            self.assertRaises(RuntimeError, method.call_async)
+            method.signal_timeout = 1
+            self.assertRaises(RuntimeError, method.call_async)
+        self.assertFalse(self.client.send_params.called)
+
+    ##############################################################
+
+    def test_envelope_negotiation(self):
+        messaging = self.client.receive_hook.messaging
+        params = {"command": "call", "req_id": b"a", "object": "obj",
+                  "method": "m", "args": (), "kwargs": {}}
+
+        # older peers understand only the pickled dict
+        self.client.send_params("peer", params, 0)
+        message = messaging.send_message.call_args[0][1]
+        self.assertEqual(
+              pickle.loads(message.data[len(snakemq.rpc.REQUEST_PREFIX):]),
+              params)
+
+        self.reply({"req_id": b"x", "ok": True, "return": None,
+                    "envelope": snakemq.rpc.ENVELOPE_VERSION})
+        self.client.send_params("peer", params, 0)
+        message = messaging.send_message.call_args[0][1]
+        data = message.data[len(snakemq.rpc.REQUEST_PREFIX):]
+        self.assertEqual(data[0:1],
+                          bytes(bytearray([snakemq.rpc.ENVELOPE_VERSION])))
+        self.assertTrue(b"obj" in data)
+
+        # names are interned once the defining message is sent
+        self.client.on_message_sent(None, "peer", message.uuid)
+        self.client.send_params("peer", params, 0)
+        data = messaging.send_message.call_args[0][1].data
+        self.assertFalse(b"obj" in data)
+
+        # a reconnected peer might be older
+        self.client.on_disconnect(None, "peer")
+        self.client.send_params("peer", params, 0)
+        message = messaging.send_message.call_args[0][1]
+        self.assertEqual(
+              pickle.loads(message.data[len(snakemq.rpc.REQUEST_PREFIX):]),
+              params)
+
+    ##############################################################
+
+    def test_envelope_with_serializer(self):
+        client = snakemq.rpc.RpcClient(mock.Mock(),
+                          serializer=snakemq.serializers.MarshalSerializer())
+        params = {"command": "call", "req_id": b"a", "object": "obj",
+                  "method": "m", "args": (), "kwargs": {}}
+        client.send_params("peer", params, 0)
+        message = client.receive_hook.messaging.send_message.call_args[0][1]
+        decoded = client.envelope.decode_request(message.data,
+                                            len(snakemq.rpc.REQUEST_PREFIX))
+        self.assertEqual(decoded["serializer"],
+                          snakemq.serializers.SERIALIZER_MARSHAL)
+
+    ##############################################################
+
+    def test_send_params_locked(self):
+        """
+        Interned names are shared with the link thread.
+        """
+        locked = []
+        self.client.send_params = mock.Mock(
+                  side_effect=lambda *args: locked.append(
+                                                    self.client.lock.locked()))
+        self.client.on_connect(None, "peer")
+        method = self.proxy.some_method
+        with self.client.batch("peer"):
+            method.call_async()
+        method.signal_timeout = 1
+        method()
+        method.call_async()
+        self.assertEqual(locked, [True] * 3)
+
+    ##############################################################
+
+    def test_batch(self):
+        self.client.send_params = mock.Mock()
+        self.client.on_connect(None, "peer")
+        with self.client.batch("peer"):
+            futures = [self.proxy.some_method.call_async(i) for i in range(3)]
+            self.assertFalse(self.client.send_params.called)
+        self.assertEqual(self.client.send_params.call_count, 1)
+        params = self.client.send_params.call_args[0][1]
+        self.assertEqual(params["command"], "batch")
+        self.assertEqual([request["args"] for request in params["requests"]],
+                          [(0,), (1,), (2,)])
+
+        for i, request in enumerate(params["requests"]):
+            self.reply({"req_id": request["req_id"], "ok": True, "return": i})
+        self.assertEqual([future.result(0) for future in futures], [0, 1, 2])
 
 #############################################################################
 #############################################################################
@@ -137,11 +444,108 @@ class TestRpcServer(utils.TestCase):
     def setUp(self):
         self.server = snakemq.rpc.RpcServer(mock.Mock())
 
+    def tearDown(self):
+        self.server.shutdown()
+
+    ##############################################################
+
+    def test_on_recv__submits_to_pool(self):
+        self.server.pool = mock.Mock()
+        self.server.register_object(object(), "a")
+        self.server.register_object(object(), "b", serialize=True)
+        for objname in ("a", "b"):
+            params = {"command": "call", "object": objname, "method": "m"}
+            data = (snakemq.rpc.REQUEST_PREFIX +
+                    self.server.pickler.dumps(params))
+            self.server.on_recv(None, "peerident", snakemq.message.Message(data))
+        calls = [call[0] for call in self.server.pool.submit.call_args_list]
+        self.assertEqual(calls[0][0], self.server.call_method)
+        self.assertEqual(calls[0][1][1]["object"], "a")
+        self.assertEqual(calls[0][2], None)
+        self.assertEqual(calls[1][1][1]["object"], "b")
+        self.assertEqual(calls[1][2], "b")
+
+    ##############################################################
+
+    def test_batch(self):
+        self.server.pool = mock.Mock()
+        requests = [{"command": "call", "object": "a", "method": "m"},
+                    {"command": "signal", "object": "a", "method": "n"}]
+        self.server.handle_request("peerident",
+                              {"command": "batch", "requests": requests})
+        calls = [call[0] for call in self.server.pool.submit.call_args_list]
+        self.assertEqual([call[1][1] for call in calls], requests)
+
+    ##############################################################
+
+    def test_interned_names(self):
+        self.server.pool = mock.Mock()
+        envelope = snakemq.rpc.Envelope()
+        names = snakemq.rpc.NameIds()
+        params = {"command": "call", "req_id": b"a", "object": "obj",
+                  "method": "m", "args": (), "kwargs": {}}
+        raw_defining = envelope.encode_request(params, names, set())
+        names.known.add(1)
+        raw = envelope.encode_request(params, names)
+        for data in (raw_defining, raw):
+            self.server.on_recv(None, "peerident", snakemq.message.Message(
+                                      snakemq.rpc.REQUEST_PREFIX + data))
+        self.assertEqual(self.server.pool.submit.call_count, 2)
+        self.assertEqual(
+              self.server.pool.submit.call_args[0][1][1]["object"], "obj")
+
+        # the client defines the names again after a reconnection
+        self.server.on_disconnect(None, "peerident")
+        self.server.on_recv(None, "peerident", snakemq.message.Message(
+                                      snakemq.rpc.REQUEST_PREFIX + raw))
+        self.assertEqual(self.server.pool.submit.call_count, 2)
+
+    ##############################################################
+
+    def test_busy(self):
+        self.server.pool = mock.Mock()
+        self.server.pool.submit.return_value = False
+        self.server.pool.__len__ = mock.Mock(return_value=1)
+        self.server.send = mock.Mock()
+        requests = [{"command": "call", "req_id": b"r", "object": "a",
+                     "method": "m"},
+                    {"command": "signal", "object": "a", "method": "n"}]
+        self.server.handle_request("peerident",
+                              {"command": "batch", "requests": requests})
+        self.assertEqual(self.server.pool.submit.call_args[1],
+                          {"block": False})
+        # only the call gets a reply
+        self.assertEqual(self.server.send.call_count, 1)
+        ident, data = self.server.send.call_args[0][:2]
+        self.assertEqual(ident, "peerident")
+        self.assertEqual(data["req_id"], b"r")
+        self.assertTrue(isinstance(data["exception"],
+                                    snakemq.rpc.ServerBusyError))
+
+    ##############################################################
+
+    def test_shut_down(self):
+        self.server.send = mock.Mock()
+        self.server.shutdown()
+        self.server.handle_request("peerident",
+                              {"command": "call", "req_id": b"r", "object": "a",
+                               "method": "m", "args": (), "kwargs": {}})
+        self.assertEqual(self.server.send.call_count, 1)
+        data = self.server.send.call_args[0][1]
+        self.assertTrue(isinstance(data["exception"],
+                                    snakemq.rpc.ServerBusyError))
+        # signals are dropped
+        self.server.handle_request("peerident",
+                              {"command": "signal", "object": "a",
+                               "method": "m", "args": (), "kwargs": {}})
+        self.assertEqual(self.server.send.call_count, 1)
+
     ##############################################################
 
     def test_send_unpickable(self):
+        data = {"req_id": b"req id", "ok": True, "return": UnpickableData()}
         self.assertRaises(self.server.pickler.PickleError,
-                          self.server.send, "some ident", UnpickableData())
+                          self.server.send, "some ident", data)
 
     ##############################################################
 
@@ -151,7 +555,7 @@ class TestRpcServer(utils.TestCase):
         # --- send pickable exception, no exception is raised
         # no traceback
         exc = TestException()
-        self.server.send_exception("some ident", "req id", exc)
+        self.server.send_exception("some ident", b"req id", exc)
         exc_value = self.server.send.call_args[0][1]["exception"]
         exc_format = self.server.send.call_args[0][1]["exception_format"]
         self.assertEqual(exc_value, exc)
@@ -161,7 +565,7 @@ class TestRpcServer(utils.TestCase):
         try:
             raise exc
         except TestException:
-            self.server.send_exception("some ident", "req id", exc)
+            self.server.send_exception("some ident", b"req id", exc)
             exc_value = self.server.send.call_args[0][1]["exception"]
             exc_format = self.server.send.call_args[0][1]["exception_format"]
             self.assertEqual(exc_value, exc)
@@ -171,7 +575,7 @@ class TestRpcServer(utils.TestCase):
         # --- send unpickable exception, original exception must be raised
         exc = TestException(UnpickableData())
         self.assertRaises(exc.__class__,
-                          self.server.send_exception, "some ident", "req id", exc)
+                          self.server.send_exception, "some ident", b"req id", exc)
 
     ##############################################################
 
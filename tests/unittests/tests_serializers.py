@@ -0,0 +1,74 @@
+#! -*- coding: utf-8 -*-
+"""
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import mock
+
+from snakemq import serializers
+
+import utils
+
+#############################################################################
+#############################################################################
+
+class TestSerializers(utils.TestCase):
+    def check_roundtrip(self, serializer, obj):
+        self.assertEqual(serializer.loads(serializer.dumps(obj)), obj)
+        self.assertEqual(serializer.loads(memoryview(serializer.dumps(obj))),
+                          obj)
+
+    ##############################################################
+
+    def test_ids(self):
+        ids = [serializer.id for serializer
+                in serializers.default_serializers().values()]
+        self.assertEqual(len(ids), len(set(ids)))
+
+    ##############################################################
+
+    def test_pickle(self):
+        self.check_roundtrip(serializers.PickleSerializer(),
+                              ((1, "a", b"b"), {"x": None}))
+        self.check_roundtrip(serializers.PickleSerializer(protocol=2),
+                              ((1, "a", b"b"), {"x": None}))
+
+    ##############################################################
+
+    def test_marshal(self):
+        self.check_roundtrip(serializers.MarshalSerializer(),
+                              ((1, "a", b"b"), {"x": None}))
+        self.assertRaises(ValueError,
+                          serializers.MarshalSerializer().dumps, object())
+
+    ##############################################################
+
+    def test_pickle_oob(self):
+        if not serializers.HAS_PICKLE_OOB:
+            return
+        serializer = serializers.PickleOutOfBandSerializer()
+        data = ((bytearray(b"a" * 100000), b"b"), {"c": bytearray(b"d")})
+        raw = serializer.dumps(data)
+        self.assertEqual(serializer.loads(raw), data)
+        # the buffer is not duplicated
+        self.assertLess(len(raw), 100000 + 200)
+
+    ##############################################################
+
+    def test_msgpack(self):
+        if serializers.msgpack is None:
+            return
+        serializer = serializers.MsgpackSerializer()
+        self.assertEqual(serializer.loads(serializer.dumps(((1, b"a"), {}))),
+                          [[1, b"a"], {}])
+
+    ##############################################################
+
+    def test_not_available(self):
+        with mock.patch("snakemq.serializers.msgpack", None):
+            self.assertRaises(RuntimeError, serializers.MsgpackSerializer)
+        with mock.patch("snakemq.serializers.HAS_PICKLE_OOB", False):
+            self.assertRaises(RuntimeError,
+                              serializers.PickleOutOfBandSerializer)
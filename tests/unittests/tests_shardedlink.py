@@ -0,0 +1,125 @@
+#! -*- coding: utf-8 -*-
+"""
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import threading
+
+import mock
+from nose.tools import timed
+
+import snakemq.link
+import snakemq.shardedlink
+
+import utils
+
+#############################################################################
+#############################################################################
+
+TEST_PORT = 40050
+CLIENTS = 6
+
+LOOP_RUNTIME = 3.0
+LOOP_RUNTIME_ASSERT = 3.5
+
+#############################################################################
+#############################################################################
+
+class TestShardedLink(utils.TestCase):
+    def setUp(self):
+        self.link = snakemq.shardedlink.ShardedLink(3)
+
+    def tearDown(self):
+        self.link.cleanup()
+
+    ########################################################
+
+    def test_select_shard(self):
+        shards = self.link.shards
+        shards[0].post(mock.Mock())
+        shards[1]._connectors["x"] = None
+        self.assertEqual(self.link.select_shard(), shards[2])
+        del shards[1]._connectors["x"]
+        shards[0].run_posted()
+
+    ########################################################
+
+    def test_connector_in_shard(self):
+        addr = self.link.add_connector(("localhost", TEST_PORT))
+        shard = self.link._connector_shards[addr]
+        shard.run_posted()
+        self.assertEqual(list(shard._connectors.keys()), [addr])
+        self.link.del_connector(addr)
+        shard.run_posted()
+        self.assertEqual(len(shard._connectors), 0)
+
+    ########################################################
+
+    def test_send_unknown_connection(self):
+        self.link.send("xyz", b"abc")
+        self.link.close("xyz")
+        for shard in self.link.shards:
+            self.assertEqual(len(shard._posted), 0)
+
+    ########################################################
+
+    @timed(LOOP_RUNTIME_ASSERT)
+    def test_echo(self):
+        """
+        More clients are spread across the shards and the callbacks are
+        called from the main loop.
+        """
+        link = self.link
+        link.add_listener(("", TEST_PORT))
+        main_thread = threading.current_thread()
+        container = {"threads": set(), "shards": set(), "echoed": 0}
+
+        def on_connect(conn_id):
+            container["threads"].add(threading.current_thread())
+            container["shards"].add(link._shard_by_conn[conn_id])
+        def on_recv(conn_id, data):
+            container["threads"].add(threading.current_thread())
+            link.send(conn_id, data)
+
+        link.on_connect.add(on_connect)
+        link.on_recv.add(on_recv)
+
+        clients = []
+        for i in range(CLIENTS):
+            client = snakemq.link.Link()
+            client.add_connector(("localhost", TEST_PORT))
+            clients.append(client)
+
+        def run_client(client):
+            def on_connect(conn_id):
+                client.send(conn_id, b"hello")
+            def on_recv(conn_id, data):
+                assert data == b"hello"
+                container["echoed"] += 1
+                client.stop()
+            client.on_connect = on_connect
+            client.on_recv = on_recv
+            client.loop(runtime=LOOP_RUNTIME)
+
+        threads = [threading.Thread(target=run_client, args=[client])
+                    for client in clients]
+        for thr in threads:
+            thr.start()
+
+        def on_loop_pass():
+            if container["echoed"] == CLIENTS:
+                link.stop()
+        link.on_loop_pass.add(on_loop_pass)
+        try:
+            link.loop(runtime=LOOP_RUNTIME)
+        finally:
+            for thr in threads:
+                thr.join()
+            for client in clients:
+                client.cleanup()
+
+        self.assertEqual(container["echoed"], CLIENTS)
+        self.assertEqual(container["threads"], set([main_thread]))
+        self.assertEqual(container["shards"], set(link.shards))
@@ -0,0 +1,221 @@
+#! -*- coding: utf-8 -*-
+"""
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import os
+import mmap
+import threading
+import tempfile
+
+import mock
+from nose.tools import timed
+
+import snakemq.link
+import snakemq.packeter
+import snakemq.shmlink
+
+import utils
+
+#############################################################################
+#############################################################################
+
+LOOP_RUNTIME = 3.0
+LOOP_RUNTIME_ASSERT = 3.5
+
+RING_SIZE = 1024
+
+#############################################################################
+#############################################################################
+
+class TestShmRing(utils.TestCase):
+    def setUp(self):
+        size = snakemq.shmlink.RING_HEADER_SIZE + RING_SIZE
+        self.mm = mmap.mmap(-1, size)
+        self.ring = snakemq.shmlink.ShmRing(self.mm, 0, size)
+
+    def tearDown(self):
+        self.mm.close()
+
+    ########################################################
+
+    def test_read_write(self):
+        ring = self.ring
+        self.assertEqual(ring.read(), None)
+        self.assertEqual(ring.write([b"ab", memoryview(b"cde")]), 5)
+        self.assertEqual(len(ring), 5)
+        self.assertEqual(ring.read(), b"abcde")
+        self.assertEqual(len(ring), 0)
+
+    ########################################################
+
+    def test_full(self):
+        ring = self.ring
+        self.assertEqual(ring.write(b"x" * (RING_SIZE + 10)), RING_SIZE)
+        self.assertEqual(ring.write(b"y"), 0)
+        self.assertEqual(ring.read(), b"x" * RING_SIZE)
+
+    ########################################################
+
+    def test_wraparound(self):
+        ring = self.ring
+        ring.write(b"a" * (RING_SIZE - 3))
+        ring.read()
+        data = b"0123456789"
+        self.assertEqual(ring.write(data), len(data))
+        self.assertEqual(ring.read(), data)
+
+#############################################################################
+#############################################################################
+
+class TestShmLink(utils.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        address = "unix:" + os.path.join(self.tmpdir, "sock")
+        self.link_server = snakemq.shmlink.ShmLink(ring_size=64 * 1024)
+        self.link_server.add_listener(address)
+        self.link_client = snakemq.shmlink.ShmLink(ring_size=64 * 1024)
+        self.link_client.add_connector(address)
+
+    def tearDown(self):
+        self.link_server.cleanup()
+        self.link_client.cleanup()
+        os.rmdir(self.tmpdir)
+
+    ########################################################
+
+    @timed(LOOP_RUNTIME_ASSERT)
+    def test_large_packet(self):
+        """
+        Packet larger than the ring goes through the packeter.
+        """
+        data = os.urandom(1024 * 1024)
+        received = []
+        packeter_server = snakemq.packeter.Packeter(self.link_server)
+        packeter_client = snakemq.packeter.Packeter(self.link_client)
+
+        def on_packet_recv(conn_id, packet):
+            received.append(packet)
+            self.link_server.stop()
+        packeter_server.on_packet_recv.add(on_packet_recv)
+
+        def on_connect(conn_id):
+            packeter_client.send_packet(conn_id, data)
+        def on_packet_sent(conn_id, packet_id):
+            self.link_client.stop()
+        packeter_client.on_connect.add(on_connect)
+        packeter_client.on_packet_sent.add(on_packet_sent)
+
+        thr = threading.Thread(target=self.link_server.loop,
+                                kwargs={"runtime": LOOP_RUNTIME})
+        thr.start()
+        try:
+            self.link_client.loop(runtime=LOOP_RUNTIME)
+        finally:
+            thr.join()
+
+        self.assertEqual(received, [data])
+        # the listener has removed the shared memory file
+        for conn in self.link_client.connections.values():
+            self.assertFalse(os.path.exists(conn.path))
+
+    ########################################################
+
+    def test_disconnect(self):
+        link = self.link_server
+        conn = snakemq.shmlink.ShmConnection("c", snakemq.shmlink.STATE_READY)
+        conn.mm = mmap.mmap(-1, 100)
+        link.connections["c"] = conn
+        disconnected = []
+        link.on_disconnect.add(disconnected.append)
+        link._on_link_disconnect("c")
+        self.assertEqual(disconnected, ["c"])
+        self.assertEqual(conn.mm, None)
+        self.assertEqual(len(link.connections), 0)
+
+#############################################################################
+#############################################################################
+
+class TestShmLinkHello(utils.TestCase):
+    def setUp(self):
+        self.link = snakemq.shmlink.ShmLink(ring_size=RING_SIZE)
+        self.link.link.close = mock.Mock()
+        self.ring_size = self.link.ring_size
+        self.conn = snakemq.shmlink.ShmConnection("c",
+                                            snakemq.shmlink.STATE_HELLO)
+        self.link.connections["c"] = self.conn
+        self.paths = []
+
+    def tearDown(self):
+        self.conn.close()
+        self.link.cleanup()
+        for path in self.paths:
+            if os.path.lexists(path):
+                os.unlink(path)
+
+    ########################################################
+
+    def make_file(self, size):
+        fd, path = tempfile.mkstemp(prefix=snakemq.shmlink.SHM_PREFIX,
+                                    dir=snakemq.shmlink.SHM_DIR)
+        os.ftruncate(fd, size)
+        os.close(fd)
+        self.paths.append(path)
+        return path
+
+    def send_hello(self, path, ring_size=None):
+        path = path.encode("utf-8")
+        if ring_size is None:
+            ring_size = self.ring_size
+        self.link.parse_hello(self.conn,
+              snakemq.shmlink.HELLO_HEADER.pack(snakemq.shmlink.HELLO_MAGIC,
+                                                ring_size, len(path)) + path)
+
+    def assert_refused(self):
+        self.assertEqual(self.link.link.close.call_count, 1)
+        self.assertEqual(self.conn.mm, None)
+        self.assertEqual(self.conn.state, snakemq.shmlink.STATE_HELLO)
+
+    ########################################################
+
+    def test_valid(self):
+        path = self.make_file(self.ring_size * 2)
+        self.link.ring = mock.Mock()
+        self.send_hello(path)
+        self.assertEqual(self.conn.state, snakemq.shmlink.STATE_READY)
+        self.assertFalse(os.path.exists(path))
+
+    def test_symlink(self):
+        target = self.make_file(self.ring_size * 2)
+        path = target + "_link"
+        os.symlink(target, path)
+        self.paths.append(path)
+        self.send_hello(path)
+        self.assert_refused()
+        self.assertTrue(os.path.exists(target))
+
+    def test_empty_file(self):
+        self.send_hello(self.make_file(0))
+        self.assert_refused()
+
+    def test_missing_file(self):
+        path = self.make_file(0)
+        os.unlink(path)
+        self.send_hello(path)
+        self.assert_refused()
+
+    def test_size_mismatch(self):
+        path = self.make_file(self.ring_size * 2)
+        self.send_hello(path, self.ring_size + 1)
+        self.assert_refused()
+        self.conn.hello = b""
+        self.send_hello(path, snakemq.shmlink.MAX_RING_SIZE + 1)
+        self.assertEqual(self.link.link.close.call_count, 2)
+        self.assertTrue(os.path.exists(path))
+
+    def test_outside_dir(self):
+        self.send_hello(os.path.join(tempfile.gettempdir(), "..", "etc",
+                                     snakemq.shmlink.SHM_PREFIX))
+        self.assert_refused()
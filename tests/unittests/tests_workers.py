@@ -0,0 +1,105 @@
+#! -*- coding: utf-8 -*-
+"""
+@author: David Siroky (siroky@dasir.cz)
+@license: MIT License (see LICENSE.txt or
+          U{http://www.opensource.org/licenses/mit-license.php})
+"""
+
+import threading
+import time
+
+from snakemq.workers import WorkersPool
+
+import utils
+
+#############################################################################
+#############################################################################
+
+class TestWorkersPool(utils.TestCase):
+    def setUp(self):
+        self.pool = WorkersPool(workers=4, max_pending=8)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    ##############################################################
+
+    def test_execute(self):
+        results = []
+        lock = threading.Lock()
+
+        def task(i):
+            with lock:
+                results.append(i)
+
+        for i in range(100):
+            self.pool.submit(task, (i,))
+        self.pool.shutdown()
+        self.assertEqual(sorted(results), list(range(100)))
+        self.assertLessEqual(len(self.pool.threads), 4)
+        stats = self.pool.get_stats()
+        self.assertEqual(stats.submitted, 100)
+        self.assertEqual(stats.completed, 100)
+
+    ##############################################################
+
+    def test_serialized_key(self):
+        results = []
+        running = []
+
+        def task(i):
+            running.append(i)
+            self.assertEqual(len(running), 1)
+            time.sleep(0.001)
+            results.append(i)
+            running.remove(i)
+
+        for i in range(20):
+            self.pool.submit(task, (i,), key="a")
+        self.pool.shutdown()
+        self.assertEqual(results, list(range(20)))
+
+    ##############################################################
+
+    def test_backpressure(self):
+        event = threading.Event()
+        for i in range(8):
+            self.pool.submit(event.wait)
+        self.assertEqual(len(self.pool), 8)
+
+        submitted = threading.Event()
+
+        def submitter():
+            self.pool.submit(lambda: None)
+            submitted.set()
+
+        thr = threading.Thread(target=submitter)
+        thr.start()
+        self.assertFalse(submitted.wait(0.05))
+        event.set()
+        thr.join()
+        self.assertTrue(submitted.is_set())
+
+    ##############################################################
+
+    def test_refuse(self):
+        event = threading.Event()
+        for i in range(8):
+            self.assertTrue(self.pool.submit(event.wait, block=False))
+        self.assertFalse(self.pool.submit(lambda: None, block=False))
+        self.assertEqual(len(self.pool), 8)
+        event.set()
+
+    ##############################################################
+
+    def test_failing_task(self):
+        def task():
+            raise ValueError("task failure")
+        self.pool.log.disabled = True
+        try:
+            self.pool.submit(task)
+            self.pool.shutdown()
+        finally:
+            self.pool.log.disabled = False
+        self.assertEqual(self.pool.get_stats().completed, 1)
+        self.assertRaises(RuntimeError, self.pool.submit, task)